@@ -0,0 +1,31 @@
+import time
+from functools import lru_cache
+
+import redis
+from django.conf import settings
+
+
+@lru_cache(maxsize=None)
+def get_redis_client():
+    """
+    Общий клиент Redis процесса (один пул соединений) для прямых команд, которых нет в Django cache API.
+    Короткие таймауты: Redis не должен надолго задерживать обработку запроса.
+    """
+    return redis.Redis.from_url(
+        settings.REDIS_URL,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=settings.REDIS_SOCKET_TIMEOUT,
+    )
+
+
+_unavailable_until = 0.0
+
+
+def redis_available():
+    """Не было ли недавно ошибки Redis: после ошибки прямые команды пропускаются REDIS_RETRY_AFTER секунд"""
+    return time.monotonic() >= _unavailable_until
+
+
+def mark_redis_unavailable():
+    global _unavailable_until
+    _unavailable_until = time.monotonic() + settings.REDIS_RETRY_AFTER
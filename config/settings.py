@@ -106,28 +106,49 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 AUTH_USER_MODEL = "users.CustomUser"
 
 REST_FRAMEWORK = {
-    "DEFAULT_AUTHENTICATION_CLASSES": ("rest_framework_simplejwt.authentication.JWTAuthentication",),
+    "DEFAULT_AUTHENTICATION_CLASSES": ("users.authentication.CachedJWTAuthentication",),
+    "DEFAULT_THROTTLE_CLASSES": ("users.throttling.TokenBucketThrottle",),
+    # Лимиты по throttle_scope представлений: "N/период" - до N запросов подряд, дальше N за период
+    "DEFAULT_THROTTLE_RATES": {
+        "subscriptions": os.getenv("THROTTLE_RATE_SUBSCRIPTIONS", "30/min"),
+        "payments": os.getenv("THROTTLE_RATE_PAYMENTS", "10/min"),
+        "register": os.getenv("THROTTLE_RATE_REGISTER", "5/min"),
+    },
 }
 
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=15),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
+    "TOKEN_OBTAIN_SERIALIZER": "users.serializers.ClaimsTokenObtainPairSerializer",
+    "TOKEN_REFRESH_SERIALIZER": "users.serializers.ClaimsTokenRefreshSerializer",
 }
+LESSON_BULK_MAX_ITEMS = 1000  # Максимум уроков в одном запросе массового импорта
+USER_PAYMENTS_EXPAND_LIMIT = 20  # Сколько последних платежей встраивается в пользователя по ?expand=payments
+PAYMENT_EXPORT_CHUNK_SIZE = 2000  # Размер порции серверного курсора при выгрузке платежей
+AUTH_USER_CACHE_TIMEOUT = 60  # Сколько секунд строка пользователя живет в кеше для небезопасных запросов
+IDEMPOTENCY_KEY_TIMEOUT = 60 * 60 * 24  # Сколько хранится ответ на запрос с Idempotency-Key
+IDEMPOTENCY_LOCK_TIMEOUT = 10  # Блокировка одновременных повторов, секунды
 
 STRIPE_API_KEY = os.getenv("STRIPE_API_KEY")
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")  # Секрет подписи вебхуков (whsec_...)
 
 # Cache and Celery configuration
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 0.2))  # Таймаут прямых команд Redis, секунды
+REDIS_RETRY_AFTER = 30  # Сколько секунд не обращаться к Redis напрямую после ошибки (троттлинг, рейтинги)
+
 CACHES_ENABLED = True
 if CACHES_ENABLED:
     CACHES = {
         "default": {
             "BACKEND": "django.core.cache.backends.redis.RedisCache",
-            "LOCATION": os.getenv("REDIS_URL", "redis://redis:6379/0"),
+            "LOCATION": REDIS_URL,
         }
     }
+CACHE_TIMEOUT = int(os.getenv("CACHE_TIMEOUT", 60 * 5))  # TTL закешированных ответов курсов и уроков, секунды
 
-CELERY_BROKER_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
-CELERY_RESULT_BACKEND = os.getenv("REDIS_URL", "redis://redis:6379/0")
+CELERY_BROKER_URL = REDIS_URL
+CELERY_RESULT_BACKEND = REDIS_URL
 CELERY_TIMEZONE = "Europe/Moscow"
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60
@@ -136,7 +157,40 @@ CELERY_BEAT_SCHEDULE = {
         "task": "lms.tasks.deactivate_inactive_users",
         "schedule": crontab(hour=0, minute=0),
     },
+    "relay_outbox": {
+        "task": "lms.tasks.relay_outbox",
+        "schedule": timedelta(seconds=5),
+    },
+    "rebuild_payment_rollups": {
+        "task": "lms.tasks.rebuild_payment_rollups",
+        "schedule": crontab(hour=1, minute=0),
+        "kwargs": {"days": int(os.getenv("PAYMENT_ROLLUP_REPAIR_DAYS", 3))},  # Сверяются только последние дни
+    },
+    "reconcile_pending_payments": {
+        "task": "lms.tasks.reconcile_pending_payments",
+        "schedule": timedelta(minutes=15),
+    },
+    "rebuild_leaderboards": {
+        "task": "lms.tasks.rebuild_leaderboards",
+        "schedule": crontab(minute=30),
+    },
+    "compute_similar_courses": {
+        "task": "lms.tasks.compute_similar_courses",
+        "schedule": crontab(hour=2, minute=0),
+    },
 }
+OUTBOX_RELAY_BATCH_SIZE = int(os.getenv("OUTBOX_RELAY_BATCH_SIZE", 500))
+DEACTIVATE_USERS_BATCH_SIZE = int(os.getenv("DEACTIVATE_USERS_BATCH_SIZE", 1000))
+DEACTIVATE_USERS_BATCH_PAUSE = float(os.getenv("DEACTIVATE_USERS_BATCH_PAUSE", 0.5))  # Пауза между пачками, секунды
+DEACTIVATE_USERS_CHECKPOINT_TIMEOUT = 60 * 60 * 24  # Сколько хранится прогресс прерванного запуска
+# Сессии Stripe Checkout живут не дольше суток, поэтому сверяются платежи за последние пару дней
+PAYMENT_RECONCILE_LOOKBACK_DAYS = int(os.getenv("PAYMENT_RECONCILE_LOOKBACK_DAYS", 2))
+PAYMENT_RECONCILE_BATCH_SIZE = int(os.getenv("PAYMENT_RECONCILE_BATCH_SIZE", 500))
+LEADERBOARD_MAX_DAYS = 30  # Самое длинное скользящее окно рейтинга популярных курсов, дней
+LEADERBOARD_WINDOW_CACHE_TIMEOUT = 60  # Сколько секунд живет собранное окно рейтинга
+SIMILAR_COURSES_TOP_K = int(os.getenv("SIMILAR_COURSES_TOP_K", 10))  # Сколько похожих курсов хранится для курса
+# Предел элементов плотного блока близостей при расчете похожих курсов (float32, 2**24 - около 64 МБ)
+SIMILAR_COURSES_BLOCK_SIZE = int(os.getenv("SIMILAR_COURSES_BLOCK_SIZE", 2**24))
 
 # Email settings
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
@@ -147,6 +201,9 @@ EMAIL_USE_SSL = True
 EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER")
 EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
+COURSE_UPDATE_MAIL_CHUNK_SIZE = int(os.getenv("COURSE_UPDATE_MAIL_CHUNK_SIZE", 500))  # Писем на одно SMTP-соединение
+# Окно (секунды), в котором обновления одного курса схлопываются в одну рассылку. 0 - рассылать сразу
+COURSE_UPDATE_MAIL_DEBOUNCE = int(os.getenv("COURSE_UPDATE_MAIL_DEBOUNCE", 60 * 10))
 
 # Security settings for production
 if not DEBUG:
@@ -0,0 +1,16 @@
+from rest_framework.filters import OrderingFilter
+
+
+class StableOrderingFilter(OrderingFilter):
+    """
+    OrderingFilter, который всегда добавляет id последним ключом сортировки (в направлении последнего ключа).
+    Без него курсорная пагинация по неуникальным столбцам (счетчики, даты) пропускает и повторяет строки
+    с одинаковыми значениями между страницами.
+    """
+
+    def get_ordering(self, request, queryset, view):
+        ordering = list(super().get_ordering(request, queryset, view) or [])
+        if not any(field.lstrip("-") in ("id", "pk") for field in ordering):
+            direction = "-" if ordering and ordering[-1].startswith("-") else ""
+            ordering.append(f"{direction}id")
+        return ordering
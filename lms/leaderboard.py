@@ -0,0 +1,171 @@
+"""
+Рейтинги популярных курсов в sorted set Redis: за все время и по дневным корзинам для скользящих окон.
+Метрики: subscriptions - подписки (отписка уменьшает счет), sales - оплаченные платежи за курс и его уроки.
+Redis обновляется после коммита транзакции, источником истины остается Postgres (см. rebuild).
+"""
+
+import logging
+from datetime import timedelta
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from config.redis_client import get_redis_client, mark_redis_unavailable, redis_available
+
+logger = logging.getLogger(__name__)
+
+METRICS = ("subscriptions", "sales")
+
+
+def _all_time_key(metric):
+    return f"lms:leaderboard:{metric}:all"
+
+
+def _day_key(metric, day):
+    return f"lms:leaderboard:{metric}:day:{day.isoformat()}"
+
+
+def _window_key(metric, days):
+    return f"lms:leaderboard:{metric}:window:{days}"
+
+
+def _day_ttl():
+    # Дневная корзина нужна, пока входит в самое длинное окно
+    return int(timedelta(days=settings.LEADERBOARD_MAX_DAYS + 1).total_seconds())
+
+
+def record(metric, deltas):
+    """
+    Прибавляет к счетам курсов deltas ({(course_id, день): изменение}) после коммита текущей транзакции,
+    одним обращением к Redis. День - дата исходной строки (created_at подписки, date платежа), как в rebuild:
+    отписка от вчерашней подписки уменьшает вчерашнюю корзину, а не сегодняшнюю.
+    Ошибки Redis не мешают основной операции: расхождение исправит rebuild.
+    """
+    deltas = {(course_id, day): delta for (course_id, day), delta in deltas.items() if course_id and delta}
+    if deltas:
+        transaction.on_commit(lambda: _apply(metric, deltas))
+
+
+def _apply(metric, deltas):
+    if not redis_available():
+        return
+    oldest = _window_start(settings.LEADERBOARD_MAX_DAYS)
+    day_keys = set()
+    try:
+        pipe = get_redis_client().pipeline(transaction=False)
+        for (course_id, day), delta in deltas.items():
+            pipe.zincrby(_all_time_key(metric), delta, course_id)
+            if day >= oldest:  # Корзины старше самого длинного окна уже не читаются
+                day_keys.add(_day_key(metric, day))
+                pipe.zincrby(_day_key(metric, day), delta, course_id)
+        for day_key in day_keys:
+            pipe.expire(day_key, _day_ttl())
+        pipe.execute()
+    except redis.RedisError as exc:
+        logger.warning(f"Рейтинг {metric} не обновлен: Redis недоступен ({exc})")
+        mark_redis_unavailable()
+
+
+def top(metric, days=None, limit=10):
+    """
+    Первые limit курсов рейтинга: список пар (course_id, счет) по убыванию счета.
+    Окно в days дней собирается ZUNIONSTORE из дневных корзин и кешируется на LEADERBOARD_WINDOW_CACHE_TIMEOUT.
+    Без Redis рейтинг считается по Postgres.
+    """
+    if redis_available():
+        try:
+            return _top_from_redis(metric, days, limit)
+        except redis.RedisError as exc:
+            logger.warning(f"Рейтинг {metric} считается по БД: Redis недоступен ({exc})")
+            mark_redis_unavailable()
+    scores = db_scores(metric, since=_window_start(days) if days else None)
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+
+def _top_from_redis(metric, days, limit):
+    client = get_redis_client()
+    if not days:
+        key = _all_time_key(metric)
+    else:
+        key = _window_key(metric, days)
+        if not client.exists(key):
+            today = timezone.localdate()
+            day_keys = [_day_key(metric, today - timedelta(days=offset)) for offset in range(days)]
+            pipe = client.pipeline()
+            pipe.zunionstore(key, day_keys)
+            pipe.expire(key, settings.LEADERBOARD_WINDOW_CACHE_TIMEOUT)
+            pipe.execute()
+    # Курсы, потерявшие все подписки, остаются в наборе с нулевым счетом и в выдачу не попадают
+    ranking = client.zrevrangebyscore(key, "+inf", "(0", start=0, num=limit, withscores=True)
+    return [(int(course_id), int(score)) for course_id, score in ranking]
+
+
+def _window_start(days):
+    return timezone.localdate() - timedelta(days=days - 1)
+
+
+def _scores_queryset(metric):
+    """Исходные строки метрики с полем course_key - курсом, к которому относится строка"""
+    from users.models import Payment, SubscriptionForCourse  # users.models импортирует этот модуль
+
+    if metric == "subscriptions":
+        return SubscriptionForCourse.objects.annotate(course_key=F("course_id"))
+    return Payment.objects.filter(is_paid=True).annotate(course_key=Coalesce("course_id", "lesson__course_id"))
+
+
+def _date_field(metric):
+    return "created_at" if metric == "subscriptions" else "date"
+
+
+def db_scores(metric, since=None):
+    """Счета курсов по Postgres: {course_id: счет}, за все время или начиная с дня since"""
+    queryset = _scores_queryset(metric)
+    if since:
+        queryset = queryset.annotate(day=TruncDate(_date_field(metric))).filter(day__gte=since)
+    rows = queryset.filter(course_key__isnull=False).values("course_key").annotate(score=Count("id")).order_by()
+    return {row["course_key"]: row["score"] for row in rows}
+
+
+def db_daily_scores(metric, since):
+    """Счета курсов по дням начиная с since: {день: {course_id: счет}}"""
+    rows = (
+        _scores_queryset(metric)
+        .annotate(day=TruncDate(_date_field(metric)))
+        .filter(day__gte=since, course_key__isnull=False)
+        .values("day", "course_key")
+        .annotate(score=Count("id"))
+        .order_by()
+    )
+    daily = {}
+    for row in rows:
+        daily.setdefault(row["day"], {})[row["course_key"]] = row["score"]
+    return daily
+
+
+def rebuild():
+    """
+    Пересобирает рейтинги из Postgres: счета за все время и дневные корзины за LEADERBOARD_MAX_DAYS дней.
+    Новые наборы пишутся во временные ключи и подменяют старые атомарно (MULTI + RENAME).
+    """
+    since = _window_start(settings.LEADERBOARD_MAX_DAYS)
+    pipe = get_redis_client().pipeline(transaction=True)
+    for metric in METRICS:
+        sets = {_all_time_key(metric): (db_scores(metric), None)}
+        daily = db_daily_scores(metric, since)
+        for offset in range(settings.LEADERBOARD_MAX_DAYS):
+            day = since + timedelta(days=offset)
+            sets[_day_key(metric, day)] = (daily.get(day, {}), _day_ttl())
+        for key, (scores, ttl) in sets.items():
+            if not scores:
+                pipe.delete(key)
+                continue
+            pipe.zadd(f"{key}:rebuild", scores)
+            pipe.rename(f"{key}:rebuild", key)
+            if ttl:
+                pipe.expire(key, ttl)
+        pipe.delete(*(_window_key(metric, days) for days in range(1, settings.LEADERBOARD_MAX_DAYS + 1)))
+    pipe.execute()
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from lms.models import Course
+
+
+class Command(BaseCommand):
+    help = "Recompute denormalized lesson and subscriber counters of courses"
+
+    def handle(self, *args, **options):
+        fixed = Course.recount_counters()
+        self.stdout.write(self.style.SUCCESS(f"Fixed counters of {fixed} courses"))
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from lms.tasks import relay_outbox
+
+
+class Command(BaseCommand):
+    help = "Publish pending outbox messages to the Celery broker"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None, help="Сообщений в одной транзакции")
+        parser.add_argument("--interval", type=float, default=1.0, help="Пауза между проходами, секунды")
+        parser.add_argument("--once", action="store_true", help="Выполнить один проход и завершиться")
+
+    def handle(self, *args, **options):
+        while True:
+            published = relay_outbox(batch_size=options["batch_size"])
+            if published:
+                self.stdout.write(self.style.SUCCESS(f"Published {published} outbox messages"))
+            if options["once"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:31
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lms", "0005_alter_course_description"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OutboxMessage",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("task_name", models.CharField(max_length=255, verbose_name="Задача")),
+                ("args", models.JSONField(blank=True, default=list)),
+                ("kwargs", models.JSONField(blank=True, default=dict)),
+                ("dedup_key", models.CharField(blank=True, max_length=255, null=True, verbose_name="Ключ схлопывания")),
+                (
+                    "available_at",
+                    models.DateTimeField(default=django.utils.timezone.now, verbose_name="Опубликовать не раньше"),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "verbose_name": "Сообщение outbox",
+                "verbose_name_plural": "Сообщения outbox",
+                "indexes": [models.Index(fields=["available_at", "id"], name="outbox_available_idx")],
+                "constraints": [models.UniqueConstraint(fields=("dedup_key",), name="outbox_unique_dedup_key")],
+            },
+        ),
+    ]
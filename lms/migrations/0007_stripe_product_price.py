@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lms", "0006_outboxmessage"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="course",
+            name="stripe_product_id",
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name="lesson",
+            name="stripe_product_id",
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.CreateModel(
+            name="StripePrice",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("amount", models.PositiveIntegerField(verbose_name="Сумма")),
+                ("price_id", models.CharField(max_length=255, unique=True)),
+                (
+                    "course",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="stripe_prices",
+                        to="lms.course",
+                    ),
+                ),
+                (
+                    "lesson",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="stripe_prices",
+                        to="lms.lesson",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Цена Stripe",
+                "verbose_name_plural": "Цены Stripe",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("course", "lesson", "amount"), name="unique_stripe_price", nulls_distinct=False
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:06
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    Course = apps.get_model("lms", "Course")
+    Lesson = apps.get_model("lms", "Lesson")
+    SubscriptionForCourse = apps.get_model("users", "SubscriptionForCourse")
+    lessons = Lesson.objects.filter(course=OuterRef("pk")).order_by().values("course").annotate(count=Count("id"))
+    subscribers = (
+        SubscriptionForCourse.objects.filter(course=OuterRef("pk")).order_by().values("course").annotate(count=Count("id"))
+    )
+    Course.objects.update(
+        lessons_count=Coalesce(Subquery(lessons.values("count")), 0),
+        subscribers_count=Coalesce(Subquery(subscribers.values("count")), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lms", "0007_stripe_product_price"),
+        ("users", "0011_payment_checkout_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="course",
+            name="lessons_count",
+            field=models.PositiveIntegerField(db_index=True, default=0, verbose_name="Количество уроков"),
+        ),
+        migrations.AddField(
+            model_name="course",
+            name="subscribers_count",
+            field=models.PositiveIntegerField(db_index=True, default=0, verbose_name="Количество подписчиков"),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lms", "0008_course_counters"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SimilarCourse",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("score", models.FloatField(verbose_name="Близость")),
+                (
+                    "course",
+                    models.ForeignKey(
+                        db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name="+", to="lms.course"
+                    ),
+                ),
+                (
+                    "similar_course",
+                    models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="+", to="lms.course"),
+                ),
+            ],
+            options={
+                "verbose_name": "Похожий курс",
+                "verbose_name_plural": "Похожие курсы",
+                "indexes": [models.Index(fields=["course", "-score"], name="similar_course_rank_idx")],
+            },
+        ),
+    ]
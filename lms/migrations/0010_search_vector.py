@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:23
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lms", "0009_similarcourse"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="course",
+            name="search_vector",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.contrib.postgres.search.CombinedSearchVector(
+                    django.contrib.postgres.search.SearchVector("title", config="russian", weight="A"),
+                    "||",
+                    django.contrib.postgres.search.SearchVector("description", config="russian", weight="B"),
+                    django.contrib.postgres.search.SearchConfig("russian"),
+                ),
+                output_field=django.contrib.postgres.search.SearchVectorField(),
+            ),
+        ),
+        migrations.AddField(
+            model_name="lesson",
+            name="search_vector",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.contrib.postgres.search.CombinedSearchVector(
+                    django.contrib.postgres.search.SearchVector("title", config="russian", weight="A"),
+                    "||",
+                    django.contrib.postgres.search.SearchVector("description", config="russian", weight="B"),
+                    django.contrib.postgres.search.SearchConfig("russian"),
+                ),
+                output_field=django.contrib.postgres.search.SearchVectorField(),
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="course",
+            index=django.contrib.postgres.indexes.GinIndex(fields=["search_vector"], name="course_search_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="lesson",
+            index=django.contrib.postgres.indexes.GinIndex(fields=["search_vector"], name="lesson_search_idx"),
+        ),
+    ]
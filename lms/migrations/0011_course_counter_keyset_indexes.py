@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:01
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lms", "0010_search_vector"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="course",
+            name="lessons_count",
+            field=models.PositiveIntegerField(default=0, verbose_name="Количество уроков"),
+        ),
+        migrations.AlterField(
+            model_name="course",
+            name="subscribers_count",
+            field=models.PositiveIntegerField(default=0, verbose_name="Количество подписчиков"),
+        ),
+        migrations.AddIndex(
+            model_name="course",
+            index=models.Index(fields=["lessons_count", "id"], name="course_lessons_count_id_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="course",
+            index=models.Index(fields=["subscribers_count", "id"], name="course_subscribers_id_idx"),
+        ),
+    ]
@@ -1,8 +1,30 @@
+from datetime import timedelta
+
 from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.db import models
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
 User = settings.AUTH_USER_MODEL
 
+SEARCH_CONFIG = "russian"  # Конфигурация полнотекстового поиска Postgres: стемминг и стоп-слова
+
+
+def search_vector_field():
+    """
+    Поисковый вектор по названию (вес A) и описанию (вес B). Хранимый генерируемый столбец
+    пересчитывается самой БД при любой записи, включая bulk_create/bulk_update и update().
+    """
+    return models.GeneratedField(
+        expression=SearchVector("title", weight="A", config=SEARCH_CONFIG)
+        + SearchVector("description", weight="B", config=SEARCH_CONFIG),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
 
 class Course(models.Model):
     title = models.CharField(max_length=255)
@@ -11,13 +33,45 @@ class Course(models.Model):
     owner = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="courses", blank=True, null=True
     )
+    stripe_product_id = models.CharField(max_length=255, blank=True, null=True)
+    # Счетчики поддерживаются сигналами и массовыми операциями через F(), расхождения чинит recount_course_counters
+    lessons_count = models.PositiveIntegerField(default=0, verbose_name="Количество уроков")
+    subscribers_count = models.PositiveIntegerField(default=0, verbose_name="Количество подписчиков")
+    search_vector = search_vector_field()
 
     def __str__(self):
         return self.title
 
+    @classmethod
+    def recount_counters(cls):
+        """
+        Пересчитывает счетчики уроков и подписчиков там, где они разошлись с фактическими.
+        Возвращает число исправленных курсов.
+        """
+        from users.models import SubscriptionForCourse  # users.models импортирует lms.models
+
+        lessons = Lesson.objects.filter(course=OuterRef("pk")).order_by().values("course").annotate(count=Count("id"))
+        subscribers = (
+            SubscriptionForCourse.objects.filter(course=OuterRef("pk")).order_by().values("course").annotate(count=Count("id"))
+        )
+        actual_lessons = Coalesce(Subquery(lessons.values("count")), 0)
+        actual_subscribers = Coalesce(Subquery(subscribers.values("count")), 0)
+        drifted = cls.objects.annotate(actual_lessons=actual_lessons, actual_subscribers=actual_subscribers).filter(
+            ~Q(lessons_count=F("actual_lessons")) | ~Q(subscribers_count=F("actual_subscribers"))
+        )
+        return cls.objects.filter(pk__in=drifted.values("pk")).update(
+            lessons_count=actual_lessons, subscribers_count=actual_subscribers
+        )
+
     class Meta:
         verbose_name = "Курс"
         verbose_name_plural = "Курсы"
+        indexes = [
+            GinIndex(fields=["search_vector"], name="course_search_idx"),
+            # Ключи keyset-пагинации при сортировке по счетчикам: (значение, id)
+            models.Index(fields=["lessons_count", "id"], name="course_lessons_count_id_idx"),
+            models.Index(fields=["subscribers_count", "id"], name="course_subscribers_id_idx"),
+        ]
 
 
 class Lesson(models.Model):
@@ -29,6 +83,8 @@ class Lesson(models.Model):
     owner = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="lessons", blank=True, null=True
     )
+    stripe_product_id = models.CharField(max_length=255, blank=True, null=True)
+    search_vector = search_vector_field()
 
     def __str__(self):
         return self.title
@@ -36,3 +92,92 @@ class Lesson(models.Model):
     class Meta:
         verbose_name = "Урок"
         verbose_name_plural = "Уроки"
+        indexes = [
+            GinIndex(fields=["search_vector"], name="lesson_search_idx"),
+        ]
+
+
+class StripePrice(models.Model):
+    """
+    Цена Stripe для курса или урока с определенной суммой. Создается один раз и переиспользуется
+    при каждой оплате (см. users.services.get_stripe_price_id).
+    """
+
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name="stripe_prices", blank=True, null=True)
+    lesson = models.ForeignKey(Lesson, on_delete=models.CASCADE, related_name="stripe_prices", blank=True, null=True)
+    amount = models.PositiveIntegerField(verbose_name="Сумма")
+    price_id = models.CharField(max_length=255, unique=True)
+
+    def __str__(self):
+        return f"{self.course or self.lesson} - {self.amount}: {self.price_id}"
+
+    class Meta:
+        verbose_name = "Цена Stripe"
+        verbose_name_plural = "Цены Stripe"
+        constraints = [
+            models.UniqueConstraint(fields=["course", "lesson", "amount"], name="unique_stripe_price", nulls_distinct=False),
+        ]
+
+
+class OutboxMessage(models.Model):
+    """
+    Задача Celery, записанная в той же транзакции, что и изменение данных.
+    Публикуется в брокер пачками задачей relay_outbox после наступления available_at.
+    """
+
+    task_name = models.CharField(max_length=255, verbose_name="Задача")
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    dedup_key = models.CharField(max_length=255, blank=True, null=True, verbose_name="Ключ схлопывания")
+    available_at = models.DateTimeField(default=timezone.now, verbose_name="Опубликовать не раньше")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.task_name}{tuple(self.args)}"
+
+    @classmethod
+    def enqueue(cls, task_name, args=(), kwargs=None, delay=0, dedup_key=None):
+        """
+        Ставит задачу в outbox. Пока неопубликованная запись с тем же dedup_key существует,
+        повторные вызовы ничего не добавляют.
+        """
+        message = cls(
+            task_name=task_name,
+            args=list(args),
+            kwargs=kwargs or {},
+            dedup_key=dedup_key,
+            available_at=timezone.now() + timedelta(seconds=delay),
+        )
+        cls.objects.bulk_create([message], ignore_conflicts=True)
+
+    class Meta:
+        verbose_name = "Сообщение outbox"
+        verbose_name_plural = "Сообщения outbox"
+        indexes = [
+            models.Index(fields=["available_at", "id"], name="outbox_available_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["dedup_key"], name="outbox_unique_dedup_key"),
+        ]
+
+
+class SimilarCourse(models.Model):
+    """
+    Похожий курс по совместным подпискам: косинусная близость множеств подписчиков двух курсов.
+    Таблица целиком пересчитывается задачей compute_similar_courses (см. lms.recommendations).
+    """
+
+    # Отдельный индекс по course не нужен: его покрывает составной индекс similar_course_rank_idx
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name="+", db_index=False)
+    similar_course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name="+")
+    score = models.FloatField(verbose_name="Близость")
+
+    def __str__(self):
+        return f"{self.course_id} ~ {self.similar_course_id}: {self.score:.3f}"
+
+    class Meta:
+        verbose_name = "Похожий курс"
+        verbose_name_plural = "Похожие курсы"
+        indexes = [
+            models.Index(fields=["course", "-score"], name="similar_course_rank_idx"),
+        ]
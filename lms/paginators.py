@@ -1,7 +1,129 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+
+from django.core.exceptions import FieldDoesNotExist
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Field, Func, Q, Value
+from django.db.models.lookups import GreaterThan, LessThan
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination, PageNumberPagination
 
 
 class CustomPaginator(PageNumberPagination):  # Пользовательский класс для пагинации(DRF).
     page_size = 10  # Определяет количество отображаемых элементов на странице по умолчанию
     page_size_query_param = "page_size"  # Для изменения количества отображаемых элементов
     max_page_size = 50  # Максимальное количество элементов. В случае если пользователь запросит большое количество
+
+
+class CustomCursorPaginator(CursorPagination):
+    """
+    Keyset-пагинация: без COUNT(*) и OFFSET, глубокие страницы стоят столько же, сколько первая.
+    Курсор в ссылках next/previous непрозрачный (base64) и хранит значения всех ключей сортировки
+    последней строки страницы, следующая страница выбирается сравнением строк (a, id) > (x, y).
+    Поэтому сортировка по неуникальным столбцам (счетчики, даты) корректна при любом числе равных значений,
+    если последний ключ уникален (его добавляет StableOrderingFilter).
+    """
+
+    page_size = 10
+    page_size_query_param = "page_size"
+    max_page_size = 50
+    ordering = "id"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = list(self.get_ordering(request, queryset, view))
+        self.cursor = self.decode_cursor(request)
+        reverse = bool(self.cursor and self.cursor.reverse)
+        ordering = [self.invert(field) for field in self.ordering] if reverse else self.ordering
+
+        queryset = self.with_key_fields(queryset).order_by(*ordering)
+        if self.cursor and self.cursor.position is not None:
+            queryset = queryset.filter(self.after(queryset.model, ordering, self.cursor.position))
+
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[: self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = self.cursor is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=self.key(self.page[-1])))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=self.key(self.page[0])))
+
+    @staticmethod
+    def invert(field):
+        return field[1:] if field.startswith("-") else f"-{field}"
+
+    def with_key_fields(self, queryset):
+        # Ключи курсора читаются с объектов страницы: при .only() они тоже должны загружаться
+        field_names, defer = queryset.query.deferred_loading
+        if not defer:
+            queryset = queryset.only(*field_names, *(field.lstrip("-") for field in self.ordering))
+        return queryset
+
+    def key(self, instance):
+        return json.dumps([getattr(instance, field.lstrip("-")) for field in self.ordering], cls=DjangoJSONEncoder)
+
+    def after(self, model, ordering, position):
+        """
+        Условие "строка после позиции курсора". При одном направлении сортировки - сравнение строк,
+        которое Postgres выполняет по составному индексу; при разных направлениях - развернутое условие.
+        """
+        try:
+            values = json.loads(position)
+            names = [field.lstrip("-") for field in ordering]
+            if not isinstance(values, list) or len(values) != len(names):
+                raise ValueError
+            values = [model._meta.get_field(name).to_python(value) for name, value in zip(names, values)]
+        except (ValueError, TypeError, DjangoValidationError, FieldDoesNotExist):
+            raise NotFound(self.invalid_cursor_message)
+
+        descending = [field.startswith("-") for field in ordering]
+        if len(set(descending)) == 1:
+            if len(names) == 1:
+                return Q(**{f"{names[0]}__{'lt' if descending[0] else 'gt'}": values[0]})
+            lookup = LessThan if descending[0] else GreaterThan
+            row = Func(*(F(name) for name in names), function="ROW", output_field=Field())
+            position_row = Func(*(Value(value) for value in values), function="ROW", output_field=Field())
+            return Q(lookup(row, position_row))
+
+        condition = Q()
+        for index in reversed(range(len(names))):
+            op = "lt" if descending[index] else "gt"
+            step = Q(**{f"{names[index]}__{op}": values[index]})
+            condition = step | (Q(**{names[index]: values[index]}) & condition) if condition else step
+        return condition
+
+
+class PaymentCursorPaginator(CustomCursorPaginator):
+    """
+    Keyset-пагинация платежей по (date, id). Сортировку может переопределить OrderingFilter представления.
+    """
+
+    ordering = ("-date", "-id")
+
+
+class PaymentRollupCursorPaginator(CustomCursorPaginator):
+    """
+    Keyset-пагинация дневных сводок выручки по (day, id) от новых дней к старым: за один день строк
+    может быть сколько угодно. Строки сводок небольшие, поэтому дашборд может забирать их крупными страницами.
+    """
+
+    page_size = 100
+    max_page_size = 1000
+    ordering = ("-day", "-id")
@@ -0,0 +1,117 @@
+"""
+Похожие курсы по совместным подпискам ("на этот курс подписаны и на..."): косинусная близость столбцов
+разреженной матрицы пользователь x курс. Все вычисления векторные (numpy/scipy), по блокам строк,
+поэтому модуль рассчитан на миллионы подписок. Импортируется только задачей Celery.
+"""
+
+import io
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from scipy import sparse
+
+from lms.models import Course, SimilarCourse
+from users.models import SubscriptionForCourse
+
+INSERT_CHUNK_SIZE = 100_000
+
+
+def load_subscriptions():
+    """Пары (пользователь, курс) всех подписок массивом формы (n, 2). Выгружаются COPY, без построчной обработки в Python"""
+    buffer = io.StringIO()
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY (SELECT owner_id, course_id FROM {SubscriptionForCourse._meta.db_table} WHERE course_id IS NOT NULL) "
+            "TO STDOUT WITH (FORMAT csv)",
+            buffer,
+        )
+    if not buffer.tell():
+        return np.empty((0, 2), dtype=np.int64)
+    buffer.seek(0)
+    return np.loadtxt(buffer, delimiter=",", dtype=np.int64, ndmin=2)
+
+
+def course_matrix(pairs):
+    """
+    Матрица курс x пользователь с единичными по норме строками и id курсов, соответствующих ее строкам.
+    Произведение двух строк такой матрицы - косинусная близость курсов.
+    """
+    course_ids, rows = np.unique(pairs[:, 1], return_inverse=True)
+    _, columns = np.unique(pairs[:, 0], return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(pairs), dtype=np.float32), (rows, columns)), shape=(len(course_ids), columns.max() + 1)
+    )
+    # Пара (пользователь, курс) уникальна, поэтому сумма строки - число подписчиков курса
+    norms = np.sqrt(np.asarray(matrix.sum(axis=1), dtype=np.float32).ravel())
+    return course_ids, (sparse.diags(1 / norms) @ matrix).tocsr()
+
+
+def top_similar(matrix, top_k, block_size):
+    """
+    Для каждой строки matrix - до top_k других строк с наибольшей положительной близостью.
+    Близости считаются блоками строк так, чтобы плотный блок не превышал block_size элементов.
+    Возвращает массивы (строка, похожая строка, близость), внутри строки - по убыванию близости.
+    """
+    n = matrix.shape[0]
+    k = min(top_k, n - 1)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    transposed = matrix.T.tocsc()
+    batch_size = max(1, block_size // n)
+    rows, similar, scores = [], [], []
+    for start in range(0, n, batch_size):
+        block = (matrix[start : start + batch_size] @ transposed).toarray()
+        local = np.arange(block.shape[0])
+        block[local, start + local] = 0  # Курс не считается похожим на самого себя
+        nearest = np.argpartition(block, -k, axis=1)[:, -k:]
+        nearest_scores = np.take_along_axis(block, nearest, axis=1)
+        order = np.argsort(-nearest_scores, axis=1)
+        nearest = np.take_along_axis(nearest, order, axis=1)
+        nearest_scores = np.take_along_axis(nearest_scores, order, axis=1)
+        keep = nearest_scores > 0  # Курсы без общих подписчиков не похожи
+        rows.append(np.repeat(start + local, k)[keep.ravel()])
+        similar.append(nearest[keep])
+        scores.append(nearest_scores[keep])
+    return np.concatenate(rows), np.concatenate(similar), np.concatenate(scores)
+
+
+def save_similar(course_ids, similar_ids, scores):
+    """
+    Заменяет таблицу похожих курсов одной транзакцией. Строки вставляются пачками через unnest;
+    пары с курсами, удаленными во время расчета, отбрасываются соединением с таблицей курсов.
+    """
+    similar_table = SimilarCourse._meta.db_table
+    course_table = Course._meta.db_table
+    saved = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {similar_table}")
+        for start in range(0, len(course_ids), INSERT_CHUNK_SIZE):
+            chunk = slice(start, start + INSERT_CHUNK_SIZE)
+            cursor.execute(
+                f"""
+                INSERT INTO {similar_table} (course_id, similar_course_id, score)
+                SELECT pair.course_id, pair.similar_course_id, pair.score
+                FROM unnest(%s::bigint[], %s::bigint[], %s::double precision[])
+                    AS pair(course_id, similar_course_id, score)
+                JOIN {course_table} AS source ON source.id = pair.course_id
+                JOIN {course_table} AS target ON target.id = pair.similar_course_id
+                """,
+                [course_ids[chunk].tolist(), similar_ids[chunk].tolist(), scores[chunk].tolist()],
+            )
+            saved += cursor.rowcount
+    return saved
+
+
+def compute_similar_courses(top_k=None):
+    """Пересчитывает похожие курсы по текущим подпискам. Возвращает число сохраненных пар"""
+    top_k = top_k or settings.SIMILAR_COURSES_TOP_K
+    pairs = load_subscriptions()
+    if not len(pairs):
+        empty = np.empty(0)
+        return save_similar(empty, empty, empty)
+
+    course_ids, matrix = course_matrix(pairs)
+    rows, similar, scores = top_similar(matrix, top_k, settings.SIMILAR_COURSES_BLOCK_SIZE)
+    return save_similar(course_ids[rows], course_ids[similar], scores)
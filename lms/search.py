@@ -0,0 +1,34 @@
+"""
+Полнотекстовый поиск Postgres по курсам и урокам: хранимый столбец search_vector с GIN-индексом,
+ранжирование ts_rank и префиксное совпадение слов запроса.
+"""
+
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import F
+
+from .models import SEARCH_CONFIG
+
+
+def search_words(text):
+    """Слова запроса без знаков препинания и операторов tsquery"""
+    return re.findall(r"\w+", text.lower())
+
+
+def prefix_query(words):
+    """Запрос, в котором каждое слово может быть началом слова документа: 'прог пит' -> 'прог:* & пит:*'"""
+    return SearchQuery(" & ".join(f"{word}:*" for word in words), search_type="raw", config=SEARCH_CONFIG)
+
+
+def search(queryset, text):
+    """
+    Записи queryset, содержащие все слова text (как префиксы), с аннотацией rank, по убыванию релевантности.
+    Поиск идет по индексу search_vector; название весит больше описания.
+    """
+    words = search_words(text)
+    if not words:
+        return queryset.none()
+
+    query = prefix_query(words)
+    return queryset.filter(search_vector=query).annotate(rank=SearchRank(F("search_vector"), query)).order_by("-rank", "id")
@@ -6,10 +6,49 @@ from .models import Course, Lesson
 from .validators import VideoUrlValidator
 
 
-class LessonSerializer(serializers.ModelSerializer):
+class DynamicFieldsMixin:
+    """
+    Управляет набором полей сериализатора:
+    fields - оставить только перечисленные (id остается всегда), omit - исключить перечисленные,
+    expand - включить поля из expandable_fields, которые по умолчанию не выводятся.
+    """
+
+    expandable_fields = ()
+
+    def __init__(self, *args, fields=None, omit=None, expand=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        expand = set(expand or ())
+        for name in set(self.expandable_fields) - expand:
+            self.fields.pop(name, None)
+        if fields:
+            for name in set(self.fields) - set(fields) - {"id"}:
+                self.fields.pop(name)
+        for name in omit or ():
+            if name != "id":
+                self.fields.pop(name, None)
+
+
+class LessonSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Lesson
+        exclude = ("stripe_product_id", "search_vector")  # Служебные поля (кеш Stripe, поисковый вектор), не часть API
+
+        validators = [
+            VideoUrlValidator(field="video_url"),
+        ]
+
+
+class LessonBulkItemSerializer(serializers.ModelSerializer):
+    """
+    Элемент массового импорта уроков: с id - обновление существующего урока курса, без id - создание.
+    Курс и владелец задаются один раз для всего импорта.
+    """
+
+    id = serializers.IntegerField(required=False, min_value=1)
+
     class Meta:
         model = Lesson
-        fields = "__all__"
+        fields = ("id", "title", "description", "video_url")
 
         validators = [
             VideoUrlValidator(field="video_url"),
@@ -22,23 +61,32 @@ class LessonDetailSerializer(serializers.ModelSerializer):
         fields = ("title", "description")
 
 
-class CourseSerializer(serializers.ModelSerializer):
+class CourseSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     lessons = LessonSerializer(many=True, read_only=True)
-    lessons_count = serializers.SerializerMethodField()
     subscriptions = serializers.SerializerMethodField()
 
+    expandable_fields = ("lessons",)  # Уроки встраиваются только по ?expand=lessons
+
     class Meta:
         model = Course
-        fields = "__all__"
-
-    def get_lessons_count(self, obj):
-        return obj.lessons.count()
-
-    def get_count_subscriptions(self, obj):
-        return f"Подписок: {obj.subscriptions.count()}"
+        exclude = ("stripe_product_id", "search_vector")  # Служебные поля (кеш Stripe, поисковый вектор), не часть API
+        read_only_fields = ("lessons_count", "subscribers_count")  # Денормализованные счетчики
 
     def get_subscriptions(self, obj):
-        user = self.context["request"].user
-        if SubscriptionForCourse.objects.filter(owner=user, course=obj).exists():
+        if hasattr(obj, "is_subscribed"):
+            is_subscribed = obj.is_subscribed
+        else:
+            user = self.context["request"].user
+            is_subscribed = SubscriptionForCourse.objects.filter(owner=user, course=obj).exists()
+        return self.subscription_message(is_subscribed)
+
+    @staticmethod
+    def subscription_message(is_subscribed):
+        if is_subscribed:
             return "У вас есть подписка на данный курс."
         return "У вас нет подписки на данный курс"
+
+
+class BulkSubscriptionSerializer(serializers.Serializer):
+    course_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=100)
+    action = serializers.ChoiceField(choices=["subscribe", "unsubscribe"])
@@ -0,0 +1,192 @@
+import hashlib
+import logging
+import time
+
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from users.models import SubscriptionForCourse
+
+from .models import OutboxMessage
+from .serializers import CourseSerializer
+from .tasks import send_course_update_mail
+
+logger = logging.getLogger(__name__)
+
+COURSES_VERSION_KEY = "lms:courses:version"
+LESSONS_VERSION_KEY = "lms:lessons:version"
+
+
+def _course_version_key(course_id):
+    return f"lms:course:{course_id}:version"
+
+
+def _lesson_version_key(lesson_id):
+    return f"lms:lesson:{lesson_id}:version"
+
+
+def _subscriptions_version_key(user_id):
+    return f"lms:subscriptions:{user_id}:version"
+
+
+def _get_version(version_key):
+    """
+    Возвращает текущую версию группы записей кеша. Версия - метка времени, поэтому после вытеснения
+    ключа из Redis новая версия не совпадет ни с одной из старых. None - Redis недоступен, кеш не используется.
+    """
+    try:
+        version = cache.get(version_key)
+        if version is None:
+            cache.add(version_key, time.time_ns(), None)
+            version = cache.get(version_key)
+    except redis.RedisError as exc:
+        logger.warning(f"Ответ не кешируется: Redis недоступен ({exc})")
+        return None
+    return version
+
+
+def _bump_versions(*version_keys):
+    """
+    Инвалидирует группы записей после коммита транзакции: старые ключи больше не читаются и истекают по TTL.
+    """
+
+    def bump():
+        try:
+            cache.set_many({key: time.time_ns() for key in version_keys}, None)
+        except redis.RedisError as exc:
+            # Записи старых версий истекут сами не позже чем через CACHE_TIMEOUT
+            logger.warning(f"Кеш не инвалидирован: Redis недоступен ({exc})")
+
+    transaction.on_commit(bump)
+
+
+def _response_key(prefix, version, request):
+    if version is None:
+        return None
+    # Ключ учитывает весь URL: курсор, page_size и другие параметры запроса
+    digest = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+    return f"{prefix}:{version}:{digest}"
+
+
+def course_list_cache_key(request):
+    return _response_key("lms:courses", _get_version(COURSES_VERSION_KEY), request)
+
+
+def course_detail_cache_key(course_id, request):
+    return _response_key(f"lms:course:{course_id}", _get_version(_course_version_key(course_id)), request)
+
+
+def lesson_list_cache_key(request):
+    return _response_key("lms:lessons", _get_version(LESSONS_VERSION_KEY), request)
+
+
+def lesson_detail_cache_key(lesson_id, request):
+    return _response_key(f"lms:lesson:{lesson_id}", _get_version(_lesson_version_key(lesson_id)), request)
+
+
+def set_cached_response(cache_key, owner_id, data):
+    """
+    Сохраняет общую для всех пользователей часть ответа вместе с владельцем объекта (для проверки прав).
+    """
+    if cache_key is None:
+        return
+    try:
+        cache.set(cache_key, (owner_id, data), settings.CACHE_TIMEOUT)
+    except redis.RedisError as exc:
+        logger.warning(f"Ответ не закеширован: Redis недоступен ({exc})")
+
+
+def get_cached_response(cache_key):
+    """
+    Возвращает (owner_id, data) или None, если записи в кеше нет или кеш недоступен.
+    """
+    if cache_key is None:
+        return None
+    try:
+        return cache.get(cache_key)
+    except redis.RedisError as exc:
+        logger.warning(f"Ответ читается из БД: Redis недоступен ({exc})")
+        return None
+
+
+def _load_subscribed_course_ids(user_id):
+    return set(SubscriptionForCourse.objects.filter(owner=user_id).values_list("course_id", flat=True))
+
+
+def get_subscribed_course_ids(user):
+    """
+    Множество id курсов, на которые подписан пользователь. Кешируется до переключения подписки.
+    Версия читается до запроса к БД: множество, прочитанное до коммита переключения, сохранится
+    под старой версией и больше не будет прочитано.
+    """
+    version = _get_version(_subscriptions_version_key(user.pk))
+    if version is None:
+        return _load_subscribed_course_ids(user.pk)
+
+    key = f"lms:subscriptions:{user.pk}:{version}"
+    try:
+        course_ids = cache.get(key)
+        if course_ids is None:
+            course_ids = _load_subscribed_course_ids(user.pk)
+            cache.set(key, course_ids, settings.CACHE_TIMEOUT)
+    except redis.RedisError as exc:
+        logger.warning(f"Подписки читаются из БД: Redis недоступен ({exc})")
+        course_ids = _load_subscribed_course_ids(user.pk)
+    return course_ids
+
+
+def without_subscriptions(items):
+    """
+    Копия сериализованных курсов без персональных данных о подписке.
+    """
+    return [{**item, "subscriptions": None} if "subscriptions" in item else dict(item) for item in items]
+
+
+def with_subscriptions(items, user):
+    """
+    Накладывает состояние подписки текущего пользователя на закешированные курсы.
+    """
+    if not any("subscriptions" in item for item in items):
+        return items
+    subscribed = get_subscribed_course_ids(user)
+    for item in items:
+        if "subscriptions" in item:
+            item["subscriptions"] = CourseSerializer.subscription_message(item["id"] in subscribed)
+    return items
+
+
+def invalidate_course(course_id):
+    invalidate_courses([course_id])
+
+
+def invalidate_courses(course_ids):
+    _bump_versions(COURSES_VERSION_KEY, *(_course_version_key(course_id) for course_id in course_ids))
+
+
+def invalidate_lessons(lesson_ids, course_ids):
+    """
+    Изменение уроков затрагивает сами уроки, их список, а также курсы, в которые уроки вложены.
+    """
+    _bump_versions(
+        LESSONS_VERSION_KEY,
+        COURSES_VERSION_KEY,
+        *(_lesson_version_key(lesson_id) for lesson_id in lesson_ids),
+        *(_course_version_key(course_id) for course_id in course_ids),
+    )
+
+
+def invalidate_subscriptions(user_id):
+    _bump_versions(_subscriptions_version_key(user_id))
+
+
+def schedule_course_update_mail(course_id):
+    """
+    Ставит рассылку об обновлении курса в outbox в текущей транзакции. Первое обновление в окне
+    COURSE_UPDATE_MAIL_DEBOUNCE откладывает рассылку до конца окна, последующие обновления схлопываются в нее,
+    пока ретранслятор не опубликует задачу.
+    """
+    window = settings.COURSE_UPDATE_MAIL_DEBOUNCE
+    dedup_key = f"course_update:{course_id}" if window > 0 else None
+    OutboxMessage.enqueue(send_course_update_mail.name, args=[course_id], delay=window, dedup_key=dedup_key)
@@ -0,0 +1,35 @@
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from lms.models import Course, Lesson
+
+
+def change_lessons_count(course_id, delta):
+    # Не уходим ниже нуля, даже если счетчик разошелся с фактом (его чинит recount_course_counters)
+    Course.objects.filter(pk=course_id).update(lessons_count=Greatest(F("lessons_count") + delta, 0))
+
+
+@receiver(post_init, sender=Lesson)
+def remember_lesson_course(sender, instance, **kwargs):
+    # Через __dict__, чтобы не загружать отложенное (only/defer) поле отдельным запросом
+    instance._counted_course_id = instance.__dict__.get("course_id")
+
+
+@receiver(post_save, sender=Lesson)
+def count_saved_lesson(sender, instance, created, **kwargs):
+    """
+    Новый урок увеличивает счетчик курса, перенос урока в другой курс переносит и единицу счетчика.
+    """
+    if created:
+        change_lessons_count(instance.course_id, 1)
+    elif instance._counted_course_id not in (None, instance.course_id):
+        change_lessons_count(instance._counted_course_id, -1)
+        change_lessons_count(instance.course_id, 1)
+    instance._counted_course_id = instance.course_id
+
+
+@receiver(post_delete, sender=Lesson)
+def count_deleted_lesson(sender, instance, **kwargs):
+    change_lessons_count(instance.course_id, -1)
@@ -1,55 +1,274 @@
 import logging
 import os
-from datetime import timedelta, timezone
+import time
+from datetime import timedelta
+from itertools import islice
+from smtplib import SMTPException
 
+import stripe
 from celery import shared_task
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.exceptions import ObjectDoesNotExist
-from django.core.mail import send_mail
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
 
-from lms.models import Course
-from users.models import CustomUser, SubscriptionForCourse
+from lms import leaderboard
+from lms.models import Course, OutboxMessage
+from users.authentication import revoke_users
+from users.models import CustomUser, Payment, PaymentDailyRollup, SubscriptionForCourse
 
 logger = logging.getLogger(__name__)
 
+DEACTIVATE_CHECKPOINT_KEY = "lms:deactivate_inactive_users:checkpoint"
+RECONCILE_METRICS_KEY = "lms:reconcile_pending_payments:metrics"
+
 
 @shared_task
 def send_course_update_mail(course_id):
     """
     Асинхронная рассылка. При обновлении курса, подписчикам курса приходит уведомление об изменении на почту.
+    Адреса читаются потоком одним запросом и делятся на пачки, каждая пачка отправляется отдельной задачей.
     """
-    try:
-        course = Course.objects.get(id=course_id)
-    except ObjectDoesNotExist:
+    if not Course.objects.filter(id=course_id).exists():
         logger.error(f"Курс с ID {course_id} не найден!")
         return
 
-    # Получаем всех подписчиков на курс.
-    subscriptions = SubscriptionForCourse.objects.filter(course_id=course_id)
+    chunk_size = settings.COURSE_UPDATE_MAIL_CHUNK_SIZE
+    emails = (
+        SubscriptionForCourse.objects.filter(course_id=course_id)
+        .values_list("owner__email", flat=True)
+        .iterator(chunk_size=chunk_size)
+    )
 
-    # Формируем список email адресов подписчиков
-    recipient_email = [subscribers.owner.email for subscribers in subscriptions]
+    chunks = 0
+    while chunk := list(islice(emails, chunk_size)):
+        send_course_update_mail_chunk.delay(course_id, chunk)
+        chunks += 1
+    return chunks
 
-    # Отправляем письмо всем подписчикам
-    send_mail(
-        subject="Курс обновлен!",
-        message=f"Курс с ID {course_id} был обновлен. Проверьте его обновления!",
-        from_email=os.getenv("EMAIL_HOST_USER"),
-        recipient_list=recipient_email,
-    )
+
+@shared_task(autoretry_for=(SMTPException, OSError), retry_backoff=True, max_retries=5)
+def send_course_update_mail_chunk(course_id, emails):
+    """
+    Отправляет пачке подписчиков отдельные письма через одно SMTP-соединение.
+    При ошибке SMTP повторяется только эта пачка.
+    """
+    messages = [
+        EmailMessage(
+            subject="Курс обновлен!",
+            body=f"Курс с ID {course_id} был обновлен. Проверьте его обновления!",
+            from_email=os.getenv("EMAIL_HOST_USER"),
+            to=[email],
+        )
+        for email in emails
+    ]
+    with get_connection() as connection:
+        return connection.send_messages(messages)
+
+
+@shared_task(bind=True)
+def relay_outbox(self, batch_size=None):
+    """
+    Публикует накопившиеся сообщения outbox в брокер пачками.
+    SELECT ... FOR UPDATE SKIP LOCKED позволяет запускать несколько ретрансляторов параллельно.
+    """
+    batch_size = batch_size or settings.OUTBOX_RELAY_BATCH_SIZE
+    published = 0
+    while True:
+        with transaction.atomic():
+            messages = list(
+                OutboxMessage.objects.select_for_update(skip_locked=True)
+                .filter(available_at__lte=timezone.now())
+                .order_by("available_at", "id")[:batch_size]
+            )
+            if not messages:
+                break
+            # Одно соединение с брокером на всю пачку
+            with self.app.producer_or_acquire() as producer:
+                for message in messages:
+                    self.app.send_task(message.task_name, args=message.args, kwargs=message.kwargs, producer=producer)
+            OutboxMessage.objects.filter(id__in=[message.id for message in messages]).delete()
+        published += len(messages)
+        if len(messages) < batch_size:
+            break
+    return published
 
 
 @shared_task
-def deactivate_inactive_users():
+def deactivate_inactive_users(dry_run=False, batch_size=None, pause=None):
     """
-    Задача для деактивации пользователей, которые не заходили более месяца
+    Задача для деактивации пользователей, которые не заходили более месяца.
+    Пользователи выбираются keyset-пачками по индексу (last_login, id), каждая пачка обновляется отдельным
+    коротким UPDATE, между пачками выдерживается пауза. Прогресс сохраняется в кеше, поэтому прерванный
+    запуск продолжается с места остановки. В режиме dry_run ничего не меняется, возвращается отчет.
     """
-    # Вычисляем дату, которая была месяц назад
-    one_month_ago = timezone.now() - timedelta(days=30)
+    batch_size = batch_size or settings.DEACTIVATE_USERS_BATCH_SIZE
+    pause = settings.DEACTIVATE_USERS_BATCH_PAUSE if pause is None else pause
+
+    checkpoint = None if dry_run else cache.get(DEACTIVATE_CHECKPOINT_KEY)
+    if checkpoint:
+        logger.info(f"Продолжаем деактивацию с пользователя ID {checkpoint['id']}")
+        one_month_ago = checkpoint["cutoff"]
+    else:
+        # Вычисляем дату, которая была месяц назад
+        one_month_ago = timezone.now() - timedelta(days=30)
 
     # Находим пользователей, которые не заходили более месяца и еще активны.
-    inactive_users = CustomUser.objects.filter(last_login__it=one_month_ago, is_active=True)
+    inactive_users = CustomUser.objects.filter(last_login__lt=one_month_ago, is_active=True).order_by("last_login", "id")
+
+    count = 0
+    while True:
+        queryset = inactive_users
+        if checkpoint:
+            queryset = queryset.filter(
+                Q(last_login__gt=checkpoint["last_login"]) | Q(last_login=checkpoint["last_login"], id__gt=checkpoint["id"])
+            )
+        batch = list(queryset.values_list("id", "last_login")[:batch_size])
+        if not batch:
+            break
 
-    count = inactive_users.update(is_active=False)
+        if dry_run:
+            count += len(batch)
+        else:
+            # Условие выборки повторяется в UPDATE: пользователь мог войти после SELECT пачки.
+            # RETURNING отдает только действительно деактивированных - доступ отзывается только у них
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    UPDATE {CustomUser._meta.db_table} SET is_active = FALSE
+                    WHERE id = ANY(%s) AND is_active AND last_login < %s
+                    RETURNING id
+                    """,
+                    [[user_id for user_id, _ in batch], one_month_ago],
+                )
+                user_ids = [row[0] for row in cursor.fetchall()]
+            count += len(user_ids)
+            # update() не вызывает сигналы, поэтому доступ по выданным токенам отзываем явно
+            revoke_users(user_ids)
 
+        last_id, last_login = batch[-1]
+        checkpoint = {"cutoff": one_month_ago, "last_login": last_login, "id": last_id}
+        if not dry_run:
+            cache.set(DEACTIVATE_CHECKPOINT_KEY, checkpoint, settings.DEACTIVATE_USERS_CHECKPOINT_TIMEOUT)
+        if len(batch) < batch_size:
+            break
+        time.sleep(pause)
+
+    if dry_run:
+        return f"Будет деактивировано {count} неактивных пользователей"
+
+    cache.delete(DEACTIVATE_CHECKPOINT_KEY)
     return f"Деактивировано {count} неактивных пользователей"
+
+
+@shared_task
+def rebuild_payment_rollups(days=None):
+    """
+    Пересборка дневных сводок выручки из платежей: за последние days дней или полностью, если days не указан.
+    Используется для первичного заполнения и для исправления расхождений.
+    """
+    since = timezone.localdate() - timedelta(days=days) if days is not None else None
+    rows = PaymentDailyRollup.rebuild(since=since)
+    return f"Пересобрано {rows} строк сводки выручки"
+
+
+@shared_task
+def rebuild_leaderboards():
+    """
+    Пересборка рейтингов популярных курсов в Redis по Postgres.
+    Исправляет расхождения после сбоев Redis и удалений в обход модели.
+    """
+    leaderboard.rebuild()
+    return "Рейтинги популярных курсов пересобраны"
+
+
+@shared_task
+def compute_similar_courses():
+    """
+    Пересчет похожих курсов по совместным подпискам (см. lms.recommendations).
+    """
+    from lms import recommendations  # numpy и scipy загружаются только воркером, выполняющим задачу
+
+    pairs = recommendations.compute_similar_courses()
+    return f"Сохранено {pairs} пар похожих курсов"
+
+
+@shared_task
+def process_checkout_session(session_id):
+    """
+    Обработка оплаченной сессии Stripe из вебхука: отмечает платеж оплаченным и обновляет сводку выручки.
+    Повторная обработка той же сессии ничего не меняет.
+    """
+    payment = Payment.objects.filter(session_id=session_id).first()
+    if payment is None:
+        logger.warning(f"Платеж для сессии Stripe {session_id} не найден")
+        return
+    payment.mark_paid()
+
+
+@shared_task
+def reconcile_pending_payments(lookback_days=None, batch_size=None):
+    """
+    Сверка неоплаченных платежей со Stripe для пользователей, не вернувшихся на страницу успеха (и пропущенных вебхуков).
+    Оплаченные сессии за период забираются постраничным списком Stripe, а не запросом на каждый платеж,
+    затем неоплаченные платежи перебираются keyset-пачками по id и отмечаются одной транзакцией на пачку.
+    Итоги запуска сохраняются в кеше по ключу RECONCILE_METRICS_KEY.
+    """
+    lookback_days = settings.PAYMENT_RECONCILE_LOOKBACK_DAYS if lookback_days is None else lookback_days
+    batch_size = batch_size or settings.PAYMENT_RECONCILE_BATCH_SIZE
+    started = time.monotonic()
+    since = timezone.now() - timedelta(days=lookback_days)
+
+    sessions = stripe.checkout.Session.list(created={"gte": int(since.timestamp())}, status="complete", limit=100)
+    paid_sessions = {session.id for session in sessions.auto_paging_iter() if session.payment_status == "paid"}
+
+    pending = Payment.objects.filter(is_paid=False, session_id__isnull=False, date__gte=since).order_by("id")
+    checked = marked = 0
+    last_id = 0
+    while True:
+        batch = list(pending.filter(id__gt=last_id).values_list("id", "session_id")[:batch_size])
+        if not batch:
+            break
+        checked += len(batch)
+        paid_ids = [payment_id for payment_id, session_id in batch if session_id in paid_sessions]
+        if paid_ids:
+            marked += Payment.mark_paid_many(paid_ids)
+        last_id = batch[-1][0]
+        if len(batch) < batch_size:
+            break
+
+    metrics = {
+        "finished_at": timezone.now(),
+        "duration": round(time.monotonic() - started, 3),
+        "stripe_paid_sessions": len(paid_sessions),
+        "checked": checked,
+        "marked_paid": marked,
+    }
+    cache.set(RECONCILE_METRICS_KEY, metrics, None)
+    logger.info(f"Сверка платежей: проверено {checked}, отмечено оплаченными {marked}")
+    return metrics
+
+
+@shared_task(bind=True, max_retries=5)
+def create_checkout_session(self, payment_id, success_url, cancel_url):
+    """
+    Создание сессии оплаты Stripe вне запроса. Временные ошибки Stripe повторяются с нарастающей паузой,
+    прочие ошибки сохраняются в платеже, клиент узнает результат через эндпоинт статуса.
+    """
+    payment = Payment.objects.select_related("course", "lesson", "user").filter(id=payment_id).first()
+    if payment is None or payment.checkout_status != "pending":
+        return
+
+    try:
+        payment.create_stripe_payment(success_url, cancel_url)
+    except (stripe.error.APIConnectionError, stripe.error.RateLimitError) as exc:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=exc, countdown=2**self.request.retries)
+        payment.checkout_status, payment.checkout_error = "failed", "Платежный сервис недоступен, попробуйте позже"
+        payment.save(update_fields=["checkout_status", "checkout_error"])
+    except ValueError as exc:
+        payment.checkout_status, payment.checkout_error = "failed", str(exc)
+        payment.save(update_fields=["checkout_status", "checkout_error"])
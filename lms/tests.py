@@ -1,16 +1,45 @@
+import json
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+import redis
 from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
-from rest_framework.test import APIClient, APITestCase
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
 
-from lms.models import Course, Lesson
-from users.models import SubscriptionForCourse
+from config import redis_client
+from config.celery import app as celery_app
+from lms import leaderboard, services
+from lms.models import Course, Lesson, OutboxMessage, SimilarCourse
+from lms.services import schedule_course_update_mail
+from lms.tasks import (
+    DEACTIVATE_CHECKPOINT_KEY,
+    compute_similar_courses,
+    deactivate_inactive_users,
+    relay_outbox,
+    send_course_update_mail,
+)
+from users.authentication import revoked_cache_key
+from users.models import Payment, SubscriptionForCourse
 
 User = get_user_model()
 
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
 
+@override_settings(CACHES=LOCMEM_CACHES)
 class LessonCRUDTests(APITestCase):
     def setUp(self):
+        cache.clear()
         # Создаём тестового пользователя (владельца)
         self.owner = User.objects.create_user(email="owner@example.com", password="testpassword", username="owner")
         self.owner_client = APIClient()
@@ -119,8 +148,100 @@ class LessonCRUDTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
 
+@override_settings(CACHES=LOCMEM_CACHES)
+class LessonBulkImportTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user(email="owner@example.com", password="testpassword", username="owner")
+        self.other = User.objects.create_user(email="other@example.com", password="testpassword", username="other")
+        self.course = Course.objects.create(title="Курс", description="Описание", owner=self.owner)
+        self.other_course = Course.objects.create(title="Чужой курс", description="Описание", owner=self.other)
+        self.lesson = Lesson.objects.create(title="Урок", description="Описание", course=self.course, owner=self.owner)
+        self.url = reverse("lms:courses-bulk-lessons", args=[self.course.id])
+        self.client.force_authenticate(user=self.owner)
+
+    def lessons_payload(self, count):
+        return [
+            {"title": f"Урок {i}", "description": "Описание", "video_url": "https://youtube.com/video"} for i in range(count)
+        ]
+
+    def test_bulk_create_and_update(self):
+        """
+        Новые уроки создаются, уроки с id обновляются, все в одном запросе.
+        """
+        data = self.lessons_payload(3) + [
+            {
+                "id": self.lesson.id,
+                "title": "Обновленный урок",
+                "description": "Новое",
+                "video_url": "https://youtube.com/video",
+            }
+        ]
+        response = self.client.post(self.url, data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data["created"]), 3)
+        self.assertEqual(response.data["updated"], [self.lesson.id])
+        self.assertEqual(Lesson.objects.filter(course=self.course, owner=self.owner).count(), 4)
+        self.lesson.refresh_from_db()
+        self.assertEqual(self.lesson.title, "Обновленный урок")
+
+    def test_bulk_query_count_does_not_grow(self):
+        """
+        Число запросов массового импорта не зависит от количества уроков, в отличие от поштучного создания.
+        """
+        with CaptureQueriesContext(connection) as single:
+            for item in self.lessons_payload(10):
+                self.client.post(reverse("lms:lesson-create"), {**item, "course": self.course.id}, format="json")
+        with CaptureQueriesContext(connection) as small:
+            self.client.post(self.url, self.lessons_payload(10), format="json")
+        with CaptureQueriesContext(connection) as large:
+            self.client.post(self.url, self.lessons_payload(100), format="json")
+        self.assertEqual(len(small), len(large))
+        self.assertLess(len(small) * 5, len(single))
+
+    def test_bulk_per_item_errors(self):
+        """
+        Ошибки возвращаются по каждому элементу, ничего не сохраняется.
+        """
+        foreign = Lesson.objects.create(title="Чужой", description="", course=self.other_course, owner=self.other)
+        data = [
+            {"title": "Хороший урок", "description": "Описание", "video_url": "https://youtube.com/video"},
+            {"title": "Плохая ссылка", "description": "Описание", "video_url": "https://example.com/video"},
+            {"id": foreign.id, "title": "Чужой урок", "description": "Описание", "video_url": "https://youtube.com/video"},
+        ]
+        response = self.client.post(self.url, data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data[0], {})
+        self.assertIn("non_field_errors", response.data[1])
+
+        response = self.client.post(self.url, [data[0], data[2]], format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("id", response.data[1])
+        self.assertEqual(Lesson.objects.filter(course=self.course).count(), 1)
+
+    def test_bulk_by_non_owner_forbidden(self):
+        """
+        Импортировать уроки может только владелец курса.
+        """
+        self.client.force_authenticate(user=self.other)
+        response = self.client.post(self.url, self.lessons_payload(2), format="json")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(Lesson.objects.filter(course=self.course).count(), 1)
+
+    def test_bulk_ndjson(self):
+        """
+        Уроки принимаются потоком NDJSON.
+        """
+        body = "\n".join(json.dumps(item) for item in self.lessons_payload(5))
+        response = self.client.post(self.url, body, content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data["created"]), 5)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
 class SubscriptionTests(APITestCase):
     def setUp(self):
+        cache.clear()
         # Создаём тестового пользователя
         self.user = User.objects.create_user(email="testuser@example.com", password="testpassword", username="testuser")
         self.client = APIClient()
@@ -163,3 +284,966 @@ class SubscriptionTests(APITestCase):
         response = self.client.post(url, data, format="json")
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
         self.assertEqual(response.data["error"], "Course does not find.")
+
+    def test_toggle_is_single_query(self):
+        """
+        Переключение подписки выполняется одним запросом в обе стороны.
+        """
+        url = reverse("lms:subscriptions")
+        with self.assertNumQueries(1):
+            response = self.client.post(url, {"course_id": self.course.id}, format="json")
+        self.assertEqual(response.data["message"], "Подписка добавлена")
+
+        with self.assertNumQueries(1):
+            response = self.client.post(url, {"course_id": self.course.id}, format="json")
+        self.assertEqual(response.data["message"], "Подписка удалена")
+        self.assertFalse(SubscriptionForCourse.objects.exists())
+
+    def test_duplicate_subscription_is_rejected(self):
+        """
+        Уникальное ограничение не допускает двух подписок на один курс.
+        """
+        SubscriptionForCourse.objects.create(owner=self.user, course=self.course)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            SubscriptionForCourse.objects.create(owner=self.user, course=self.course)
+
+    def test_bulk_subscribe_and_unsubscribe(self):
+        """
+        Массовая подписка пропускает несуществующие курсы и имеющиеся подписки.
+        """
+        other = Course.objects.create(title="Other Course", owner=self.user)
+        SubscriptionForCourse.objects.create(owner=self.user, course=self.course)
+        url = reverse("lms:subscriptions-bulk")
+
+        with self.assertNumQueries(1):
+            response = self.client.post(
+                url, {"course_ids": [self.course.id, other.id, 999], "action": "subscribe"}, format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["subscribed"], [other.id])
+        self.assertEqual(SubscriptionForCourse.objects.filter(owner=self.user).count(), 2)
+
+        response = self.client.post(url, {"course_ids": [self.course.id, other.id], "action": "unsubscribe"}, format="json")
+        self.assertEqual(sorted(response.data["unsubscribed"]), sorted([self.course.id, other.id]))
+        self.assertFalse(SubscriptionForCourse.objects.exists())
+
+    def test_bulk_requires_valid_payload(self):
+        """
+        Пустой список курсов и неизвестное действие отклоняются.
+        """
+        url = reverse("lms:subscriptions-bulk")
+        response = self.client.post(url, {"course_ids": [], "action": "subscribe"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(url, {"course_ids": [self.course.id], "action": "toggle"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CourseQueryTests(APITestCase):
+    """
+    Бюджет запросов к БД при промахе кеша.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email="reader@example.com", password="testpassword", username="reader")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def create_courses(self, count, lessons_per_course=3):
+        courses = []
+        for index in range(count):
+            course = Course.objects.create(title=f"Course {index}", owner=self.user)
+            for number in range(lessons_per_course):
+                Lesson.objects.create(
+                    title=f"Lesson {number}", description="Description", course=course, video_url="https://youtube.com/v"
+                )
+            courses.append(course)
+        return courses
+
+    def test_course_list_query_budget(self):
+        """
+        Список курсов выполняется фиксированным числом запросов: курсы с аннотациями и уроки.
+        """
+        courses = self.create_courses(5)
+        SubscriptionForCourse.objects.create(owner=self.user, course=courses[0])
+
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("lms:courses-list"), {"expand": "lessons"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        data = {item["id"]: item for item in response.data["results"]}
+        self.assertEqual(data[courses[0].id]["lessons_count"], 3)
+        self.assertEqual(len(data[courses[0].id]["lessons"]), 3)
+        self.assertEqual(data[courses[0].id]["subscriptions"], "У вас есть подписка на данный курс.")
+        self.assertEqual(data[courses[1].id]["subscriptions"], "У вас нет подписки на данный курс")
+
+    def test_course_list_queries_do_not_grow(self):
+        """
+        Количество запросов не зависит от числа курсов и уроков.
+        """
+        self.create_courses(1, lessons_per_course=1)
+        with self.assertNumQueries(2):
+            self.client.get(reverse("lms:courses-list"), {"expand": "lessons"})
+
+        self.create_courses(10, lessons_per_course=5)
+        cache.clear()
+        with self.assertNumQueries(2):
+            self.client.get(reverse("lms:courses-list"), {"expand": "lessons"})
+
+    def test_course_retrieve_query_budget(self):
+        """
+        Получение курса: курс с аннотациями и уроки, права проверяются без запросов.
+        """
+        course = self.create_courses(1, lessons_per_course=10)[0]
+
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("lms:courses-detail", args=[course.id]), {"expand": "lessons"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["lessons_count"], 10)
+        self.assertEqual(len(response.data["lessons"]), 10)
+
+    def test_course_list_cursor_pagination(self):
+        """
+        Курсы отдаются keyset-страницами по непрозрачному курсору, без COUNT(*).
+        """
+        courses = self.create_courses(3, lessons_per_course=0)
+        url = reverse("lms:courses-list")
+
+        response = self.client.get(url, {"page_size": 2})
+        self.assertNotIn("count", response.data)
+        self.assertEqual([item["id"] for item in response.data["results"]], [courses[0].id, courses[1].id])
+
+        with self.assertNumQueries(1):
+            response = self.client.get(response.data["next"])
+        self.assertEqual([item["id"] for item in response.data["results"]], [courses[2].id])
+        self.assertIsNone(response.data["next"])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SparseFieldsetTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email="mobile@example.com", password="testpassword", username="mobile")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.course = Course.objects.create(title="Sparse Course", description="Long description", owner=self.user)
+        self.lesson = Lesson.objects.create(
+            title="Sparse Lesson",
+            description="Long text",
+            course=self.course,
+            owner=self.user,
+            video_url="https://youtube.com/v",
+        )
+
+    def test_lessons_embedded_only_on_expand(self):
+        """
+        Уроки встраиваются в курс только по ?expand=lessons и без него не запрашиваются.
+        """
+        url = reverse("lms:courses-detail", args=[self.course.id])
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertNotIn("lessons", response.data)
+        self.assertEqual(response.data["lessons_count"], 1)
+
+        response = self.client.get(url, {"expand": "lessons"})
+        self.assertEqual([lesson["title"] for lesson in response.data["lessons"]], ["Sparse Lesson"])
+
+    def test_fields_limit_payload_and_columns(self):
+        """
+        ?fields= оставляет только перечисленные поля, лишние столбцы и аннотации не выбираются.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("lms:courses-list"), {"fields": "title"})
+        self.assertEqual(response.data["results"], [{"id": self.course.id, "title": "Sparse Course"}])
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn("description", queries[0]["sql"])
+        self.assertNotIn("EXISTS", queries[0]["sql"])
+
+    def test_omit_fields(self):
+        """
+        ?omit= исключает поля урока.
+        """
+        response = self.client.get(reverse("lms:lesson-get", args=[self.lesson.id]), {"omit": "description,preview"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("description", response.data)
+        self.assertNotIn("preview", response.data)
+        self.assertEqual(response.data["title"], "Sparse Lesson")
+
+    def test_lesson_list_fields(self):
+        """
+        Список уроков с ?fields= не выбирает описание.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("lms:lesson-list"), {"fields": "title,video_url"})
+        self.assertEqual(set(response.data["results"][0]), {"id", "title", "video_url"})
+        self.assertNotIn("description", queries[0]["sql"])
+
+    def test_write_ignores_fields(self):
+        """
+        Параметры выборки полей не влияют на валидацию при записи.
+        """
+        url = reverse("lms:courses-detail", args=[self.course.id]) + "?fields=title"
+        response = self.client.patch(url, {"description": "Short"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.course.refresh_from_db()
+        self.assertEqual(self.course.description, "Short")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CourseCounterTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user(email="owner@example.com", password="testpassword", username="owner")
+        self.client.force_authenticate(user=self.owner)
+        self.course = Course.objects.create(title="Курс", owner=self.owner)
+        self.other_course = Course.objects.create(title="Другой курс", owner=self.owner)
+
+    def counters(self, course):
+        course.refresh_from_db()
+        return course.lessons_count, course.subscribers_count
+
+    def test_lessons_count(self):
+        """
+        Счетчик уроков следует за созданием, переносом, удалением и массовым импортом уроков.
+        """
+        data = {"title": "Урок", "description": "Описание", "video_url": "https://youtube.com/video"}
+        with self.captureOnCommitCallbacks(execute=True):
+            lesson_id = self.client.post(reverse("lms:lesson-create"), {**data, "course": self.course.id}, format="json").data[
+                "id"
+            ]
+        self.assertEqual(self.counters(self.course), (1, 0))
+
+        lesson = Lesson.objects.get(pk=lesson_id)
+        lesson.course = self.other_course
+        lesson.save()
+        self.assertEqual((self.counters(self.course), self.counters(self.other_course)), ((0, 0), (1, 0)))
+
+        lesson.delete()
+        self.assertEqual(self.counters(self.other_course), (0, 0))
+
+        self.client.post(reverse("lms:courses-bulk-lessons", args=[self.course.id]), [data] * 3, format="json")
+        self.assertEqual(self.counters(self.course), (3, 0))
+
+    def test_subscribers_count(self):
+        """
+        Счетчик подписчиков следует за переключением, массовой подпиской и изменениями через ORM.
+        """
+        self.client.post(reverse("lms:subscriptions"), {"course_id": self.course.id}, format="json")
+        self.assertEqual(self.counters(self.course), (0, 1))
+        self.client.post(reverse("lms:subscriptions"), {"course_id": self.course.id}, format="json")
+        self.assertEqual(self.counters(self.course), (0, 0))
+
+        url = reverse("lms:subscriptions-bulk")
+        course_ids = [self.course.id, self.other_course.id]
+        self.client.post(url, {"course_ids": course_ids, "action": "subscribe"}, format="json")
+        self.client.post(url, {"course_ids": course_ids, "action": "subscribe"}, format="json")
+        self.assertEqual((self.counters(self.course), self.counters(self.other_course)), ((0, 1), (0, 1)))
+        self.client.post(url, {"course_ids": [self.course.id], "action": "unsubscribe"}, format="json")
+        self.assertEqual(self.counters(self.course), (0, 0))
+
+        subscriber = User.objects.create_user(email="fan@example.com", password="testpassword", username="fan")
+        SubscriptionForCourse.objects.create(owner=subscriber, course=self.course)
+        self.assertEqual(self.counters(self.course), (0, 1))
+        subscriber.delete()
+        self.assertEqual(self.counters(self.course), (0, 0))
+
+    def test_order_and_filter_by_popularity(self):
+        """
+        Курсы сортируются и фильтруются по счетчикам.
+        """
+        Course.objects.filter(pk=self.other_course.pk).update(subscribers_count=5)
+        response = self.client.get(reverse("lms:courses-list"), {"ordering": "-subscribers_count"})
+        self.assertEqual([item["id"] for item in response.data["results"]], [self.other_course.id, self.course.id])
+        self.assertEqual(response.data["results"][0]["subscribers_count"], 5)
+
+        response = self.client.get(reverse("lms:courses-list"), {"subscribers_count__gte": 1})
+        self.assertEqual([item["id"] for item in response.data["results"]], [self.other_course.id])
+
+    def test_paging_through_tied_counters(self):
+        """
+        При равных счетчиках курсы упорядочиваются по id: страницы курсора не теряют и не повторяют курсы.
+        """
+        courses = [self.course, self.other_course] + [
+            Course.objects.create(title=f"Курс {index}", owner=self.owner) for index in range(7)
+        ]
+        Course.objects.update(subscribers_count=3)
+        Course.objects.filter(pk=courses[4].pk).update(subscribers_count=5)
+
+        seen = []
+        url = reverse("lms:courses-list") + "?ordering=-subscribers_count&page_size=2"
+        while url:
+            response = self.client.get(url)
+            seen += [item["id"] for item in response.data["results"]]
+            url = response.data["next"]
+        expected = [courses[4].id] + sorted((course.id for course in courses if course != courses[4]), reverse=True)
+        self.assertEqual(seen, expected)
+
+    def test_paging_through_large_tie(self):
+        """
+        Курсор хранит (значение, id), а не смещение внутри группы равных значений:
+        больше тысячи курсов с одинаковым счетчиком пролистываются до конца в обе стороны и при любых направлениях.
+        """
+        Course.objects.bulk_create(Course(title=f"Курс {index}", owner=self.owner) for index in range(1150))
+        for ordering, expected in (
+            ("lessons_count", sorted(Course.objects.values_list("id", flat=True))),
+            ("-lessons_count", sorted(Course.objects.values_list("id", flat=True), reverse=True)),
+            ("lessons_count,-id", sorted(Course.objects.values_list("id", flat=True), reverse=True)),
+        ):
+            with self.subTest(ordering=ordering):
+                seen = []
+                url = reverse("lms:courses-list") + f"?ordering={ordering}&page_size=50"
+                while url:
+                    response = self.client.get(url)
+                    self.assertEqual(response.status_code, status.HTTP_200_OK)
+                    page = [item["id"] for item in response.data["results"]]
+                    seen += page
+                    url = response.data["next"]
+                self.assertEqual(seen, expected)
+
+                response = self.client.get(response.data["previous"])
+                start = len(expected) - len(page)
+                self.assertEqual([item["id"] for item in response.data["results"]], expected[start - 50 : start])
+
+    def test_invalid_cursor(self):
+        """
+        Подделанный курсор дает 404, а не ошибку сервера.
+        """
+        response = self.client.get(reverse("lms:courses-list") + "?ordering=lessons_count&cursor=cD0lNUIlMjJ4JTIyJTVE")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_recount_command(self):
+        """
+        Команда recount_course_counters исправляет разошедшиеся счетчики.
+        """
+        Lesson.objects.create(title="Урок", description="", course=self.course, owner=self.owner)
+        SubscriptionForCourse.objects.create(owner=self.owner, course=self.course)
+        Course.objects.update(lessons_count=7, subscribers_count=0)
+
+        out = StringIO()
+        call_command("recount_course_counters", stdout=out)
+        self.assertIn("Fixed counters of 2 courses", out.getvalue())
+        self.assertEqual((self.counters(self.course), self.counters(self.other_course)), ((1, 1), (0, 0)))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PopularCoursesTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(redis_client, "_unavailable_until", 0.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.owner = User.objects.create_user(email="owner@example.com", password="testpassword", username="owner")
+        self.client.force_authenticate(user=self.owner)
+        self.course = Course.objects.create(title="Курс", owner=self.owner)
+        self.other_course = Course.objects.create(title="Другой курс", owner=self.owner)
+        self.url = reverse("lms:courses-popular")
+
+    @mock.patch.object(leaderboard, "get_redis_client")
+    def test_incremental_updates(self, mock_client):
+        """
+        Подписки и оплаты меняют счета в Redis после коммита, одним конвейером на операцию.
+        """
+        pipe = mock_client.return_value.pipeline.return_value
+        with self.captureOnCommitCallbacks(execute=True):
+            SubscriptionForCourse.subscribe_many(self.owner.pk, [self.course.id, self.other_course.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            SubscriptionForCourse.toggle(self.owner.pk, self.course.id)
+        lesson = Lesson.objects.create(title="Урок", description="", course=self.other_course, owner=self.owner)
+        payments = [
+            Payment.objects.create(user=self.owner, course=self.course, amount=100, payment_method="cash"),
+            Payment.objects.create(user=self.owner, lesson=lesson, amount=50, payment_method="cash"),
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            Payment.mark_paid_many([payment.id for payment in payments])
+
+        all_time = [
+            (call.args[0].split(":")[2], call.args[2], call.args[1])
+            for call in pipe.zincrby.call_args_list
+            if call.args[0].endswith(":all")
+        ]
+        self.assertEqual(
+            all_time,
+            [
+                ("subscriptions", self.course.id, 1),
+                ("subscriptions", self.other_course.id, 1),
+                ("subscriptions", self.course.id, -1),
+                ("sales", self.course.id, 1),
+                ("sales", self.other_course.id, 1),
+            ],
+        )
+        self.assertEqual(pipe.execute.call_count, 3)
+
+    @mock.patch.object(leaderboard, "get_redis_client")
+    @override_settings(LEADERBOARD_MAX_DAYS=30)
+    def test_incremental_updates_use_row_day(self, mock_client):
+        """
+        Изменение попадает в дневную корзину даты самой строки, как при rebuild: отписка - в день подписки,
+        продажа - в день платежа; корзины старше самого длинного окна не трогаются.
+        """
+        pipe = mock_client.return_value.pipeline.return_value
+        today = timezone.localdate()
+        subscription = SubscriptionForCourse.objects.create(owner=self.owner, course=self.course)
+        SubscriptionForCourse.objects.filter(pk=subscription.pk).update(created_at=timezone.now() - timedelta(days=3))
+        payments = [
+            Payment.objects.create(user=self.owner, course=self.other_course, amount=100, payment_method="cash")
+            for _ in range(2)
+        ]
+        Payment.objects.filter(pk=payments[0].pk).update(date=timezone.now() - timedelta(days=2))
+        Payment.objects.filter(pk=payments[1].pk).update(date=timezone.now() - timedelta(days=90))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            SubscriptionForCourse.toggle(self.owner.pk, self.course.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            Payment.mark_paid_many([payment.id for payment in payments])
+
+        day_deltas = [
+            (call.args[0].split(":", 4)[4], call.args[2], call.args[1])
+            for call in pipe.zincrby.call_args_list
+            if ":day:" in call.args[0]
+        ]
+        self.assertEqual(
+            day_deltas,
+            [
+                ((today - timedelta(days=3)).isoformat(), self.course.id, -1),
+                ((today - timedelta(days=2)).isoformat(), self.other_course.id, 1),
+            ],
+        )
+        all_time = [call.args[1:] for call in pipe.zincrby.call_args_list if call.args[0] == "lms:leaderboard:sales:all"]
+        self.assertEqual(all_time, [(1, self.other_course.id), (1, self.other_course.id)])
+
+    @mock.patch.object(leaderboard, "get_redis_client")
+    def test_popular_from_redis(self, mock_client):
+        """
+        Выдача строится по рейтингу Redis, курсы загружаются одним запросом, удаленные курсы пропускаются.
+        """
+        client = mock_client.return_value
+        client.exists.return_value = False
+        client.zrevrangebyscore.return_value = [(str(self.other_course.id), 3.0), ("999999", 2.0), (str(self.course.id), 1.0)]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {"by": "sales", "days": 7, "limit": 5})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(item["id"], item["score"]) for item in response.data["results"]],
+            [(self.other_course.id, 3), (self.course.id, 1)],
+        )
+        self.assertEqual(len([query for query in queries if "lms_course" in query["sql"]]), 1)
+
+        key, day_keys = client.pipeline.return_value.zunionstore.call_args.args
+        self.assertEqual(key, "lms:leaderboard:sales:window:7")
+        self.assertEqual(len(day_keys), 7)
+        client.zrevrangebyscore.assert_called_with(key, "+inf", "(0", start=0, num=5, withscores=True)
+
+    @mock.patch.object(leaderboard, "get_redis_client", side_effect=redis.ConnectionError("down"))
+    def test_popular_falls_back_to_database(self, mock_client):
+        """
+        Без Redis рейтинг считается по Postgres; оплата урока засчитывается его курсу.
+        """
+        subscriber = User.objects.create_user(email="fan@example.com", password="testpassword", username="fan")
+        SubscriptionForCourse.objects.create(owner=subscriber, course=self.other_course)
+        SubscriptionForCourse.objects.create(owner=self.owner, course=self.other_course)
+        SubscriptionForCourse.objects.create(owner=self.owner, course=self.course)
+        lesson = Lesson.objects.create(title="Урок", description="", course=self.course, owner=self.owner)
+        Payment.objects.create(user=self.owner, lesson=lesson, amount=50, payment_method="cash", is_paid=True)
+        Payment.objects.create(user=self.owner, course=self.other_course, amount=50, payment_method="cash")
+
+        response = self.client.get(self.url)
+        self.assertEqual(
+            [(item["id"], item["score"]) for item in response.data["results"]],
+            [(self.other_course.id, 2), (self.course.id, 1)],
+        )
+        response = self.client.get(self.url, {"by": "sales", "days": 1})
+        self.assertEqual([(item["id"], item["score"]) for item in response.data["results"]], [(self.course.id, 1)])
+
+    def test_invalid_params(self):
+        """
+        Неизвестная метрика и значения days и limit вне допустимых границ дают 400.
+        """
+        for params in ({"by": "views"}, {"days": 0}, {"days": 31}, {"limit": "many"}, {"limit": 51}):
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SimilarCoursesTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user(email="owner@example.com", password="testpassword", username="owner")
+        self.client.force_authenticate(user=self.owner)
+        self.courses = [Course.objects.create(title=f"Курс {index}", owner=self.owner) for index in range(4)]
+        students = [
+            User.objects.create_user(email=f"student{index}@example.com", password="testpassword", username=f"student{index}")
+            for index in range(4)
+        ]
+        # Подписчики: курс 0 - {0, 1, 2}, курс 1 - {0, 1}, курс 2 - {2}, курс 3 - {3}
+        subscriptions = {0: [0, 1], 1: [0, 1], 2: [0, 2], 3: [3]}
+        SubscriptionForCourse.objects.bulk_create(
+            SubscriptionForCourse(owner=students[student], course=self.courses[course])
+            for student, courses in subscriptions.items()
+            for course in courses
+        )
+
+    def similar(self, course):
+        return [
+            (item.similar_course_id, round(item.score, 4))
+            for item in SimilarCourse.objects.filter(course=course).order_by("-score")
+        ]
+
+    @override_settings(SIMILAR_COURSES_BLOCK_SIZE=4)  # По одному курсу в блоке
+    def test_compute_similar_courses(self):
+        """
+        Близость - косинус множеств подписчиков; курсы без общих подписчиков не сохраняются, старые пары заменяются.
+        """
+        first, second, third, fourth = self.courses
+        SimilarCourse.objects.create(course=fourth, similar_course=first, score=1)
+
+        self.assertEqual(compute_similar_courses.apply().get(), "Сохранено 4 пар похожих курсов")
+        self.assertEqual(self.similar(first), [(second.id, 0.8165), (third.id, 0.5774)])
+        self.assertEqual(self.similar(second), [(first.id, 0.8165)])
+        self.assertEqual(self.similar(third), [(first.id, 0.5774)])
+        self.assertEqual(self.similar(fourth), [])
+
+        with override_settings(SIMILAR_COURSES_TOP_K=1):
+            compute_similar_courses.apply().get()
+        self.assertEqual(self.similar(first), [(second.id, 0.8165)])
+
+    def test_similar_endpoint(self):
+        """
+        Похожие курсы отдаются одним запросом по убыванию близости; для несуществующего курса - 404.
+        """
+        compute_similar_courses.apply().get()
+        first, second, third, fourth = self.courses
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("lms:courses-similar", args=[first.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([item["id"] for item in response.data["results"]], [second.id, third.id])
+        self.assertEqual(set(response.data["results"][0]), {"id", "title", "lessons_count", "subscribers_count", "score"})
+
+        response = self.client.get(reverse("lms:courses-similar", args=[fourth.id]))
+        self.assertEqual(response.data, {"results": []})
+        response = self.client.get(reverse("lms:courses-similar", args=[999999]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SearchTests(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(email="owner@example.com", password="testpassword", username="owner")
+        self.client.force_authenticate(user=self.owner)
+        self.python = Course.objects.create(title="Программирование на Python", description="Основы языка", owner=self.owner)
+        self.django = Course.objects.create(
+            title="Веб-разработка на Django", description="Программирование сайтов", owner=self.owner
+        )
+        self.lessons = Lesson.objects.bulk_create(
+            [
+                Lesson(title="Функции", description="Функции и замыкания в Python", course=self.python, owner=self.owner),
+                Lesson(title="Модели", description="Модели и миграции", course=self.django, owner=self.owner),
+            ]
+        )
+        self.url = reverse("lms:search")
+
+    def ids(self, results):
+        return [item["id"] for item in results]
+
+    def test_ranked_prefix_search(self):
+        """
+        Совпадение в названии выше совпадения в описании, слова ищутся как начала слов и с учетом словоформ.
+        """
+        response = self.client.get(self.url, {"q": "программ"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.ids(response.data["courses"]), [self.python.id, self.django.id])
+        self.assertGreater(response.data["courses"][0]["rank"], response.data["courses"][1]["rank"])
+        self.assertEqual(response.data["lessons"], [])
+
+        response = self.client.get(self.url, {"q": "функция питон"})
+        self.assertEqual(self.ids(response.data["lessons"]), [])
+        response = self.client.get(self.url, {"q": "функция pyth", "type": "lessons"})
+        self.assertEqual(list(response.data), ["lessons"])
+        self.assertEqual(response.data["lessons"][0]["course_id"], self.python.id)
+        self.assertEqual(self.ids(response.data["lessons"]), [self.lessons[0].id])
+
+    def test_vector_follows_updates(self):
+        """
+        Поисковый вектор пересчитывается БД при любом изменении, в том числе через update().
+        """
+        Lesson.objects.filter(pk=self.lessons[1].pk).update(title="Сериализаторы")
+        response = self.client.get(self.url, {"q": "сериализатор", "type": "lessons"})
+        self.assertEqual(self.ids(response.data["lessons"]), [self.lessons[1].id])
+
+    def test_invalid_params(self):
+        """
+        Пустой запрос, неизвестный вид и лимит вне границ дают 400.
+        """
+        for params in ({}, {"q": " !? "}, {"q": "python", "type": "users"}, {"q": "python", "limit": 100}):
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CacheDeleteRaceTests(APITransactionTestCase):
+    """
+    Удаление с настоящим коммитом (без транзакции теста): on_commit выполняется сразу после коммита.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user(email="author@example.com", password="testpassword", username="author")
+        self.client.force_authenticate(user=self.owner)
+        self.course = Course.objects.create(title="Курс", owner=self.owner)
+        self.lesson = Lesson.objects.create(
+            title="Урок", description="Описание", course=self.course, owner=self.owner, video_url="https://youtube.com/v"
+        )
+
+    def read_during_delete(self, model, list_url):
+        """Удаление, во время которого параллельный запрос читает список, пока строка еще не удалена"""
+        real_delete = model.delete
+
+        def delete(instance, *args, **kwargs):
+            self.client.get(list_url)
+            return real_delete(instance, *args, **kwargs)
+
+        return mock.patch.object(model, "delete", delete)
+
+    def test_lesson_list_read_during_delete(self):
+        """
+        Список уроков, прочитанный во время удаления урока, не отдается после удаления.
+        """
+        list_url = reverse("lms:lesson-list")
+        with self.read_during_delete(Lesson, list_url):
+            response = self.client.delete(reverse("lms:lesson-delete", args=[self.lesson.id]))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.get(list_url).data["results"], [])
+
+    def test_course_list_read_during_delete(self):
+        """
+        Список курсов, прочитанный во время удаления курса, не отдается после удаления.
+        """
+        list_url = reverse("lms:courses-list")
+        with self.read_during_delete(Course, list_url):
+            response = self.client.delete(reverse("lms:courses-detail", args=[self.course.id]))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.get(list_url).data["results"], [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CourseCacheTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user(email="author@example.com", password="testpassword", username="author")
+        self.owner_client = APIClient()
+        self.owner_client.force_authenticate(user=self.owner)
+        self.reader = User.objects.create_user(email="student@example.com", password="testpassword", username="student")
+        self.reader_client = APIClient()
+        self.reader_client.force_authenticate(user=self.reader)
+
+        self.course = Course.objects.create(title="Cached Course", owner=self.owner)
+        self.lesson = Lesson.objects.create(
+            title="Cached Lesson",
+            description="Description",
+            course=self.course,
+            owner=self.owner,
+            video_url="https://youtube.com/v",
+        )
+
+    def test_course_list_served_from_cache(self):
+        """
+        Повторный запрос списка не обращается к БД, подписка накладывается для каждого пользователя.
+        """
+        SubscriptionForCourse.objects.create(owner=self.reader, course=self.course)
+        url = reverse("lms:courses-list")
+        self.owner_client.get(url)
+
+        with self.assertNumQueries(1):  # Подписки пользователя, далее тоже из кеша
+            response = self.reader_client.get(url)
+        self.assertEqual(response.data["results"][0]["subscriptions"], "У вас есть подписка на данный курс.")
+
+        with self.assertNumQueries(0):
+            self.reader_client.get(url)
+
+        response = self.owner_client.get(url)
+        self.assertEqual(response.data["results"][0]["subscriptions"], "У вас нет подписки на данный курс")
+
+    def test_stale_subscriptions_not_cached_after_toggle(self):
+        """
+        Множество подписок, прочитанное до коммита переключения, не переживает инвалидацию.
+        """
+        empty = SubscriptionForCourse.objects.none()
+
+        def toggle_during_read(*args, **kwargs):
+            # Подписка переключается и коммитится, пока запрос держит старое (пустое) состояние
+            with self.captureOnCommitCallbacks(execute=True):
+                SubscriptionForCourse.toggle(self.reader.pk, self.course.id)
+                services.invalidate_subscriptions(self.reader.pk)
+            return empty
+
+        with mock.patch.object(SubscriptionForCourse.objects, "filter", side_effect=toggle_during_read):
+            self.assertEqual(services.get_subscribed_course_ids(self.reader), set())
+        self.assertEqual(services.get_subscribed_course_ids(self.reader), {self.course.id})
+
+    def test_works_without_redis(self):
+        """
+        Недоступный кеш не ломает чтение и запись курсов и уроков: данные берутся из БД.
+        """
+        down = redis.ConnectionError("down")
+        broken_cache = mock.Mock(**{f"{name}.side_effect": down for name in ("get", "add", "set", "set_many")})
+        SubscriptionForCourse.objects.create(owner=self.reader, course=self.course)
+        with mock.patch.object(services, "cache", broken_cache):
+            response = self.reader_client.get(reverse("lms:courses-list"))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data["results"][0]["subscriptions"], "У вас есть подписка на данный курс.")
+            for url in (
+                reverse("lms:courses-detail", args=[self.course.id]),
+                reverse("lms:lesson-list"),
+                reverse("lms:lesson-get", args=[self.lesson.id]),
+            ):
+                self.assertEqual(self.owner_client.get(url).status_code, status.HTTP_200_OK, url)
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.owner_client.patch(
+                    reverse("lms:lesson-update", args=[self.lesson.id]),
+                    {"title": "Новое название", "video_url": "https://youtube.com/v"},
+                    format="json",
+                )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_course_retrieve_checks_permissions_on_cache_hit(self):
+        """
+        Закешированный курс по-прежнему недоступен тому, кто не владелец и не модератор.
+        """
+        url = reverse("lms:courses-detail", args=[self.course.id])
+        self.assertEqual(self.owner_client.get(url).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.reader_client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_course_update_invalidates_cache(self):
+        """
+        После обновления курса в кеше не остается старых данных.
+        """
+        detail_url = reverse("lms:courses-detail", args=[self.course.id])
+        list_url = reverse("lms:courses-list")
+        self.owner_client.get(detail_url)
+        self.owner_client.get(list_url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.owner_client.patch(detail_url, {"title": "Updated Course"}, format="json")
+
+        self.assertEqual(self.owner_client.get(detail_url).data["title"], "Updated Course")
+        self.assertEqual(self.owner_client.get(list_url).data["results"][0]["title"], "Updated Course")
+
+    def test_lesson_changes_invalidate_cache(self):
+        """
+        Создание и удаление урока сбрасывают кеш курса и списка уроков.
+        """
+        course_url = reverse("lms:courses-detail", args=[self.course.id])
+        lessons_url = reverse("lms:lesson-list")
+        self.assertEqual(self.owner_client.get(course_url).data["lessons_count"], 1)
+        self.assertEqual(len(self.owner_client.get(lessons_url).data["results"]), 1)
+
+        data = {
+            "title": "New Lesson",
+            "description": "New Lesson Description",
+            "course": self.course.id,
+            "video_url": "https://youtube.com/video",
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            self.owner_client.post(reverse("lms:lesson-create"), data, format="json")
+        self.assertEqual(self.owner_client.get(course_url).data["lessons_count"], 2)
+        self.assertEqual(len(self.owner_client.get(lessons_url).data["results"]), 2)
+
+        lesson_url = reverse("lms:lesson-get", args=[self.lesson.id])
+        self.assertEqual(self.owner_client.get(lesson_url).status_code, status.HTTP_200_OK)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.owner_client.delete(reverse("lms:lesson-delete", args=[self.lesson.id]))
+        self.assertEqual(self.owner_client.get(lesson_url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.owner_client.get(course_url).data["lessons_count"], 1)
+
+    def test_subscription_toggle_invalidates_overlay(self):
+        """
+        Переключение подписки сразу отражается в закешированном списке курсов.
+        """
+        url = reverse("lms:courses-list")
+        response = self.reader_client.get(url)
+        self.assertEqual(response.data["results"][0]["subscriptions"], "У вас нет подписки на данный курс")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.reader_client.post(reverse("lms:subscriptions"), {"course_id": self.course.id}, format="json")
+
+        response = self.reader_client.get(url)
+        self.assertEqual(response.data["results"][0]["subscriptions"], "У вас есть подписка на данный курс.")
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES, EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend", COURSE_UPDATE_MAIL_CHUNK_SIZE=2
+)
+class CourseUpdateMailTests(APITestCase):
+    def setUp(self):
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
+
+        owner = User.objects.create_user(email="author@example.com", password="testpassword", username="author")
+        self.course = Course.objects.create(title="Mailed Course", owner=owner)
+        for index in range(5):
+            subscriber = User.objects.create_user(
+                email=f"subscriber{index}@example.com", password="testpassword", username=f"subscriber{index}"
+            )
+            SubscriptionForCourse.objects.create(owner=subscriber, course=self.course)
+
+    def test_each_subscriber_gets_own_message(self):
+        """
+        Каждый подписчик получает отдельное письмо, адреса выбираются без N+1.
+        """
+        with self.assertNumQueries(2):  # Проверка курса и поток адресов
+            chunks = send_course_update_mail(self.course.id)
+
+        self.assertEqual(chunks, 3)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertTrue(all(len(message.to) == 1 for message in mail.outbox))
+        self.assertEqual({message.to[0] for message in mail.outbox}, {f"subscriber{i}@example.com" for i in range(5)})
+
+    def test_missing_course(self):
+        """
+        Для несуществующего курса письма не отправляются.
+        """
+        self.assertIsNone(send_course_update_mail(999))
+        self.assertEqual(len(mail.outbox), 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, COURSE_UPDATE_MAIL_DEBOUNCE=600)
+class CourseUpdateOutboxTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user(email="author@example.com", password="testpassword", username="author")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.owner)
+        self.course = Course.objects.create(title="Edited Course", owner=self.owner)
+
+    def test_burst_of_updates_is_coalesced(self):
+        """
+        Серия правок курса в пределах окна оставляет в outbox одну отложенную рассылку.
+        """
+        url = reverse("lms:courses-detail", args=[self.course.id])
+        for index in range(10):
+            self.client.patch(url, {"title": f"Edited Course {index}"}, format="json")
+
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.task_name, "lms.tasks.send_course_update_mail")
+        self.assertEqual(message.args, [self.course.id])
+        self.assertGreater(message.available_at, timezone.now() + timedelta(seconds=590))
+
+    def test_failed_update_leaves_no_message(self):
+        """
+        Невалидное обновление не порождает уведомление.
+        """
+        url = reverse("lms:courses-detail", args=[self.course.id])
+        response = self.client.patch(url, {"title": ""}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    @mock.patch.object(celery_app, "send_task")
+    def test_relay_publishes_due_messages(self, mock_send_task):
+        """
+        Ретранслятор публикует только наступившие сообщения и удаляет их, после чего правка планирует новую рассылку.
+        """
+        schedule_course_update_mail(self.course.id)
+        OutboxMessage.enqueue("lms.tasks.send_course_update_mail", args=[999])
+
+        self.assertEqual(relay_outbox(), 1)
+        mock_send_task.assert_called_once()
+        self.assertEqual(mock_send_task.call_args.args, ("lms.tasks.send_course_update_mail",))
+        self.assertEqual(mock_send_task.call_args.kwargs["args"], [999])
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+
+        OutboxMessage.objects.update(available_at=timezone.now())
+        self.assertEqual(relay_outbox(), 1)
+        self.assertFalse(OutboxMessage.objects.exists())
+
+        schedule_course_update_mail(self.course.id)
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+
+    @override_settings(COURSE_UPDATE_MAIL_DEBOUNCE=0)
+    def test_debounce_disabled(self):
+        """
+        С нулевым окном каждое обновление ставит рассылку сразу.
+        """
+        schedule_course_update_mail(self.course.id)
+        schedule_course_update_mail(self.course.id)
+        self.assertEqual(OutboxMessage.objects.filter(available_at__lte=timezone.now()).count(), 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DEACTIVATE_USERS_BATCH_PAUSE=0)
+class DeactivateInactiveUsersTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        long_ago = timezone.now() - timedelta(days=60)
+        self.inactive = [
+            User.objects.create_user(
+                email=f"sleeper{index}@example.com", password="testpassword", username=f"sleeper{index}", last_login=long_ago
+            )
+            for index in range(5)
+        ]
+        self.recent = User.objects.create_user(
+            email="recent@example.com", password="testpassword", username="recent", last_login=timezone.now()
+        )
+        self.never = User.objects.create_user(email="never@example.com", password="testpassword", username="never")
+
+    def test_deactivates_in_batches(self):
+        """
+        Деактивируются только давно не заходившие пользователи, пачками заданного размера.
+        """
+        with self.assertNumQueries(6):  # Три пачки: выборка + UPDATE
+            result = deactivate_inactive_users(batch_size=2)
+
+        self.assertEqual(result, "Деактивировано 5 неактивных пользователей")
+        self.assertEqual(User.objects.filter(is_active=False).count(), 5)
+        self.assertTrue(User.objects.get(pk=self.recent.pk).is_active)
+        self.assertTrue(User.objects.get(pk=self.never.pk).is_active)
+        self.assertIsNone(cache.get(DEACTIVATE_CHECKPOINT_KEY))
+
+    def test_login_between_select_and_update(self):
+        """
+        Пользователь, вошедший после выборки пачки, не деактивируется и не теряет доступ.
+        """
+        woke_up = self.inactive[0]
+
+        def login_before_update(execute, sql, params, many, context):
+            if "SET is_active = FALSE" in sql:
+                execute(
+                    f"UPDATE {User._meta.db_table} SET last_login = %s WHERE id = %s",
+                    [timezone.now(), woke_up.pk],
+                    False,
+                    context,
+                )
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(login_before_update):
+            result = deactivate_inactive_users(batch_size=10)
+
+        self.assertEqual(result, "Деактивировано 4 неактивных пользователей")
+        self.assertTrue(User.objects.get(pk=woke_up.pk).is_active)
+        self.assertIsNone(cache.get(revoked_cache_key(woke_up.pk)))
+        self.assertTrue(cache.get(revoked_cache_key(self.inactive[1].pk)))
+
+    def test_dry_run_changes_nothing(self):
+        """
+        Режим dry_run только считает пользователей.
+        """
+        result = deactivate_inactive_users(dry_run=True, batch_size=2)
+        self.assertEqual(result, "Будет деактивировано 5 неактивных пользователей")
+        self.assertFalse(User.objects.filter(is_active=False).exists())
+
+    def test_resumes_from_checkpoint(self):
+        """
+        Прерванный запуск продолжается с сохраненной позиции.
+        """
+        ordered = sorted(self.inactive, key=lambda user: (user.last_login, user.pk))
+        cache.set(
+            DEACTIVATE_CHECKPOINT_KEY,
+            {"cutoff": timezone.now() - timedelta(days=30), "last_login": ordered[2].last_login, "id": ordered[2].pk},
+        )
+
+        result = deactivate_inactive_users(batch_size=2)
+        self.assertEqual(result, "Деактивировано 2 неактивных пользователей")
+        self.assertEqual(
+            set(User.objects.filter(is_active=False).values_list("pk", flat=True)), {ordered[3].pk, ordered[4].pk}
+        )
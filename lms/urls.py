@@ -4,6 +4,7 @@ from rest_framework.routers import DefaultRouter
 from lms.apps import LmsConfig
 
 from .views import (
+    CourseBulkSubscriptionAPIView,
     CourseSubscriptionViewSet,
     CourseViewSet,
     LessonCreateAPIView,
@@ -11,6 +12,7 @@ from .views import (
     LessonListAPIView,
     LessonRetrieveAPIView,
     LessonUpdateAPIView,
+    SearchAPIView,
 )
 
 app_name = LmsConfig.name
@@ -24,4 +26,6 @@ urlpatterns = [
     path("lessons/<int:pk>/update/", LessonUpdateAPIView.as_view(), name="lesson-update"),
     path("lessons/<int:pk>/delete/", LessonDeleteAPIView.as_view(), name="lesson-delete"),
     path("subscriptions/", CourseSubscriptionViewSet.as_view(), name="subscriptions"),
+    path("subscriptions/bulk/", CourseBulkSubscriptionAPIView.as_view(), name="subscriptions-bulk"),
+    path("search/", SearchAPIView.as_view(), name="search"),
 ] + router.urls
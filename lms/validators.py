@@ -2,6 +2,9 @@ import re
 
 from rest_framework.serializers import ValidationError
 
+# Компилируется один раз при импорте, а не при каждой проверке
+VIDEO_URL_REGEX = re.compile(r"^(https?:\/\/)?([\w-]{1,32}\.[\w-]{1,32})[^\s@]*$")
+
 
 class VideoUrlValidator:
 
@@ -9,9 +12,8 @@ class VideoUrlValidator:
         self.field = field
 
     def __call__(self, value):
-        reg = re.compile(r"^(https?:\/\/)?([\w-]{1,32}\.[\w-]{1,32})[^\s@]*$")
         tmp_val = dict(value).get(self.field)
-        if not bool(reg.match(tmp_val)) or not value or value is None:
+        if not bool(VIDEO_URL_REGEX.match(tmp_val)) or not value or value is None:
             raise ValidationError("Url неверный")
         elif "youtube.com" not in tmp_val:
             raise ValidationError("Ссылка на видео только с youtube.com")
@@ -1,18 +1,69 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Prefetch
+from django.shortcuts import get_object_or_404
+from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import generics, status, viewsets
-from rest_framework.exceptions import NotFound, PermissionDenied
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
+from rest_framework.parsers import JSONParser
+from rest_framework.permissions import SAFE_METHODS, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from lms.tasks import send_course_update_mail
+from lms import leaderboard, search, services
 from users.models import SubscriptionForCourse
 from users.permissions import IsModeratorOrOwner, IsOwner
 
-from .models import Course, Lesson
-from .serializers import CourseSerializer, LessonSerializer
+from .filters import StableOrderingFilter
+from .models import Course, Lesson, SimilarCourse
+from .paginators import CustomCursorPaginator
+from .parsers import NDJSONParser
+from .serializers import BulkSubscriptionSerializer, CourseSerializer, LessonBulkItemSerializer, LessonSerializer
 
 
-class CourseViewSet(viewsets.ModelViewSet):
+def get_bounded_int_param(request, name, default, maximum):
+    """Целый параметр запроса от 1 до maximum; default, если параметр не передан"""
+    value = request.query_params.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if not 1 <= value <= maximum:
+        raise ValidationError({name: f"Ожидается целое число от 1 до {maximum}."})
+    return value
+
+
+class SparseFieldsetMixin:
+    """
+    Поддержка ?fields=, ?omit= и ?expand= для чтения. Из БД выбираются только столбцы выводимых полей
+    (а также id и owner для проверки прав), связанные данные подгружаются только при раскрытии.
+    """
+
+    def get_query_param_set(self, name):
+        return {value for value in self.request.query_params.get(name, "").split(",") if value}
+
+    def get_serializer(self, *args, **kwargs):
+        # Запись всегда валидируется полным набором полей
+        if self.request.method in SAFE_METHODS:
+            kwargs.setdefault("fields", self.get_query_param_set("fields"))
+            kwargs.setdefault("omit", self.get_query_param_set("omit"))
+        kwargs.setdefault("expand", self.get_query_param_set("expand"))
+        return super().get_serializer(*args, **kwargs)
+
+    def get_serializer_field_names(self):
+        return set(self.get_serializer().fields)
+
+    def only_serialized_fields(self, queryset, field_names):
+        if self.request.method not in SAFE_METHODS:
+            return queryset
+        model_fields = {field.name for field in queryset.model._meta.concrete_fields}
+        return queryset.only(*(field_names & model_fields | {"id", "owner"}))
+
+
+class CourseViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     """
     Управляет курсами.
     Модель CourseView.
@@ -23,29 +74,193 @@ class CourseViewSet(viewsets.ModelViewSet):
     queryset = Course.objects.all()
     serializer_class = CourseSerializer
     permission_classes = [IsAuthenticated, IsOwner]
+    pagination_class = CustomCursorPaginator
+    # Популярность - индексированные столбцы-счетчики, без COUNT(*) по урокам и подпискам
+    filter_backends = [DjangoFilterBackend, StableOrderingFilter]
+    filterset_fields = {"lessons_count": ["gte", "lte"], "subscribers_count": ["gte", "lte"]}
+    ordering_fields = ["id", "lessons_count", "subscribers_count"]
+    ordering = ["id"]
 
     def get_permissions(self):
         """
         Определяет права доступа применяются в зависимости от выполняемого действия.
         """
-        if self.action in ["create", "destroy"]:
+        if self.action in ["create", "destroy", "bulk_lessons"]:
             permission_classes = [IsAuthenticated, IsOwner]  # Только владельцы могут создавать и удалять
         else:
             permission_classes = [IsAuthenticated, IsModeratorOrOwner]
 
         return [permission() for permission in permission_classes]
 
+    def get_queryset(self):
+        """
+        Признак подписки текущего пользователя и сами уроки выбираются фиксированным числом запросов,
+        независимо от количества курсов, и только если эти поля выводятся.
+        """
+        field_names = self.get_serializer_field_names()
+        queryset = self.only_serialized_fields(Course.objects.all(), field_names)
+        if "subscriptions" in field_names:
+            subscriptions = SubscriptionForCourse.objects.filter(owner=self.request.user.pk, course=OuterRef("pk"))
+            queryset = queryset.annotate(is_subscribed=Exists(subscriptions))
+        if "lessons" in field_names:
+            queryset = queryset.prefetch_related(Prefetch("lessons", queryset=Lesson.objects.order_by("pk")))
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        """
+        Общая часть списка берется из кеша, подписка текущего пользователя накладывается поверх.
+        """
+        cache_key = services.course_list_cache_key(request)
+        cached = services.get_cached_response(cache_key)
+        if cached is None:
+            response = super().list(request, *args, **kwargs)
+            data = {**response.data, "results": services.without_subscriptions(response.data["results"])}
+            services.set_cached_response(cache_key, None, data)
+            return response
+
+        _, data = cached
+        return Response({**data, "results": services.with_subscriptions(data["results"], request.user)})
+
+    def retrieve(self, request, *args, **kwargs):
+        cache_key = services.course_detail_cache_key(kwargs[self.lookup_field], request)
+        cached = services.get_cached_response(cache_key)
+        if cached is None:
+            course = self.get_object()
+            data = self.get_serializer(course).data
+            services.set_cached_response(cache_key, course.owner_id, services.without_subscriptions([data])[0])
+            return Response(data)
+
+        owner_id, data = cached
+        self.check_object_permissions(request, Course(pk=kwargs[self.lookup_field], owner_id=owner_id))
+        return Response(services.with_subscriptions([data], request.user)[0])
+
+    def perform_create(self, serializer):
+        course = serializer.save()
+        services.invalidate_course(course.pk)
+
     def perform_update(self, serializer):
         """
         Обновление курса и отправка уведомления всем подписанным пользователям.
         """
-        course = serializer.save()
-        # Отправляем уведомление подписчикам (асинхронно)
-        send_course_update_mail.delay(course.id)  # Вызываем задачу
+        with transaction.atomic():
+            course = serializer.save()
+            # Уведомление подписчикам попадает в outbox вместе с изменением курса, серия правок схлопывается
+            services.schedule_course_update_mail(course.id)
+        services.invalidate_course(course.id)
+
+    @action(detail=True, methods=["post"], url_path="lessons/bulk", parser_classes=[JSONParser, NDJSONParser])
+    def bulk_lessons(self, request, pk=None):
+        """
+        Массовый импорт уроков курса: JSON-массив или NDJSON-поток.
+        Права проверяются один раз, все элементы валидируются, при ошибках возвращаются ошибки по каждому элементу.
+        Запись выполняется bulk_create/bulk_update в одной транзакции.
+        """
+        course = get_object_or_404(Course.objects.only("id", "owner"), pk=pk)
+        self.check_object_permissions(request, course)
+
+        if not isinstance(request.data, list) or not request.data:
+            raise ValidationError({"error": "Ожидается непустой список уроков."})
+        if len(request.data) > settings.LESSON_BULK_MAX_ITEMS:
+            raise ValidationError({"error": f"Не более {settings.LESSON_BULK_MAX_ITEMS} уроков за один запрос."})
+
+        serializer = LessonBulkItemSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        items = serializer.validated_data
+
+        with transaction.atomic():
+            update_ids = [item["id"] for item in items if "id" in item]
+            existing = Lesson.objects.select_for_update().filter(course=course).in_bulk(update_ids) if update_ids else {}
+            errors = [
+                {"id": ["Урок не найден в этом курсе."]} if "id" in item and item["id"] not in existing else {}
+                for item in items
+            ]
+            if any(errors):
+                raise ValidationError(errors)
+
+            created = Lesson.objects.bulk_create(
+                [Lesson(**item, course=course, owner=request.user) for item in items if "id" not in item]
+            )
+            if created:
+                # bulk_create не вызывает сигналы, счетчик обновляется одним запросом
+                Course.objects.filter(pk=course.pk).update(lessons_count=F("lessons_count") + len(created))
+            updated = []
+            for item in items:
+                if "id" in item:
+                    lesson = existing[item["id"]]
+                    for field, value in item.items():
+                        setattr(lesson, field, value)
+                    updated.append(lesson)
+            Lesson.objects.bulk_update(updated, ["title", "description", "video_url"])
+
+        services.invalidate_lessons([lesson.pk for lesson in created + updated], [course.pk])
+        return Response(
+            {"created": [lesson.pk for lesson in created], "updated": [lesson.pk for lesson in updated]},
+            status=status.HTTP_201_CREATED,
+        )
+
+    @action(detail=False, url_path="popular")
+    def popular(self, request):
+        """
+        Самые популярные курсы по рейтингу из Redis: ?by=subscriptions|sales, ?days - скользящее окно в днях
+        (без него - за все время), ?limit - размер выдачи. Курсы выбираются одним запросом.
+        """
+        by = request.query_params.get("by", "subscriptions")
+        if by not in leaderboard.METRICS:
+            raise ValidationError({"by": f"Допустимые значения: {', '.join(leaderboard.METRICS)}."})
+        days = get_bounded_int_param(request, "days", None, settings.LEADERBOARD_MAX_DAYS)
+        limit = get_bounded_int_param(request, "limit", 10, 50)
+
+        ranking = leaderboard.top(by, days=days, limit=limit)
+        courses = Course.objects.only("id", "title", "lessons_count", "subscribers_count").in_bulk(
+            [course_id for course_id, _ in ranking]
+        )
+        results = [
+            self.course_summary(course, score)
+            for course_id, score in ranking
+            if (course := courses.get(course_id)) is not None  # Курс мог быть удален после попадания в рейтинг
+        ]
+        return Response({"results": results})
+
+    @action(detail=True, url_path="similar")
+    def similar(self, request, pk=None):
+        """
+        Похожие курсы по совместным подпискам из заранее рассчитанной таблицы (задача compute_similar_courses):
+        один запрос по индексу (course, -score) вместе с данными курсов.
+        """
+        similar = (
+            SimilarCourse.objects.filter(course_id=pk)
+            .select_related("similar_course")
+            .only("score", *(f"similar_course__{name}" for name in ("id", "title", "lessons_count", "subscribers_count")))
+            .order_by("-score")
+        )
+        results = [self.course_summary(item.similar_course, item.score) for item in similar]
+        if not results and not Course.objects.filter(pk=pk).exists():
+            raise NotFound("Курс не найден.")
+        return Response({"results": results})
+
+    @staticmethod
+    def course_summary(course, score):
+        return {
+            "id": course.id,
+            "title": course.title,
+            "lessons_count": course.lessons_count,
+            "subscribers_count": course.subscribers_count,
+            "score": score,
+        }
+
+    def perform_destroy(self, instance):
+        # Версии кеша меняются после коммита удаления: чтение до коммита не закеширует удаляемый курс под новой версией
+        with transaction.atomic():
+            course_id = instance.pk  # delete() обнуляет pk
+            lesson_ids = list(instance.lessons.values_list("id", flat=True))
+            instance.delete()
+            services.invalidate_course(course_id)
+            services.invalidate_lessons(lesson_ids, [])
 
 
 class CourseSubscriptionViewSet(APIView):
     permission_classes = [IsAuthenticated]
+    throttle_scope = "subscriptions"
 
     def post(self, request, *args, **kwargs):
         user = request.user
@@ -54,20 +269,43 @@ class CourseSubscriptionViewSet(APIView):
         if not course_id:
             return Response({"error": "Не указан id курса."}, status=status.HTTP_400_BAD_REQUEST)
         try:
-            course = Course.objects.get(pk=course_id)
-        except Course.DoesNotExist:
+            course_id = int(course_id)
+        except (TypeError, ValueError):
+            return Response({"error": "Некорректный id курса."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Один атомарный запрос вместо проверки и удаления/создания
+        subscribed = SubscriptionForCourse.toggle(user.pk, course_id)
+        if subscribed is None:
             return Response({"error": "Course does not find."}, status=status.HTTP_404_NOT_FOUND)
 
-        subscription = SubscriptionForCourse.objects.filter(owner=user, course=course)
+        message = "Подписка добавлена" if subscribed else "Подписка удалена"
+        services.invalidate_subscriptions(user.pk)
+        services.invalidate_course(course_id)  # Изменился счетчик подписчиков
+
+        return Response({"message": message}, status=status.HTTP_200_OK)
+
+
+class CourseBulkSubscriptionAPIView(APIView):
+    """
+    Подписка на несколько курсов или отписка от них одним запросом к БД.
+    """
+
+    permission_classes = [IsAuthenticated]
+    throttle_scope = "subscriptions"
+
+    def post(self, request, *args, **kwargs):
+        serializer = BulkSubscriptionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        course_ids = serializer.validated_data["course_ids"]
 
-        if subscription.exists():
-            subscription.delete()
-            message = "Подписка удалена"
+        if serializer.validated_data["action"] == "subscribe":
+            result = {"subscribed": SubscriptionForCourse.subscribe_many(request.user.pk, course_ids)}
         else:
-            SubscriptionForCourse.objects.create(owner=user, course=course)
-            message = "Подписка добавлена"
+            result = {"unsubscribed": SubscriptionForCourse.unsubscribe_many(request.user.pk, course_ids)}
+        services.invalidate_subscriptions(request.user.pk)
+        services.invalidate_courses(next(iter(result.values())))  # Изменились счетчики подписчиков
 
-        return Response({"message": message}, status=status.HTTP_200_OK)
+        return Response(result, status=status.HTTP_200_OK)
 
 
 class LessonCreateAPIView(generics.CreateAPIView):
@@ -82,27 +320,97 @@ class LessonCreateAPIView(generics.CreateAPIView):
                 raise PermissionDenied("Вы не являетесь владельцем этого курса.")
         except Course.DoesNotExist:
             raise NotFound("Курс не найден.")
-        serializer.save(owner=self.request.user, course=course)
+        lesson = serializer.save(owner=self.request.user, course=course)
+        services.invalidate_lessons([lesson.pk], [course.pk])
 
 
-class LessonListAPIView(generics.ListAPIView):
+class LessonListAPIView(SparseFieldsetMixin, generics.ListAPIView):
     queryset = Lesson.objects.all()
     serializer_class = LessonSerializer
     permission_classes = [IsAuthenticated]  # Авторизованные пользователи могут просматривать
+    pagination_class = CustomCursorPaginator
+
+    def get_queryset(self):
+        return self.only_serialized_fields(super().get_queryset(), self.get_serializer_field_names())
+
+    def list(self, request, *args, **kwargs):
+        cache_key = services.lesson_list_cache_key(request)
+        cached = services.get_cached_response(cache_key)
+        if cached is None:
+            response = super().list(request, *args, **kwargs)
+            services.set_cached_response(cache_key, None, response.data)
+            return response
+        return Response(cached[1])
 
 
-class LessonRetrieveAPIView(generics.RetrieveAPIView):
+class LessonRetrieveAPIView(SparseFieldsetMixin, generics.RetrieveAPIView):
     queryset = Lesson.objects.all()
     serializer_class = LessonSerializer
     permission_classes = [IsAuthenticated, IsModeratorOrOwner]
 
+    def get_queryset(self):
+        return self.only_serialized_fields(super().get_queryset(), self.get_serializer_field_names())
+
+    def retrieve(self, request, *args, **kwargs):
+        cache_key = services.lesson_detail_cache_key(kwargs[self.lookup_field], request)
+        cached = services.get_cached_response(cache_key)
+        if cached is None:
+            lesson = self.get_object()
+            data = self.get_serializer(lesson).data
+            services.set_cached_response(cache_key, lesson.owner_id, data)
+            return Response(data)
+
+        owner_id, data = cached
+        self.check_object_permissions(request, Lesson(pk=kwargs[self.lookup_field], owner_id=owner_id))
+        return Response(data)
+
 
 class LessonUpdateAPIView(generics.UpdateAPIView):
     queryset = Lesson.objects.all()
     serializer_class = LessonSerializer
     permission_classes = [IsAuthenticated, IsModeratorOrOwner]
 
+    def perform_update(self, serializer):
+        old_course_id = serializer.instance.course_id
+        lesson = serializer.save()
+        services.invalidate_lessons([lesson.pk], {old_course_id, lesson.course_id})
+
 
 class LessonDeleteAPIView(generics.DestroyAPIView):
     queryset = Lesson.objects.all()
     permission_classes = [IsAuthenticated, IsOwner]  # Только владельцы могут удалять
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            lesson_id = instance.pk  # delete() обнуляет pk
+            instance.delete()
+            services.invalidate_lessons([lesson_id], [instance.course_id])
+
+
+class SearchAPIView(APIView):
+    """
+    Полнотекстовый поиск курсов и уроков: ?q= - текст (слова ищутся как начала слов),
+    ?type=courses|lessons - искать только одно, ?limit= - число результатов каждого вида.
+    Результаты упорядочены по релевантности, каждый вид выбирается одним запросом по GIN-индексу.
+    """
+
+    permission_classes = [IsAuthenticated]
+    search_fields = {
+        "courses": (Course, ("id", "title", "description")),
+        "lessons": (Lesson, ("id", "title", "description", "course_id")),
+    }
+
+    def get(self, request, *args, **kwargs):
+        text = request.query_params.get("q", "").strip()
+        if not search.search_words(text):
+            raise ValidationError({"q": "Укажите текст запроса."})
+        kind = request.query_params.get("type")
+        if kind is not None and kind not in self.search_fields:
+            raise ValidationError({"type": f"Допустимые значения: {', '.join(self.search_fields)}."})
+        limit = get_bounded_int_param(request, "limit", 10, 50)
+
+        results = {}
+        for name, (model, fields) in self.search_fields.items():
+            if kind in (None, name):
+                results[name] = list(search.search(model.objects.all(), text).values(*fields, "rank")[:limit])
+        return Response(results)
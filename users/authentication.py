@@ -0,0 +1,129 @@
+import logging
+
+import redis
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+logger = logging.getLogger(__name__)
+
+
+def user_cache_key(user_id):
+    return f"users:user:{user_id}"
+
+
+def revoked_cache_key(user_id):
+    return f"users:revoked:{user_id}"
+
+
+def forget_user(user_id, restore_access=False):
+    """
+    Сбрасывает закешированную строку пользователя, следующий запрос загрузит ее из БД.
+    restore_access снимает отзыв доступа (повторная активация пользователя).
+    """
+    keys = [user_cache_key(user_id)]
+    if restore_access:
+        keys.append(revoked_cache_key(user_id))
+    try:
+        cache.delete_many(keys)
+    except redis.RedisError as exc:
+        logger.warning(f"Кеш пользователя {user_id} не сброшен: Redis недоступен ({exc})")
+
+
+def revoke_users(user_ids):
+    """
+    Отзывает доступ пользователей: токены с их id отклоняются до истечения срока действия access-токена.
+    Выпустить новый access-токен неактивный пользователь не сможет - это проверяет TokenRefreshView.
+    Права (is_staff, группы) при обновлении токена перечитываются из БД в ClaimsTokenRefreshSerializer.
+    """
+    user_ids = list(user_ids)
+    timeout = int(settings.SIMPLE_JWT["ACCESS_TOKEN_LIFETIME"].total_seconds())
+    try:
+        cache.set_many({revoked_cache_key(user_id): True for user_id in user_ids}, timeout)
+        cache.delete_many([user_cache_key(user_id) for user_id in user_ids])
+    except redis.RedisError as exc:
+        # Без кеша запросы записи все равно проверяют активность по БД
+        logger.warning(f"Отзыв доступа {len(user_ids)} пользователей не записан: Redis недоступен ({exc})")
+
+
+class ClaimsTokenUser(TokenUser):
+    """
+    Пользователь, собранный из подписанных claims access-токена, без обращения к БД.
+    """
+
+    @cached_property
+    def id(self):
+        # SimpleJWT хранит id строкой, приводим к типу первичного ключа для сравнения с owner_id
+        return get_user_model()._meta.pk.to_python(self.token[api_settings.USER_ID_CLAIM])
+
+    @cached_property
+    def email(self):
+        return self.token.get("email", "")
+
+    @cached_property
+    def group_names(self):
+        return frozenset(self.token.get("groups", ()))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWT-аутентификация без запроса пользователя к БД.
+    Для безопасных методов (GET, HEAD, OPTIONS) пользователь строится из claims токена (id, email, is_staff, groups),
+    для остальных загружается полная модель через кеш с коротким TTL. Отзыв доступа проверяется по ключу в кеше.
+    Без Redis аутентификация продолжает работать: пользователь загружается из БД, ключ отзыва не проверяется.
+    """
+
+    def authenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        validated_token = self.get_validated_token(raw_token)
+        # Токены, выпущенные без claims, обрабатываются как раньше
+        if request.method in SAFE_METHODS and "groups" in validated_token:
+            return self.get_token_user(validated_token), validated_token
+        return self.get_user(validated_token), validated_token
+
+    def get_user_id(self, validated_token):
+        try:
+            return validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_("Token contained no recognizable user identification")) from e
+
+    def get_token_user(self, validated_token):
+        user_id = self.get_user_id(validated_token)
+        try:
+            revoked = cache.get(revoked_cache_key(user_id))
+        except redis.RedisError as exc:
+            logger.warning(f"Отзыв доступа не проверен: Redis недоступен ({exc})")
+            revoked = False
+        if revoked:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        return ClaimsTokenUser(validated_token)
+
+    def get_user(self, validated_token):
+        key = user_cache_key(self.get_user_id(validated_token))
+        try:
+            user = cache.get(key)
+        except redis.RedisError as exc:
+            logger.warning(f"Пользователь загружается из БД: Redis недоступен ({exc})")
+            return super().get_user(validated_token)
+        if user is None:
+            # Проверки существования и активности выполняет SimpleJWT
+            user = super().get_user(validated_token)
+            try:
+                cache.set(key, user, settings.AUTH_USER_CACHE_TIMEOUT)
+            except redis.RedisError as exc:
+                logger.warning(f"Пользователь не закеширован: Redis недоступен ({exc})")
+        return user
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from lms.tasks import deactivate_inactive_users
+
+
+class Command(BaseCommand):
+    help = "Deactivate users who have not logged in for more than a month"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Только отчет, без изменений")
+        parser.add_argument("--batch-size", type=int, default=None, help="Пользователей в одной пачке")
+        parser.add_argument("--pause", type=float, default=None, help="Пауза между пачками, секунды")
+
+    def handle(self, *args, **options):
+        result = deactivate_inactive_users(
+            dry_run=options["dry_run"], batch_size=options["batch_size"], pause=options["pause"]
+        )
+        self.stdout.write(self.style.SUCCESS(result))
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lms", "0005_alter_course_description"),
+        ("users", "0005_remove_payment_status_payment_is_paid_and_more"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(fields=["-date", "-id"], name="payment_date_id_idx"),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("users", "0006_payment_date_id_idx"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="customuser",
+            index=models.Index(
+                condition=models.Q(("is_active", True)), fields=["last_login", "id"], name="user_active_last_login_idx"
+            ),
+        ),
+    ]
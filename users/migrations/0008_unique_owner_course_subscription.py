@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:34
+
+from django.db import migrations, models
+
+
+def remove_duplicate_subscriptions(apps, schema_editor):
+    """
+    Перед добавлением уникального ограничения оставляем по одной (самой ранней) подписке на пару пользователь-курс.
+    """
+    SubscriptionForCourse = apps.get_model("users", "SubscriptionForCourse")
+    table = SubscriptionForCourse._meta.db_table
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"""
+            DELETE FROM {table} duplicate USING {table} original
+            WHERE duplicate.owner_id = original.owner_id
+              AND duplicate.course_id = original.course_id
+              AND duplicate.id > original.id
+            """)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lms", "0006_outboxmessage"),
+        ("users", "0007_user_active_last_login_idx"),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_subscriptions, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="subscriptionforcourse",
+            constraint=models.UniqueConstraint(fields=("owner", "course"), name="unique_owner_course_subscription"),
+        ),
+    ]
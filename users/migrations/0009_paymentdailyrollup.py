@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lms", "0006_outboxmessage"),
+        ("users", "0008_unique_owner_course_subscription"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PaymentDailyRollup",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("day", models.DateField(verbose_name="День")),
+                (
+                    "payment_method",
+                    models.CharField(
+                        choices=[("cash", "Наличные"), ("transfer", "Перевод на счет"), ("stripe", "Stripe")], max_length=10
+                    ),
+                ),
+                ("amount_total", models.PositiveBigIntegerField(default=0, verbose_name="Сумма")),
+                ("payments_count", models.PositiveIntegerField(default=0, verbose_name="Количество платежей")),
+                (
+                    "course",
+                    models.ForeignKey(
+                        blank=True,
+                        db_constraint=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        to="lms.course",
+                    ),
+                ),
+                (
+                    "lesson",
+                    models.ForeignKey(
+                        blank=True,
+                        db_constraint=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        to="lms.lesson",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Сводка выручки за день",
+                "verbose_name_plural": "Сводки выручки за день",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("day", "course", "lesson", "payment_method"),
+                        name="unique_payment_rollup",
+                        nulls_distinct=False,
+                    )
+                ],
+            },
+        ),
+    ]
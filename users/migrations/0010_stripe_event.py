@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0009_paymentdailyrollup"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StripeEvent",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("event_id", models.CharField(max_length=255, unique=True)),
+                ("type", models.CharField(max_length=255)),
+                ("received_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "verbose_name": "Событие Stripe",
+                "verbose_name_plural": "События Stripe",
+            },
+        ),
+        migrations.AlterField(
+            model_name="payment",
+            name="session_id",
+            field=models.CharField(
+                blank=True, db_index=True, help_text="Укажите ID сессии", max_length=255, null=True, verbose_name="ID сессии"
+            ),
+        ),
+    ]
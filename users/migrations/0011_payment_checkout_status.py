@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:57
+
+from django.db import migrations, models
+
+
+def mark_existing_checkouts(apps, schema_editor):
+    """Платежи, созданные синхронно до появления статуса, уже имеют сессию Stripe"""
+    Payment = apps.get_model("users", "Payment")
+    Payment.objects.filter(session_id__isnull=False).update(checkout_status="created")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0010_stripe_event"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="payment",
+            name="checkout_error",
+            field=models.TextField(blank=True, default="", verbose_name="Ошибка создания оплаты"),
+        ),
+        migrations.AddField(
+            model_name="payment",
+            name="checkout_status",
+            field=models.CharField(
+                blank=True,
+                choices=[("pending", "Создается"), ("created", "Создана"), ("failed", "Ошибка")],
+                default="",
+                max_length=10,
+                verbose_name="Статус создания оплаты",
+            ),
+        ),
+        migrations.RunPython(mark_existing_checkouts, migrations.RunPython.noop),
+    ]
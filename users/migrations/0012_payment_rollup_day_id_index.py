@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lms", "0011_course_counter_keyset_indexes"),
+        ("users", "0011_payment_checkout_status"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="paymentdailyrollup",
+            index=models.Index(fields=["-day", "-id"], name="payment_rollup_day_id_idx"),
+        ),
+    ]
@@ -1,11 +1,14 @@
 from venv import logger
 
 import stripe
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.db import models
-from django.urls import reverse
+from django.db import connection, models, transaction
+from django.utils import timezone
 
+from lms import leaderboard
 from lms.models import Course, Lesson
+from users import services
 
 
 class CustomUser(AbstractUser):
@@ -17,6 +20,12 @@ class CustomUser(AbstractUser):
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = ["username"]
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Поиск давно не заходивших активных пользователей (deactivate_inactive_users)
+            models.Index(fields=["last_login", "id"], condition=models.Q(is_active=True), name="user_active_last_login_idx"),
+        ]
+
 
 class Payment(models.Model):
     PAYMENT_METHODS = [
@@ -24,6 +33,11 @@ class Payment(models.Model):
         ("transfer", "Перевод на счет"),
         ("stripe", "Stripe"),
     ]
+    CHECKOUT_STATUSES = [
+        ("pending", "Создается"),
+        ("created", "Создана"),
+        ("failed", "Ошибка"),
+    ]
 
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True, blank=True, verbose_name="Пользователь")
     date = models.DateTimeField(auto_now_add=True)
@@ -32,7 +46,7 @@ class Payment(models.Model):
     amount = models.PositiveIntegerField(verbose_name="Сумма платежа", help_text="Укажите сумму платежа")
     payment_method = models.CharField(max_length=10, choices=PAYMENT_METHODS)
     session_id = models.CharField(
-        max_length=255, blank=True, null=True, verbose_name="ID сессии", help_text="Укажите ID сессии"
+        max_length=255, blank=True, null=True, db_index=True, verbose_name="ID сессии", help_text="Укажите ID сессии"
     )
     link = models.URLField(
         max_length=400, blank=True, null=True, verbose_name="Ссылка на оплату", help_text="Укажите ссылку на оплату"
@@ -40,69 +54,101 @@ class Payment(models.Model):
     stripe_product_id = models.CharField(max_length=255, blank=True, null=True)
     stripe_price_id = models.CharField(max_length=255, blank=True, null=True)
     is_paid = models.BooleanField(default=False, verbose_name="Оплачено")
+    checkout_status = models.CharField(
+        max_length=10, choices=CHECKOUT_STATUSES, blank=True, default="", verbose_name="Статус создания оплаты"
+    )
+    checkout_error = models.TextField(blank=True, default="", verbose_name="Ошибка создания оплаты")
 
     def __str__(self):
         return f"{self.user} - {self.amount} ({self.payment_method})"
 
-    def create_stripe_payment(self, request):
-        """Создание платежа в Stripe"""
-        if not self.course and not self.lesson:
-            raise ValueError("Платеж должен быть привязан к курсу или уроку")
+    def mark_paid(self):
+        """
+        Отмечает платеж оплаченным и учитывает его в дневной сводке выручки.
+        Условное обновление делает вызов идемпотентным: повторный вызов (успешная оплата, вебхук) ничего не меняет.
+        Возвращает True, если платеж был отмечен этим вызовом.
+        """
+        with transaction.atomic():
+            marked = Payment.objects.filter(pk=self.pk, is_paid=False).update(is_paid=True)
+            if marked:
+                PaymentDailyRollup.add(self)
+                leaderboard.record("sales", Payment.sales_by_course([self]))
+        self.is_paid = True
+        return bool(marked)
 
-        # Определяем название и описание продукта
-        if self.course:
-            product_name = self.course.title
-            product_description = self.course.description or "Оплата курса"
-        else:
-            product_name = self.lesson.title
-            product_description = self.lesson.description or "Оплата урока"
+    @classmethod
+    def mark_paid_many(cls, payment_ids):
+        """
+        Отмечает оплаченными несколько платежей одной транзакцией и учитывает их в сводке выручки.
+        Уже оплаченные платежи пропускаются. Возвращает число отмеченных платежей.
+        """
+        with transaction.atomic():
+            payments = list(cls.objects.select_for_update().filter(id__in=payment_ids, is_paid=False))
+            cls.objects.filter(id__in=[payment.id for payment in payments]).update(is_paid=True)
+            for payment in payments:
+                PaymentDailyRollup.add(payment)
+            leaderboard.record("sales", cls.sales_by_course(payments))
+        return len(payments)
 
-        try:
-            # Создаем продукт в Stripe
-            product = stripe.Product.create(
-                name=product_name,
-                description=product_description,
+    @staticmethod
+    def sales_by_course(payments):
+        """Число продаж по (курс, день платежа): оплата урока засчитывается его курсу"""
+        lesson_courses = dict(
+            Lesson.objects.filter(id__in={payment.lesson_id for payment in payments if not payment.course_id}).values_list(
+                "id", "course_id"
             )
-            self.stripe_product_id = product.id
+        )
+        sales = {}
+        for payment in payments:
+            key = (payment.course_id or lesson_courses.get(payment.lesson_id), timezone.localdate(payment.date))
+            sales[key] = sales.get(key, 0) + 1
+        return sales
 
-            # Создаем цену (умножаем на 100 для перевода в копейки/центы)
-            price = stripe.Price.create(
-                product=self.stripe_product_id,
-                unit_amount=int(self.amount * 100),
-                currency="rub",
-            )
-            self.stripe_price_id = price.id
-
-            # Создаем URL для редиректа после оплаты
-            success_url = request.build_absolute_uri(reverse("users:payment_success", kwargs={"pk": self.pk}))
-            cancel_url = request.build_absolute_uri(reverse("users:payment_cancel", kwargs={"pk": self.pk}))
-
-            # Создаем сессию оплаты
-            session = stripe.checkout.Session.create(
-                payment_method_types=["card"],
-                line_items=[
-                    {
-                        "price": self.stripe_price_id,
-                        "quantity": int(1),
-                    }
-                ],
-                mode="payment",
+    def create_stripe_payment(self, success_url, cancel_url):
+        """
+        Создание сессии оплаты в Stripe (вызывается задачей create_checkout_session).
+        Продукт и цена переиспользуются, поэтому обычно нужен один вызов Stripe. Платеж сохраняется один раз.
+        """
+        item = self.course or self.lesson
+        if item is None:
+            raise ValueError("Платеж должен быть привязан к курсу или уроку")
+
+        try:
+            self.stripe_price_id = services.get_stripe_price_id(item, self.amount)
+            self.stripe_product_id = item.stripe_product_id
+
+            # Создаем сессию оплаты. Ключ идемпотентности защищает от второй сессии при повторе задачи
+            session = services.create_stripe_session(
+                self.stripe_price_id,
                 success_url=success_url,
                 cancel_url=cancel_url,
                 customer_email=self.user.email if self.user else None,
                 metadata={
                     "payment_id": str(self.id),
                 },
+                idempotency_key=f"checkout:{self.pk}",
             )
 
             # Сохраняем данные сессии
-            self.session_id = session.id
-            self.link = session.url
+            self.session_id = session["session_id"]
+            self.link = session["payment_link"]
             self.payment_method = "stripe"
-            self.save()
+            self.checkout_status = "created"
+            self.save(
+                update_fields=[
+                    "stripe_price_id",
+                    "stripe_product_id",
+                    "session_id",
+                    "link",
+                    "payment_method",
+                    "checkout_status",
+                ]
+            )
 
             return self.link, self.session_id
 
+        except (stripe.error.APIConnectionError, stripe.error.RateLimitError):
+            raise  # Временные ошибки повторяет задача
         except stripe.error.StripeError as e:
             # Логируем ошибку Stripe
             logger.error(f"Stripe error: {e}")
@@ -111,6 +157,106 @@ class Payment(models.Model):
     class Meta:
         verbose_name = "Платеж"
         verbose_name_plural = "Платежи"
+        indexes = [
+            models.Index(fields=["-date", "-id"], name="payment_date_id_idx"),  # Keyset-пагинация по (date, id)
+        ]
+
+
+class StripeEvent(models.Model):
+    """
+    Принятое событие вебхука Stripe. Уникальный event_id отсекает повторные доставки одного события.
+    """
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=255)
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.event_id} ({self.type})"
+
+    class Meta:
+        verbose_name = "Событие Stripe"
+        verbose_name_plural = "События Stripe"
+
+
+class PaymentDailyRollup(models.Model):
+    """
+    Дневная сводка оплаченных платежей по (день, курс, урок, способ оплаты).
+    Пополняется в Payment.mark_paid, пересобирается задачей rebuild_payment_rollups.
+    """
+
+    day = models.DateField(verbose_name="День")
+    # Без внешнего ключа в БД: при удалении курса или урока история выручки сохраняется под прежним id
+    course = models.ForeignKey(Course, on_delete=models.DO_NOTHING, db_constraint=False, null=True, blank=True)
+    lesson = models.ForeignKey(Lesson, on_delete=models.DO_NOTHING, db_constraint=False, null=True, blank=True)
+    payment_method = models.CharField(max_length=10, choices=Payment.PAYMENT_METHODS)
+    amount_total = models.PositiveBigIntegerField(default=0, verbose_name="Сумма")
+    payments_count = models.PositiveIntegerField(default=0, verbose_name="Количество платежей")
+
+    def __str__(self):
+        return f"{self.day} - {self.course_id}/{self.lesson_id} ({self.payment_method}): {self.amount_total}"
+
+    @classmethod
+    def add(cls, payment):
+        """
+        Прибавляет оплаченный платеж к сводке его дня одним запросом (upsert).
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {cls._meta.db_table} (day, course_id, lesson_id, payment_method, amount_total, payments_count)
+                VALUES (%s, %s, %s, %s, %s, 1)
+                ON CONFLICT (day, course_id, lesson_id, payment_method) DO UPDATE
+                SET amount_total = {cls._meta.db_table}.amount_total + EXCLUDED.amount_total,
+                    payments_count = {cls._meta.db_table}.payments_count + 1
+                """,
+                [
+                    timezone.localdate(payment.date),
+                    payment.course_id,
+                    payment.lesson_id,
+                    payment.payment_method,
+                    payment.amount,
+                ],
+            )
+
+    @classmethod
+    def rebuild(cls, since=None):
+        """
+        Пересобирает сводку по оплаченным платежам начиная с дня since (все дни, если не указан).
+        Таблица блокируется от одновременных add, поэтому платежи, оплаченные во время пересборки, не теряются
+        и не учитываются дважды. Возвращает число строк сводки.
+        """
+        table = cls._meta.db_table
+        day = "(date AT TIME ZONE %s)::date"
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+            if since is None:
+                cursor.execute(f"DELETE FROM {table}")
+            else:
+                cursor.execute(f"DELETE FROM {table} WHERE day >= %s", [since])
+            cursor.execute(
+                f"""
+                INSERT INTO {table} (day, course_id, lesson_id, payment_method, amount_total, payments_count)
+                SELECT {day}, course_id, lesson_id, payment_method, SUM(amount), COUNT(*)
+                FROM {Payment._meta.db_table}
+                WHERE is_paid AND (%s::date IS NULL OR {day} >= %s::date)
+                GROUP BY 1, 2, 3, 4
+                """,
+                [settings.TIME_ZONE, since, settings.TIME_ZONE, since],
+            )
+            return cursor.rowcount
+
+    class Meta:
+        verbose_name = "Сводка выручки за день"
+        verbose_name_plural = "Сводки выручки за день"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["day", "course", "lesson", "payment_method"], name="unique_payment_rollup", nulls_distinct=False
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["-day", "-id"], name="payment_rollup_day_id_idx"),  # Keyset-пагинация по (day, id)
+        ]
 
 
 class SubscriptionForCourse(models.Model):
@@ -121,7 +267,108 @@ class SubscriptionForCourse(models.Model):
     def __str__(self):
         return f"{self.owner} - {self.course} - {self.created_at}"
 
+    @classmethod
+    def toggle(cls, owner_id, course_id):
+        """
+        Переключает подписку одним атомарным запросом: удаляет существующую, иначе создает новую,
+        и в том же запросе меняет счетчик подписчиков курса.
+        Возвращает True - подписка добавлена, False - удалена, None - курс не найден.
+        """
+        table = cls._meta.db_table
+        course_table = Course._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH deleted AS (
+                    DELETE FROM {table} WHERE owner_id = %(owner)s AND course_id = %(course)s RETURNING id, created_at
+                ), inserted AS (
+                    INSERT INTO {table} (owner_id, course_id, created_at)
+                    SELECT %(owner)s, id, %(now)s FROM {course_table}
+                    WHERE id = %(course)s AND NOT EXISTS (SELECT 1 FROM deleted)
+                    ON CONFLICT (owner_id, course_id) DO NOTHING
+                    RETURNING id, created_at
+                ), counted AS (
+                    UPDATE {course_table}
+                    SET subscribers_count = GREATEST(
+                        subscribers_count + (SELECT COUNT(*) FROM inserted) - (SELECT COUNT(*) FROM deleted), 0
+                    )
+                    WHERE id = %(course)s AND (EXISTS (SELECT 1 FROM inserted) OR EXISTS (SELECT 1 FROM deleted))
+                )
+                SELECT
+                    (SELECT created_at FROM deleted),
+                    (SELECT created_at FROM inserted),
+                    EXISTS (SELECT 1 FROM {course_table} WHERE id = %(course)s)
+                """,
+                {"owner": owner_id, "course": course_id, "now": timezone.now()},
+            )
+            deleted, inserted, course_exists = cursor.fetchone()  # Даты создания удаленной и добавленной подписок
+        if deleted:
+            leaderboard.record("subscriptions", {(course_id, timezone.localdate(deleted)): -1})
+            return False
+        if inserted:
+            leaderboard.record("subscriptions", {(course_id, timezone.localdate(inserted)): 1})
+            return True
+        # Параллельный запрос успел добавить ту же подписку (ON CONFLICT DO NOTHING): она уже есть, счет не меняется
+        return True if course_exists else None
+
+    @classmethod
+    def subscribe_many(cls, owner_id, course_ids):
+        """
+        Подписывает на несколько курсов одним запросом (вместе со счетчиками подписчиков).
+        Несуществующие курсы и имеющиеся подписки пропускаются. Возвращает id курсов, на которые подписка добавлена.
+        """
+        course_table = Course._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH inserted AS (
+                    INSERT INTO {cls._meta.db_table} (owner_id, course_id, created_at)
+                    SELECT %s, id, %s FROM {course_table} WHERE id = ANY(%s)
+                    ON CONFLICT (owner_id, course_id) DO NOTHING
+                    RETURNING course_id, created_at
+                ), counted AS (
+                    UPDATE {course_table} SET subscribers_count = subscribers_count + 1
+                    WHERE id IN (SELECT course_id FROM inserted)
+                )
+                SELECT course_id, created_at FROM inserted
+                """,
+                [owner_id, timezone.now(), list(course_ids)],
+            )
+            rows = cursor.fetchall()
+        leaderboard.record("subscriptions", {(course_id, timezone.localdate(created_at)): 1 for course_id, created_at in rows})
+        return [course_id for course_id, _ in rows]
+
+    @classmethod
+    def unsubscribe_many(cls, owner_id, course_ids):
+        """
+        Удаляет подписки на несколько курсов одним запросом (вместе со счетчиками подписчиков).
+        Возвращает id курсов, подписка на которые удалена.
+        """
+        course_table = Course._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH deleted AS (
+                    DELETE FROM {cls._meta.db_table} WHERE owner_id = %s AND course_id = ANY(%s)
+                    RETURNING course_id, created_at
+                ), counted AS (
+                    UPDATE {course_table} SET subscribers_count = GREATEST(subscribers_count - 1, 0)
+                    WHERE id IN (SELECT course_id FROM deleted)
+                )
+                SELECT course_id, created_at FROM deleted
+                """,
+                [owner_id, list(course_ids)],
+            )
+            rows = cursor.fetchall()
+        leaderboard.record(
+            "subscriptions", {(course_id, timezone.localdate(created_at)): -1 for course_id, created_at in rows}
+        )
+        return [course_id for course_id, _ in rows]
+
     class Meta:
         verbose_name = "Подписка"
         verbose_name_plural = "Подписки"
         ordering = ["created_at", "owner", "course"]
+        constraints = [
+            models.UniqueConstraint(fields=["owner", "course"], name="unique_owner_course_subscription"),
+        ]
@@ -1,4 +1,27 @@
 from rest_framework import permissions
+from rest_framework.filters import BaseFilterBackend
+
+
+def get_group_names(request):
+    """
+    Названия групп текущего пользователя. Загружаются одним запросом и запоминаются на запросе,
+    поэтому повторные проверки прав (например, по каждому объекту списка) не обращаются к БД.
+    """
+    group_names = getattr(request, "_group_names", None)
+    if group_names is None:
+        user = request.user
+        if hasattr(user, "group_names"):  # Группы из claims JWT-токена
+            group_names = user.group_names
+        elif not user.is_authenticated:
+            group_names = frozenset()
+        else:
+            group_names = frozenset(user.groups.values_list("name", flat=True))
+        request._group_names = group_names
+    return group_names
+
+
+def is_moderator(request):
+    return "moderator" in get_group_names(request)
 
 
 class IsModerator(permissions.BasePermission):
@@ -6,7 +29,13 @@ class IsModerator(permissions.BasePermission):
         """
         Проверяет доступ к конкретному объекту.
         """
-        return request.user.groups.filter(name="moderator").exists()
+        return is_moderator(request)
+
+    def filter_queryset(self, request, queryset, view):
+        """
+        Ограничивает выборку на уровне SQL: модератор видит все, остальные - ничего.
+        """
+        return queryset if is_moderator(request) else queryset.none()
 
 
 class IsOwner(permissions.BasePermission):
@@ -14,9 +43,33 @@ class IsOwner(permissions.BasePermission):
         """
         Проверяет право доступа к конкретному объекту
         """
-        return obj.owner == request.user
+        # Сравнение по id не загружает владельца из БД
+        return obj.owner_id == request.user.pk
+
+    def filter_queryset(self, request, queryset, view):
+        return queryset.filter(owner=request.user.pk)
 
 
 class IsModeratorOrOwner(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
-        return request.user.is_staff or obj.owner == request.user
+        return request.user.is_staff or obj.owner_id == request.user.pk
+
+    def filter_queryset(self, request, queryset, view):
+        return queryset if request.user.is_staff else queryset.filter(owner=request.user.pk)
+
+
+class PermissionFilterBackend(BaseFilterBackend):
+    """
+    Для списков применяет filter_queryset разрешений представления: недоступные объекты отсекаются
+    в SQL, а не проверкой каждого объекта. На запросы конкретного объекта не влияет,
+    чтобы для них сохранялся ответ 403, а не 404.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        lookup_url_kwarg = getattr(view, "lookup_url_kwarg", None) or getattr(view, "lookup_field", "pk")
+        if lookup_url_kwarg in view.kwargs:
+            return queryset
+        for permission in view.get_permissions():
+            if hasattr(permission, "filter_queryset"):
+                queryset = permission.filter_queryset(request, queryset, view)
+        return queryset
@@ -1,7 +1,11 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
 
-from users.models import CustomUser, Payment
+from users.models import CustomUser, Payment, PaymentDailyRollup
 
 User = get_user_model()  # получает пользовательскую модель
 
@@ -10,6 +14,7 @@ class PaymentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Payment
         fields = "__all__"
+        read_only_fields = ("checkout_status", "checkout_error")
 
     def validate(self, data):
         """Проверяем, что указан либо курс, либо урок"""
@@ -18,13 +23,32 @@ class PaymentSerializer(serializers.ModelSerializer):
         return data
 
 
+class PaymentDailyRollupSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PaymentDailyRollup
+        fields = ("day", "course", "lesson", "payment_method", "amount_total", "payments_count")
+
+
 class UserSerializer(serializers.ModelSerializer):
-    payments = PaymentSerializer(many=True, read_only=True, source="payment_set")
+    payments = serializers.SerializerMethodField()
 
     class Meta:
         model = CustomUser
         fields = ["id", "username", "email", "phone", "city", "avatar", "payments"]
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Платежи встраиваются только по запросу ?expand=payments
+        if "payments" not in self.context.get("expand", ()):
+            self.fields.pop("payments")
+
+    def get_payments(self, obj):
+        # Последние платежи подгружает UserExpandMixin, иначе (например, после create) - отдельный запрос
+        payments = getattr(obj, "recent_payments", None)
+        if payments is None:
+            payments = obj.payment_set.order_by("-date", "-id")[: settings.USER_PAYMENTS_EXPAND_LIMIT]
+        return PaymentSerializer(payments, many=True).data
+
 
 class RegisterSerializer(serializers.ModelSerializer):  # Сериализатор для создания новых пользователей.
     password = serializers.CharField(write_only=True)
@@ -42,3 +66,35 @@ class RegisterSerializer(serializers.ModelSerializer):  # Сериализато
             username=validated_data["username"], email=validated_data["email"], password=validated_data["password"]
         )
         return user
+
+
+def add_user_claims(token, user):
+    """Claims, по которым CachedJWTAuthentication собирает пользователя без запроса к БД"""
+    token["email"] = user.email
+    token["is_staff"] = user.is_staff
+    token["groups"] = list(user.groups.values_list("name", flat=True))
+    return token
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """
+    Добавляет в токены claims, по которым CachedJWTAuthentication собирает пользователя без запроса к БД.
+    """
+
+    @classmethod
+    def get_token(cls, user):
+        return add_user_claims(super().get_token(user), user)
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    Выпускает access-токен с claims, прочитанными из БД заново, а не скопированными из refresh-токена:
+    снятые права администратора или группы перестают действовать не позже чем через ACCESS_TOKEN_LIFETIME.
+    """
+
+    def validate(self, attrs):
+        data = super().validate(attrs)
+        access = AccessToken(data["access"])
+        user = User.objects.get(**{api_settings.USER_ID_FIELD: access[api_settings.USER_ID_CLAIM]})
+        data["access"] = str(add_user_claims(access, user))
+        return data
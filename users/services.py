@@ -1,30 +1,57 @@
+import hashlib
+import json
+
 import stripe
 from django.conf import settings
+from django.core.cache import cache
+
+from lms.models import StripePrice
 
 stripe.api_key = settings.STRIPE_API_KEY
 
 
-def create_stripe_product(course):
-    """Создание продукта в Stripe"""
+def get_stripe_product_id(item):
+    """
+    Продукт Stripe для курса или урока. Создается один раз и сохраняется в item.stripe_product_id.
+    Ключ идемпотентности не дает одновременным оплатам создать дубликаты продукта.
+    """
+    if item.stripe_product_id:
+        return item.stripe_product_id
+
+    model = type(item)
     product = stripe.Product.create(
-        name=course.title,
-        description=course.description,
+        name=item.title,
+        description=item.description or f"Оплата: {model._meta.verbose_name}",
+        idempotency_key=f"product:{model._meta.model_name}:{item.pk}",
     )
-    return product.id
+    if not model.objects.filter(pk=item.pk, stripe_product_id__isnull=True).update(stripe_product_id=product.id):
+        # Продукт уже сохранил параллельный запрос
+        product.id = model.objects.values_list("stripe_product_id", flat=True).get(pk=item.pk)
+    item.stripe_product_id = product.id
+    return item.stripe_product_id
 
 
-def create_stripe_price(product_id, amount):
-    """Создание цены в Stripe"""
+def get_stripe_price_id(item, amount):
+    """
+    Цена Stripe для курса или урока с суммой amount (в рублях). Создается один раз на пару (item, amount).
+    """
+    lookup = {item._meta.model_name: item, "amount": amount}
+    price_id = StripePrice.objects.filter(**lookup).values_list("price_id", flat=True).first()
+    if price_id:
+        return price_id
+
     price = stripe.Price.create(
-        product=product_id,
-        unit_amount=amount * 100,
+        product=get_stripe_product_id(item),
+        unit_amount=amount * 100,  # В копейках
         currency="rub",
+        idempotency_key=f"price:{item._meta.model_name}:{item.pk}:{amount}",
     )
-    return price.id
+    stripe_price, _ = StripePrice.objects.get_or_create(**lookup, defaults={"price_id": price.id})
+    return stripe_price.price_id
 
 
-def create_stripe_session(price_id):
-    """Создание сессии оплаты в Stripe"""
+def create_stripe_session(price_id, success_url="http://127.0.0.1:8000/", **kwargs):
+    """Создание сессии оплаты в Stripe, единственный вызов Stripe при оплате (цена берется из кеша)"""
     session = stripe.checkout.Session.create(
         payment_method_types=["card"],
         line_items=[
@@ -34,6 +61,38 @@ def create_stripe_session(price_id):
             }
         ],
         mode="payment",
-        success_url="http://127.0.0.1:8000/",
+        success_url=success_url,
+        **kwargs,
     )
     return {"session_id": session.id, "payment_link": session.url}
+
+
+def idempotency_cache_key(user_id, key):
+    """Ключ сохраненного ответа для заголовка Idempotency-Key (ключи разных пользователей не пересекаются)"""
+    return f"users:idempotency:{user_id}:{hashlib.md5(key.encode()).hexdigest()}"
+
+
+def request_fingerprint(data):
+    """Отпечаток тела запроса: повтор с тем же ключом, но другим телом - ошибка клиента"""
+    return hashlib.md5(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_idempotent_response(cache_key):
+    return cache.get(cache_key)
+
+
+def set_idempotent_response(cache_key, fingerprint, response):
+    cache.set(
+        cache_key,
+        {"fingerprint": fingerprint, "status": response.status_code, "data": response.data},
+        settings.IDEMPOTENCY_KEY_TIMEOUT,
+    )
+
+
+def acquire_idempotency_lock(cache_key):
+    """Короткая блокировка на время первого запроса; cache.add атомарен, второй одновременный запрос ее не получит"""
+    return cache.add(f"{cache_key}:lock", True, settings.IDEMPOTENCY_LOCK_TIMEOUT)
+
+
+def release_idempotency_lock(cache_key):
+    cache.delete(f"{cache_key}:lock")
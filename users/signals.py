@@ -0,0 +1,38 @@
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from lms.models import Course
+from users.authentication import forget_user, revoke_users
+from users.models import CustomUser, SubscriptionForCourse
+
+
+@receiver(post_save, sender=CustomUser)
+def refresh_cached_user(sender, instance, **kwargs):
+    """
+    Изменение пользователя сбрасывает его кеш, деактивация сразу отзывает доступ по токенам,
+    повторная активация снимает отзыв.
+    """
+    if instance.is_active:
+        forget_user(instance.pk, restore_access=True)
+    else:
+        revoke_users([instance.pk])
+
+
+@receiver(post_delete, sender=CustomUser)
+def revoke_deleted_user(sender, instance, **kwargs):
+    revoke_users([instance.pk])
+
+
+@receiver(post_save, sender=SubscriptionForCourse)
+def count_created_subscription(sender, instance, created, **kwargs):
+    # Массовые пути (toggle, subscribe_many, unsubscribe_many) обновляют счетчик в своем SQL
+    if created and instance.course_id:
+        Course.objects.filter(pk=instance.course_id).update(subscribers_count=F("subscribers_count") + 1)
+
+
+@receiver(post_delete, sender=SubscriptionForCourse)
+def count_deleted_subscription(sender, instance, **kwargs):
+    if instance.course_id:
+        Course.objects.filter(pk=instance.course_id).update(subscribers_count=Greatest(F("subscribers_count") - 1, 0))
@@ -1,2 +1,824 @@
-from rest_framework import status
-from rest_framework.test import APITestCase
+import csv
+import hashlib
+import hmac
+import json
+import time
+from datetime import timedelta
+from unittest import mock
+
+import redis
+import stripe
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import generics, status
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from config import redis_client
+from config.celery import app as celery_app
+from lms.models import Course, Lesson, OutboxMessage, StripePrice
+from lms.tasks import (
+    RECONCILE_METRICS_KEY,
+    create_checkout_session,
+    deactivate_inactive_users,
+    process_checkout_session,
+    rebuild_payment_rollups,
+    reconcile_pending_payments,
+)
+from users import authentication, services, throttling
+from users.models import Payment, PaymentDailyRollup, StripeEvent
+from users.permissions import IsModerator, IsModeratorOrOwner, IsOwner, PermissionFilterBackend
+
+User = get_user_model()
+
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def run_outbox():
+    """
+    Выполняет сообщения outbox синхронно, как это сделали бы ретранслятор и воркер.
+    Повтор задачи в этом режиме выполняется сразу внутри apply().
+    """
+    for message in OutboxMessage.objects.order_by("id"):
+        celery_app.tasks[message.task_name].apply(args=message.args, kwargs=message.kwargs).get()
+        message.delete()
+
+
+class FakeStripe:
+    """
+    Локальная замена Stripe для тестов: подменяет вызовы SDK, запоминает их и соблюдает ключи идемпотентности.
+    Созданные сессии оплаты хранятся и отдаются списком Session.list.
+    """
+
+    def __init__(self, test_case):
+        self.calls = []
+        self.objects = {}
+        self.sessions = {}
+        patcher = mock.patch("stripe.checkout.Session.list", side_effect=self.list_sessions)
+        patcher.start()
+        test_case.addCleanup(patcher.stop)
+        for target, prefix in [
+            ("stripe.Product.create", "prod"),
+            ("stripe.Price.create", "price"),
+            ("stripe.checkout.Session.create", "cs"),
+        ]:
+            patcher = mock.patch(target, side_effect=self.create_handler(prefix))
+            patcher.start()
+            test_case.addCleanup(patcher.stop)
+
+    def create_handler(self, prefix):
+        def create(idempotency_key=None, **params):
+            self.calls.append((prefix, params))
+            if idempotency_key in self.objects:
+                return self.objects[idempotency_key]
+            number = len(self.calls)
+            obj = mock.Mock(id=f"{prefix}_{number}", url=f"https://checkout.stripe.test/{number}", **params)
+            if idempotency_key:
+                self.objects[idempotency_key] = obj
+            if prefix == "cs":
+                obj.configure_mock(payment_status="unpaid", status="open", created=int(time.time()))
+                self.sessions[obj.id] = obj
+            return obj
+
+        return create
+
+    def pay(self, session_id):
+        self.sessions[session_id].configure_mock(payment_status="paid", status="complete")
+
+    def list_sessions(self, created=None, status=None, limit=10):
+        self.calls.append(("cs_list", {"created": created, "status": status}))
+        sessions = [
+            session
+            for session in self.sessions.values()
+            if (status is None or session.status == status) and session.created >= (created or {}).get("gte", 0)
+        ]
+
+        return mock.Mock(auto_paging_iter=lambda: iter(sessions))
+
+    def count(self, prefix):
+        return sum(1 for name, _ in self.calls if name == prefix)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PaymentListTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="payer@example.com", password="testpassword", username="payer")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.course = Course.objects.create(title="Paid Course", owner=self.user)
+
+    def admin_client(self):
+        admin = User.objects.create_user(email="admin@example.com", password="testpassword", username="admin", is_staff=True)
+        self.client.force_authenticate(user=admin)
+
+    def test_payments_cursor_pagination(self):
+        """
+        Платежи отдаются keyset-страницами от новых к старым, без COUNT(*).
+        """
+        payments = [
+            Payment.objects.create(user=self.user, course=self.course, amount=100, payment_method="cash") for _ in range(3)
+        ]
+        url = reverse("users:payment-list")
+
+        response = self.client.get(url, {"page_size": 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("count", response.data)
+        self.assertEqual([item["id"] for item in response.data["results"]], [payments[2].id, payments[1].id])
+
+        response = self.client.get(response.data["next"])
+        self.assertEqual([item["id"] for item in response.data["results"]], [payments[0].id])
+
+    def test_payments_filter_by_method(self):
+        """
+        Фильтр payment_method работает вместе с курсорной пагинацией.
+        """
+        Payment.objects.create(user=self.user, course=self.course, amount=100, payment_method="cash")
+        transfer = Payment.objects.create(user=self.user, course=self.course, amount=200, payment_method="transfer")
+
+        response = self.client.get(reverse("users:payment-list"), {"payment_method": "transfer"})
+        self.assertEqual([item["id"] for item in response.data["results"]], [transfer.id])
+
+    def test_payments_export_admin_only(self):
+        """
+        Полная выгрузка платежей доступна только администраторам.
+        """
+        url = reverse("users:payment-export")
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(APIClient().get(url).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_payments_export_csv(self):
+        """
+        Выгрузка CSV отдается потоком, учитывает фильтр и сортировку от новых к старым.
+        """
+        self.admin_client()
+        cash = [
+            Payment.objects.create(user=self.user, course=self.course, amount=100, payment_method="cash") for _ in range(3)
+        ]
+        Payment.objects.create(user=self.user, course=self.course, amount=200, payment_method="transfer")
+
+        response = self.client.get(reverse("users:payment-export"), {"payment_method": "cash"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        rows = list(csv.reader(b"".join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0][0], "id")
+        self.assertEqual([int(row[0]) for row in rows[1:]], [payment.id for payment in reversed(cash)])
+
+    def test_payments_export_ndjson(self):
+        """
+        Выгрузка NDJSON: по одному платежу на строку.
+        """
+        self.admin_client()
+        payment = Payment.objects.create(user=self.user, course=self.course, amount=100, payment_method="cash")
+
+        response = self.client.get(reverse("users:payment-export"), {"type": "ndjson"})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)["id"] for line in lines], [payment.id])
+
+        response = self.client.get(reverse("users:payment-export"), {"type": "xml"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PaymentRollupTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="payer@example.com", password="testpassword", username="payer")
+        self.admin = User.objects.create_user(
+            email="admin@example.com", password="testpassword", username="admin", is_staff=True
+        )
+        self.course = Course.objects.create(title="Paid Course", owner=self.user)
+        self.lesson = Lesson.objects.create(title="Paid Lesson", course=self.course, owner=self.user)
+
+    def create_payment(self, amount, payment_method="cash", **kwargs):
+        kwargs.setdefault("course", self.course)
+        return Payment.objects.create(user=self.user, amount=amount, payment_method=payment_method, **kwargs)
+
+    def rollups(self):
+        return {
+            (rollup.course_id, rollup.lesson_id, rollup.payment_method): (rollup.amount_total, rollup.payments_count)
+            for rollup in PaymentDailyRollup.objects.all()
+        }
+
+    def test_mark_paid_updates_rollup_once(self):
+        """
+        Оплата прибавляется к сводке дня один раз, повторная отметка ничего не меняет.
+        """
+        first, second = self.create_payment(100), self.create_payment(250)
+        self.assertTrue(first.mark_paid())
+        self.assertTrue(second.mark_paid())
+        self.assertFalse(first.mark_paid())
+
+        rollup = PaymentDailyRollup.objects.get()
+        self.assertEqual(rollup.day, timezone.localdate())
+        self.assertEqual((rollup.amount_total, rollup.payments_count), (350, 2))
+
+    def test_rebuild_matches_incremental(self):
+        """
+        Пересборка дает те же сводки, что и инкрементальное обновление, неоплаченные платежи не учитываются.
+        """
+        for payment in [
+            self.create_payment(100),
+            self.create_payment(200, "transfer"),
+            self.create_payment(300, course=None, lesson=self.lesson),
+        ]:
+            payment.mark_paid()
+        self.create_payment(1000)
+        incremental = self.rollups()
+
+        PaymentDailyRollup.objects.all().delete()
+        rebuild_payment_rollups()
+        self.assertEqual(self.rollups(), incremental)
+
+        PaymentDailyRollup.objects.update(amount_total=0)
+        rebuild_payment_rollups(days=1)
+        self.assertEqual(self.rollups(), incremental)
+
+    def test_rollup_endpoint(self):
+        """
+        Сводки отдаются только администратору, с фильтрами по курсу, способу оплаты и дню.
+        """
+        self.create_payment(100).mark_paid()
+        self.create_payment(200, "transfer").mark_paid()
+        url = reverse("users:payment_rollups")
+
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=self.admin)
+        today = timezone.localdate().isoformat()
+        response = self.client.get(url, {"course": self.course.id, "payment_method": "transfer", "day__gte": today})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data["results"],
+            [
+                {
+                    "day": today,
+                    "course": self.course.id,
+                    "lesson": None,
+                    "payment_method": "transfer",
+                    "amount_total": 200,
+                    "payments_count": 1,
+                }
+            ],
+        )
+
+    def test_rollup_paging_within_one_day(self):
+        """
+        Курсор хранит (day, id): тысячи сводок одного дня пролистываются без потерь и повторов.
+        """
+        today, yesterday = timezone.localdate(), timezone.localdate() - timedelta(days=1)
+        PaymentDailyRollup.objects.bulk_create(
+            PaymentDailyRollup(day=day, course_id=index, payment_method="cash", amount_total=1, payments_count=1)
+            for day in (yesterday, today)
+            for index in range(1, 2501)
+        )
+        expected = list(PaymentDailyRollup.objects.order_by("-day", "-id").values_list("id", flat=True))
+
+        self.client.force_authenticate(user=self.admin)
+        seen, url = [], reverse("users:payment_rollups") + "?page_size=1000"
+        while url:
+            response = self.client.get(url)
+            seen += [(item["day"], item["course"]) for item in response.data["results"]]
+            url = response.data["next"]
+        self.assertEqual(len(seen), len(expected))
+        self.assertEqual(len(set(seen)), len(expected))
+        self.assertEqual(seen[0], (today.isoformat(), 2500))
+        self.assertEqual(seen[-1], (yesterday.isoformat(), 1))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StripeCheckoutTests(APITestCase):
+    def setUp(self):
+        self.stripe = FakeStripe(self)
+        self.user = User.objects.create_user(email="payer@example.com", password="testpassword", username="payer")
+        self.client.force_authenticate(user=self.user)
+        self.course = Course.objects.create(title="Paid Course", description="Описание", owner=self.user)
+        self.lesson = Lesson.objects.create(title="Paid Lesson", description="Описание", course=self.course, owner=self.user)
+
+    def checkout(self, **data):
+        response = self.client.post(reverse("users:create_payment"), {"payment_method": "stripe", **data}, format="json")
+        run_outbox()
+        return response
+
+    def test_product_and_price_created_once(self):
+        """
+        Продукт и цена создаются при первой оплате, последующие оплаты делают один вызов Stripe.
+        """
+        for _ in range(3):
+            response = self.checkout(course=self.course.id, amount=1000)
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        self.assertEqual((self.stripe.count("prod"), self.stripe.count("price"), self.stripe.count("cs")), (1, 1, 3))
+        self.course.refresh_from_db()
+        price = StripePrice.objects.get(course=self.course)
+        self.assertEqual(price.amount, 1000)
+        payment = Payment.objects.latest("id")
+        self.assertEqual((payment.stripe_product_id, payment.stripe_price_id), (self.course.stripe_product_id, price.price_id))
+
+    def test_new_amount_reuses_product(self):
+        """
+        Для другой суммы создается только новая цена, продукт курса переиспользуется; урок получает свой продукт.
+        """
+        self.checkout(course=self.course.id, amount=1000)
+        self.checkout(course=self.course.id, amount=500)
+        self.checkout(lesson=self.lesson.id, amount=500)
+
+        self.assertEqual((self.stripe.count("prod"), self.stripe.count("price")), (2, 3))
+        self.assertEqual(StripePrice.objects.filter(course=self.course).count(), 2)
+        self.assertEqual(StripePrice.objects.filter(lesson=self.lesson).count(), 1)
+
+    def test_services_share_cache(self):
+        """
+        Хелперы users.services используют тот же кеш, что и оплата.
+        """
+        self.checkout(course=self.course.id, amount=1000)
+        self.course.refresh_from_db()
+        self.assertEqual(services.get_stripe_product_id(self.course), self.course.stripe_product_id)
+        self.assertEqual(services.get_stripe_price_id(self.course, 1000), StripePrice.objects.get().price_id)
+        self.assertEqual(self.stripe.count("prod") + self.stripe.count("price"), 2)
+
+    def test_checkout_is_created_in_background(self):
+        """
+        Запрос только сохраняет платеж и ставит задачу, ссылку на оплату отдает эндпоинт статуса.
+        """
+        response = self.client.post(
+            reverse("users:create_payment"),
+            {"course": self.course.id, "amount": 1000, "payment_method": "cash"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(self.stripe.calls, [])
+        status_url = response.data["status_url"]
+        self.assertEqual(self.client.get(status_url).data["status"], "pending")
+
+        run_outbox()
+        data = self.client.get(status_url).data
+        self.assertEqual(data["status"], "created")
+        self.assertTrue(data["payment_link"].startswith("https://checkout.stripe.test/"))
+        payment = Payment.objects.get()
+        self.assertEqual(
+            (payment.payment_method, payment.session_id), ("stripe", self.stripe.objects[f"checkout:{payment.id}"].id)
+        )
+
+        create_checkout_session(payment.id, "http://testserver/success/", "http://testserver/cancel/")
+        self.assertEqual(self.stripe.count("cs"), 1)
+
+        other = User.objects.create_user(email="other@example.com", password="testpassword", username="other")
+        self.client.force_authenticate(user=other)
+        self.assertEqual(self.client.get(status_url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_checkout_errors(self):
+        """
+        Временная ошибка Stripe повторяется, постоянная сохраняется в статусе платежа.
+        """
+        with mock.patch.object(
+            services,
+            "create_stripe_session",
+            side_effect=[
+                stripe.error.APIConnectionError("timeout"),
+                {"session_id": "cs_ok", "payment_link": "https://checkout.stripe.test/ok"},
+            ],
+        ):
+            self.checkout(course=self.course.id, amount=1000)
+        self.assertEqual(Payment.objects.get().checkout_status, "created")
+
+        error = stripe.error.InvalidRequestError("bad request", param=None)
+        with mock.patch.object(services, "create_stripe_session", side_effect=error):
+            response = self.checkout(course=self.course.id, amount=1000)
+        data = self.client.get(response.data["status_url"]).data
+        self.assertEqual(data["status"], "failed")
+        self.assertIn("Ошибка при создании платежа", data["error"])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PaymentIdempotencyTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email="payer@example.com", password="testpassword", username="payer")
+        self.client.force_authenticate(user=self.user)
+        self.course = Course.objects.create(title="Paid Course", owner=self.user)
+        self.data = {"course": self.course.id, "amount": 1000, "payment_method": "stripe"}
+
+    def post(self, data=None, key="retry-1"):
+        return self.client.post(reverse("users:create_payment"), data or self.data, format="json", HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_repeat_replays_first_response(self):
+        """
+        Повтор с тем же ключом возвращает первый ответ и не создает второй платеж и вторую задачу.
+        """
+        first = self.post()
+        second = self.post()
+        self.assertEqual(second.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertNotIn("Idempotent-Replayed", first)
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+
+        self.post(key="retry-2")
+        self.assertEqual(Payment.objects.count(), 2)
+
+    def test_key_reused_with_other_body(self):
+        """
+        Тот же ключ с другим телом запроса отклоняется.
+        """
+        self.post()
+        response = self.post({**self.data, "amount": 2000})
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_concurrent_duplicate_conflicts(self):
+        """
+        Пока первый запрос с ключом выполняется, одновременный повтор получает 409.
+        """
+        services.acquire_idempotency_lock(services.idempotency_cache_key(self.user.pk, "retry-1"))
+        response = self.post()
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertFalse(Payment.objects.exists())
+
+    def test_keys_are_per_user(self):
+        """
+        Одинаковые ключи разных пользователей не пересекаются.
+        """
+        self.post()
+        other = User.objects.create_user(email="other@example.com", password="testpassword", username="other")
+        self.client.force_authenticate(user=other)
+        response = self.post()
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(Payment.objects.filter(user=other).count(), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, STRIPE_WEBHOOK_SECRET="whsec_test")
+class StripeWebhookTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="payer@example.com", password="testpassword", username="payer")
+        self.course = Course.objects.create(title="Paid Course", owner=self.user)
+        self.payment = Payment.objects.create(
+            user=self.user, course=self.course, amount=500, payment_method="stripe", session_id="cs_test"
+        )
+        self.url = reverse("users:stripe_webhook")
+
+    def post_event(
+        self, event_id="evt_1", event_type="checkout.session.completed", payment_status="paid", secret="whsec_test"
+    ):
+        payload = json.dumps(
+            {
+                "id": event_id,
+                "object": "event",
+                "type": event_type,
+                "data": {"object": {"id": "cs_test", "object": "checkout.session", "payment_status": payment_status}},
+            }
+        )
+        timestamp = int(time.time())
+        signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+        return self.client.post(
+            self.url, payload, content_type="application/json", HTTP_STRIPE_SIGNATURE=f"t={timestamp},v1={signature}"
+        )
+
+    def test_paid_session_is_queued_once(self):
+        """
+        Событие оплаты сохраняется и ставит обработку в outbox; повторная доставка события игнорируется.
+        """
+        for _ in range(2):
+            response = self.post_event()
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(StripeEvent.objects.get().event_id, "evt_1")
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.task_name, message.args), ("lms.tasks.process_checkout_session", ["cs_test"]))
+
+        success_url = reverse("users:payment_success", args=[self.payment.id])
+        self.assertEqual(self.client.get(success_url).data["status"], "pending")
+
+        process_checkout_session(*message.args)
+        process_checkout_session(*message.args)
+        self.assertEqual(self.client.get(success_url).data["status"], "success")
+        rollup = PaymentDailyRollup.objects.get()
+        self.assertEqual((rollup.amount_total, rollup.payments_count), (500, 1))
+
+    def test_invalid_signature_rejected(self):
+        """
+        Событие с неверной подписью отклоняется и не сохраняется.
+        """
+        response = self.post_event(secret="whsec_other")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    def test_unpaid_session_not_queued(self):
+        """
+        Завершенная, но еще не оплаченная сессия (отложенные способы оплаты) не отмечает платеж.
+        """
+        self.post_event(payment_status="unpaid")
+        self.post_event(event_id="evt_2", event_type="customer.created")
+        self.assertFalse(OutboxMessage.objects.exists())
+        self.assertEqual(StripeEvent.objects.count(), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PaymentReconcileTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.stripe = FakeStripe(self)
+        self.user = User.objects.create_user(email="payer@example.com", password="testpassword", username="payer")
+        self.client.force_authenticate(user=self.user)
+        self.course = Course.objects.create(title="Paid Course", owner=self.user)
+
+    def checkout(self, amount=1000):
+        self.client.post(
+            reverse("users:create_payment"),
+            {"payment_method": "stripe", "course": self.course.id, "amount": amount},
+            format="json",
+        )
+        run_outbox()
+        return Payment.objects.latest("id")
+
+    def test_reconcile_marks_paid_sessions(self):
+        """
+        Оплаченные в Stripe сессии отмечаются пачками без запроса на каждый платеж, остальные остаются ожидающими.
+        """
+        payments = [self.checkout(amount=100 * (index + 1)) for index in range(5)]
+        for payment in payments[:3]:
+            self.stripe.pay(payment.session_id)
+        Payment.objects.filter(id=payments[0].id).update(date=timezone.now() - timedelta(days=10))  # Вне окна сверки
+
+        metrics = reconcile_pending_payments(batch_size=2)
+        self.assertEqual((metrics["checked"], metrics["marked_paid"], metrics["stripe_paid_sessions"]), (4, 2, 3))
+        self.assertEqual(cache.get(RECONCILE_METRICS_KEY)["marked_paid"], 2)
+        self.assertEqual(
+            set(Payment.objects.filter(is_paid=True).values_list("id", flat=True)), {payments[1].id, payments[2].id}
+        )
+        self.assertEqual(PaymentDailyRollup.objects.get().amount_total, 500)
+        self.assertEqual(self.stripe.count("cs_list"), 1)
+
+        metrics = reconcile_pending_payments()
+        self.assertEqual((metrics["checked"], metrics["marked_paid"]), (2, 0))
+        self.assertEqual(PaymentDailyRollup.objects.get().payments_count, 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ThrottlingTests(APITestCase):
+    def setUp(self):
+        patcher = mock.patch.object(redis_client, "_unavailable_until", 0.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user(email="payer@example.com", password="testpassword", username="payer")
+        self.register_data = {"email": "new@example.com", "username": "new", "password": "testpassword"}
+
+    @mock.patch.object(throttling, "token_bucket", return_value=(False, 1500))
+    def test_exhausted_bucket_returns_retry_after(self, mock_bucket):
+        """
+        Пустая корзина дает 429 с заголовком Retry-After, анонимные запросы считаются по IP.
+        """
+        response = self.client.post(reverse("users:register"), self.register_data, REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response["Retry-After"], "2")
+        self.assertFalse(User.objects.filter(email="new@example.com").exists())
+        key, capacity, rate = mock_bucket.call_args.args
+        self.assertEqual((key, capacity), ("throttle:register:ip:10.0.0.1", 5))
+        self.assertAlmostEqual(rate, 5 / 60000)
+
+    @mock.patch.object(throttling, "token_bucket", return_value=(True, 0))
+    def test_scopes_and_user_buckets(self, mock_bucket):
+        """
+        Для пользователя корзина своя в каждой области; представления без области Redis не опрашивают.
+        """
+        self.client.force_authenticate(user=self.user)
+        course = Course.objects.create(title="Course", owner=self.user)
+        self.client.post(reverse("users:create_payment"), {"course": course.id, "amount": 100}, format="json")
+        self.client.post(reverse("lms:subscriptions"), {"course_id": course.id}, format="json")
+        self.client.get(reverse("users:payment-list"))
+
+        keys = [call.args[0] for call in mock_bucket.call_args_list]
+        self.assertEqual(keys, [f"throttle:payments:user:{self.user.pk}", f"throttle:subscriptions:user:{self.user.pk}"])
+
+    @mock.patch.object(throttling, "token_bucket", side_effect=redis.ConnectionError("down"))
+    def test_fail_open_when_redis_unavailable(self, mock_bucket):
+        """
+        Без Redis запросы не ограничиваются, и Redis какое-то время не опрашивается.
+        """
+        for index in range(2):
+            response = self.client.post(
+                reverse("users:register"),
+                {**self.register_data, "email": f"new{index}@example.com", "username": f"new{index}"},
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        mock_bucket.assert_called_once()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PermissionTests(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(email="owner@example.com", password="testpassword", username="owner")
+        self.moderator = User.objects.create_user(email="moderator@example.com", password="testpassword", username="moderator")
+        self.moderator.groups.add(Group.objects.create(name="moderator"))
+        self.courses = [Course.objects.create(title=f"Course {index}", owner=self.owner) for index in range(3)]
+        self.foreign_course = Course.objects.create(title="Foreign Course", owner=self.moderator)
+
+    def make_request(self, user):
+        request = Request(APIRequestFactory().get("/"))
+        request.user = user
+        return request
+
+    def make_view(self, *permission_classes, **kwargs):
+        view = generics.ListAPIView(permission_classes=permission_classes)
+        view.kwargs = kwargs
+        return view
+
+    def test_moderator_groups_loaded_once_per_request(self):
+        """
+        Группы пользователя загружаются одним запросом на все проверки объектов.
+        """
+        request = self.make_request(self.moderator)
+        permission = IsModerator()
+        with self.assertNumQueries(1):
+            self.assertTrue(all(permission.has_object_permission(request, None, course) for course in self.courses))
+
+        request = self.make_request(self.owner)
+        with self.assertNumQueries(1):
+            self.assertFalse(any(permission.has_object_permission(request, None, course) for course in self.courses))
+
+    def test_owner_check_does_not_load_owner(self):
+        """
+        Проверка владельца сравнивает id и не загружает связанного пользователя.
+        """
+        request = self.make_request(self.owner)
+        courses = list(Course.objects.all())
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [IsOwner().has_object_permission(request, None, course) for course in courses],
+                [course.owner_id == self.owner.pk for course in courses],
+            )
+
+    def test_filter_backend_restricts_lists(self):
+        """
+        Для списков права применяются как фильтр SQL.
+        """
+        backend = PermissionFilterBackend()
+        queryset = Course.objects.all()
+
+        owner_request = self.make_request(self.owner)
+        filtered = backend.filter_queryset(owner_request, queryset, self.make_view(IsModeratorOrOwner))
+        self.assertEqual(set(filtered), set(self.courses))
+
+        moderator_request = self.make_request(self.moderator)
+        filtered = backend.filter_queryset(moderator_request, queryset, self.make_view(IsModerator))
+        self.assertEqual(filtered.count(), 4)
+        filtered = backend.filter_queryset(owner_request, queryset, self.make_view(IsModerator))
+        self.assertFalse(filtered.exists())
+
+    def test_filter_backend_ignores_detail_requests(self):
+        """
+        Запросы конкретного объекта не фильтруются, чтобы сохранялся ответ 403.
+        """
+        request = self.make_request(self.owner)
+        view = self.make_view(IsOwner, pk=self.foreign_course.pk)
+        self.assertEqual(PermissionFilterBackend().filter_queryset(request, Course.objects.all(), view).count(), 4)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StatelessAuthenticationTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email="student@example.com", password="testpassword", username="student")
+        self.user.groups.add(Group.objects.create(name="moderator"))
+        self.course = Course.objects.create(title="Course", owner=self.user)
+        self.lesson = Lesson.objects.create(
+            title="Lesson", description="Description", course=self.course, owner=self.user, video_url="https://youtube.com/v"
+        )
+        response = self.client.post(
+            reverse("users:token_obtain_pair"), {"email": "student@example.com", "password": "testpassword"}, format="json"
+        )
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+
+    def test_read_requests_skip_user_lookup(self):
+        """
+        GET-запрос аутентифицируется по claims токена: в БД выполняется только выборка урока.
+        """
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("lms:lesson-get", args=[self.lesson.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_write_requests_use_cached_user(self):
+        """
+        Небезопасные методы получают полную модель пользователя, повторно - из кеша.
+        """
+        url = reverse("lms:subscriptions")
+        with self.assertNumQueries(2):  # Пользователь и переключение подписки
+            self.client.post(url, {"course_id": self.course.id}, format="json")
+        with self.assertNumQueries(1):
+            self.client.post(url, {"course_id": self.course.id}, format="json")
+
+    def test_deactivation_revokes_access(self):
+        """
+        Деактивированный пользователь сразу теряет доступ по уже выданному токену.
+        """
+        User.objects.filter(pk=self.user.pk).update(last_login=timezone.now() - timedelta(days=60))
+        url = reverse("lms:lesson-get", args=[self.lesson.id])
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+        deactivate_inactive_users(pause=0)
+
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.post(reverse("lms:subscriptions"), {"course_id": self.course.id}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_saving_inactive_user_revokes_access(self):
+        """
+        Отключение пользователя через модель (например, в админке) также отзывает доступ, повторная активация - возвращает.
+        """
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get(reverse("lms:lesson-get", args=[self.lesson.id]))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.user.is_active = True
+        self.user.save()
+        response = self.client.get(reverse("lms:lesson-get", args=[self.lesson.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_refresh_rereads_claims(self):
+        """
+        Обновленный access-токен несет текущие права из БД: разжалованный администратор теряет их при refresh.
+        """
+        self.user.is_staff = True
+        self.user.save()
+        tokens = self.client.post(
+            reverse("users:token_obtain_pair"), {"email": "student@example.com", "password": "testpassword"}, format="json"
+        ).data
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        self.assertEqual(self.client.get(reverse("users:payment_rollups")).status_code, status.HTTP_200_OK)
+
+        self.user.is_staff = False
+        self.user.save()
+        self.user.groups.clear()
+        response = self.client.post(reverse("users:token_refresh"), {"refresh": tokens["refresh"]}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        access = AccessToken(response.data["access"])
+        self.assertEqual((access["is_staff"], access["groups"]), (False, []))
+
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.assertEqual(self.client.get(reverse("users:payment_rollups")).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_works_without_redis(self):
+        """
+        Недоступный кеш не ломает аутентификацию и сохранение пользователя: данные берутся из БД.
+        """
+        down = redis.ConnectionError("down")
+        broken_cache = mock.Mock(**{f"{name}.side_effect": down for name in ("get", "set", "set_many", "delete_many")})
+        with mock.patch.object(authentication, "cache", broken_cache):
+            response = self.client.get(reverse("lms:lesson-get", args=[self.lesson.id]))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.post(reverse("lms:subscriptions"), {"course_id": self.course.id}, format="json")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.user.first_name = "Иван"
+            self.user.save()
+            self.user.is_active = False
+            self.user.save()
+
+
+@override_settings(CACHES=LOCMEM_CACHES, USER_PAYMENTS_EXPAND_LIMIT=2)
+class UserListTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="admin@example.com", password="testpassword", username="admin")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        course = Course.objects.create(title="Course", owner=self.user)
+        for index in range(4):
+            customer = User.objects.create_user(
+                email=f"customer{index}@example.com", password="testpassword", username=f"customer{index}"
+            )
+            for amount in (100, 200, 300):
+                Payment.objects.create(user=customer, course=course, amount=amount, payment_method="cash")
+
+    def test_list_is_lightweight_by_default(self):
+        """
+        По умолчанию список пользователей без платежей и одним запросом.
+        """
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("users:user-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), 5)
+        self.assertNotIn("payments", response.data["results"][0])
+
+    def test_expand_payments_prefetches_latest(self):
+        """
+        ?expand=payments подгружает последние платежи всех пользователей страницы одним запросом.
+        """
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("users:user-list"), {"expand": "payments"})
+        customers = [item for item in response.data["results"] if item["id"] != self.user.id]
+        self.assertTrue(all(len(item["payments"]) == 2 for item in customers))
+        self.assertEqual([payment["amount"] for payment in customers[0]["payments"]], [300, 200])
+
+    def test_users_paginated(self):
+        """
+        Список пользователей разбит на keyset-страницы.
+        """
+        response = self.client.get(reverse("users:user-list"), {"page_size": 2})
+        self.assertEqual(len(response.data["results"]), 2)
+        self.assertIsNotNone(response.data["next"])
@@ -0,0 +1,88 @@
+import logging
+from functools import lru_cache
+
+import redis
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle
+
+from config.redis_client import get_redis_client, mark_redis_unavailable, redis_available
+
+logger = logging.getLogger(__name__)
+
+# Token bucket: емкость capacity, пополнение rate токенов в миллисекунду. Время берется из Redis (TIME),
+# поэтому часы веб-процессов не важны. Возвращает {1, 0} если запрос разрешен, иначе {0, ожидание в мс}.
+TOKEN_BUCKET_LUA = """
+local now = redis.call('TIME')
+local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now_ms
+tokens = math.min(capacity, tokens + math.max(0, now_ms - ts) * rate)
+local allowed, wait = 0, 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = math.ceil((1 - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now_ms)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate))
+return {allowed, wait}
+"""
+
+PERIODS = {"s": 1, "m": 60, "h": 60 * 60, "d": 60 * 60 * 24}
+
+
+@lru_cache(maxsize=None)
+def get_token_bucket_script():
+    return get_redis_client().register_script(TOKEN_BUCKET_LUA)
+
+
+def token_bucket(key, capacity, rate_per_ms):
+    """
+    Атомарно забирает токен из корзины одним обращением к Redis (EVALSHA; EVAL только при первом вызове).
+    """
+    allowed, wait_ms = get_token_bucket_script()(keys=[key], args=[capacity, rate_per_ms])
+    return bool(allowed), int(wait_ms)
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Ограничение частоты запросов по алгоритму token bucket в Redis.
+    Область задается атрибутом throttle_scope представления, лимит - в DEFAULT_THROTTLE_RATES ("10/min":
+    до 10 запросов подряд, затем по одному каждые 6 секунд). Корзина своя у каждого пользователя,
+    для анонимных запросов - у каждого IP. Представления без области не ограничиваются и не обращаются к Redis.
+    Если Redis недоступен, запросы пропускаются, и Redis не опрашивается REDIS_RETRY_AFTER секунд.
+    """
+
+    def __init__(self):
+        self.wait_ms = 0
+
+    def parse_rate(self, rate):
+        count, period = rate.split("/")
+        return int(count), PERIODS[period[0]]
+
+    def get_cache_key(self, request, scope):
+        if request.user and request.user.is_authenticated:
+            return f"throttle:{scope}:user:{request.user.pk}"
+        return f"throttle:{scope}:ip:{self.get_ident(request)}"
+
+    def allow_request(self, request, view):
+        scope = getattr(view, "throttle_scope", None)
+        rate = settings.REST_FRAMEWORK.get("DEFAULT_THROTTLE_RATES", {}).get(scope)
+        if rate is None or not redis_available():
+            return True
+
+        capacity, period = self.parse_rate(rate)
+        try:
+            allowed, self.wait_ms = token_bucket(self.get_cache_key(request, scope), capacity, capacity / (period * 1000))
+        except redis.RedisError as exc:
+            logger.warning(f"Ограничение частоты запросов отключено: Redis недоступен ({exc})")
+            mark_redis_unavailable()
+            return True
+        return allowed
+
+    def wait(self):
+        return self.wait_ms / 1000
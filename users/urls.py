@@ -4,7 +4,17 @@ from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 from lms.apps import LmsConfig
 
-from .views import CustomUserViewSet, PaymentCancelView, PaymentCreateAPIView, PaymentSuccessView, PaymentViewSet, RegisterView
+from .views import (
+    CustomUserViewSet,
+    PaymentCancelView,
+    PaymentCreateAPIView,
+    PaymentRollupListView,
+    PaymentStatusView,
+    PaymentSuccessView,
+    PaymentViewSet,
+    RegisterView,
+    StripeWebhookView,
+)
 
 app_name = LmsConfig.name
 router = DefaultRouter()
@@ -16,6 +26,9 @@ urlpatterns = [
     path("token/", TokenObtainPairView.as_view(), name="token_obtain_pair"),
     path("token/refresh/", TokenRefreshView.as_view(), name="token_refresh"),
     path("payments/create/", PaymentCreateAPIView.as_view(), name="create_payment"),
+    path("payments/rollups/", PaymentRollupListView.as_view(), name="payment_rollups"),
     path("payments/success/<int:pk>/", PaymentSuccessView.as_view(), name="payment_success"),
     path("payments/cancel/<int:pk>/", PaymentCancelView.as_view(), name="payment_cancel"),
+    path("payments/status/<int:pk>/", PaymentStatusView.as_view(), name="payment_status"),
+    path("payments/webhook/", StripeWebhookView.as_view(), name="stripe_webhook"),
 ] + router.urls
@@ -1,26 +1,60 @@
+import csv
+import json
+from itertools import chain
+
 import stripe
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import generics, permissions, status, viewsets
-from rest_framework.filters import OrderingFilter
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import CreateAPIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from lms.models import Course, Lesson
-from lms.paginators import CustomPaginator
+from lms.filters import StableOrderingFilter
+from lms.models import Course, Lesson, OutboxMessage
+from lms.paginators import CustomCursorPaginator, CustomPaginator, PaymentCursorPaginator, PaymentRollupCursorPaginator
 from lms.serializers import LessonSerializer
-from users.models import CustomUser, Payment
-from users.serializers import PaymentSerializer, RegisterSerializer, UserSerializer
+from users import services
+from users.models import CustomUser, Payment, PaymentDailyRollup, StripeEvent
+from users.serializers import PaymentDailyRollupSerializer, PaymentSerializer, RegisterSerializer, UserSerializer
 
 User = get_user_model()  # получает пользовательскую модель
 stripe.api_key = settings.STRIPE_API_KEY
 
 
-class CustomUserViewSet(viewsets.ModelViewSet):
+class UserExpandMixin:
+    """
+    Разбирает параметр ?expand= для UserSerializer. Платежи подгружаются одним запросом
+    и только по запросу, не более USER_PAYMENTS_EXPAND_LIMIT последних на пользователя.
+    """
+
+    def get_expand(self):
+        return {name for name in self.request.query_params.get("expand", "").split(",") if name}
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context["expand"] = self.get_expand()
+        return context
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if "payments" in self.get_expand():
+            payments = Payment.objects.order_by("-date", "-id")[: settings.USER_PAYMENTS_EXPAND_LIMIT]
+            queryset = queryset.prefetch_related(Prefetch("payment_set", queryset=payments, to_attr="recent_payments"))
+        return queryset
+
+
+class CustomUserViewSet(UserExpandMixin, viewsets.ModelViewSet):
     """
     Управляет пользователями.
     Модель CustomUser.
@@ -32,26 +66,88 @@ class CustomUserViewSet(viewsets.ModelViewSet):
     permission_classes = [
         permissions.IsAuthenticated
     ]  # Настройка прав доступа. Доступ только для аутентифицированных пользователей.
+    pagination_class = CustomCursorPaginator
+
+
+class Echo:
+    """
+    Псевдофайл для csv.writer: возвращает записанную строку вместо буферизации.
+    """
+
+    def write(self, value):
+        return value
 
 
 class PaymentViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Payment.objects.all()
     serializer_class = PaymentSerializer
-    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, StableOrderingFilter]
     filterset_fields = ["payment_method"]
     ordering_fields = ["date"]
-    ordering = ["-date"]  # По умолчанию сортировка от новых к старым
+    ordering = ["-date", "-id"]  # По умолчанию сортировка от новых к старым
+    pagination_class = PaymentCursorPaginator
+
+    export_fields = ("id", "user_id", "date", "course_id", "lesson_id", "amount", "payment_method", "is_paid")
+    export_content_types = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+    @action(detail=False, methods=["get"], url_path="export", permission_classes=[permissions.IsAdminUser])
+    def export(self, request):
+        """
+        Потоковая выгрузка всех платежей в CSV или NDJSON (?type=csv|ndjson) с учетом фильтров и сортировки.
+        Строки читаются серверным курсором порциями, поэтому память не зависит от числа платежей.
+        """
+        export_type = request.query_params.get("type", "csv")
+        if export_type not in self.export_content_types:
+            raise ValidationError({"type": f"Допустимые значения: {', '.join(self.export_content_types)}."})
+
+        rows = (
+            self.filter_queryset(self.get_queryset())
+            .values(*self.export_fields)
+            .iterator(chunk_size=settings.PAYMENT_EXPORT_CHUNK_SIZE)
+        )
+        if export_type == "csv":
+            writer = csv.writer(Echo())
+            header = [writer.writerow(self.export_fields)]
+            content = chain(header, (writer.writerow([row[field] for field in self.export_fields]) for row in rows))
+        else:
+            content = (json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + "\n" for row in rows)
+
+        response = StreamingHttpResponse(content, content_type=self.export_content_types[export_type])
+        response["Content-Disposition"] = f'attachment; filename="payments.{export_type}"'
+        return response
+
+
+class PaymentRollupListView(generics.ListAPIView):
+    """
+    Выручка по дням, курсам, урокам и способам оплаты из готовых сводок, без агрегации по платежам.
+    Фильтры: day__gte, day__lte, course, lesson, payment_method.
+    """
+
+    queryset = PaymentDailyRollup.objects.all()
+    serializer_class = PaymentDailyRollupSerializer
+    permission_classes = [permissions.IsAdminUser]
+    filter_backends = [DjangoFilterBackend]
+    filterset_fields = {
+        "day": ["exact", "gte", "lte"],
+        "course": ["exact"],
+        "lesson": ["exact"],
+        "payment_method": ["exact"],
+    }
+    pagination_class = PaymentRollupCursorPaginator
 
 
-class UserListCreateView(generics.ListCreateAPIView):  # Позволяет просматривать список пользователей и создавать нового
+class UserListCreateView(
+    UserExpandMixin, generics.ListCreateAPIView
+):  # Позволяет просматривать список пользователей и создавать нового
     queryset = User.objects.all()  # выбрать всех пользователей из БД.
     serializer_class = UserSerializer  # преобразует данные при помощи UserSerializer
     permission_classes = [
         permissions.IsAuthenticated
     ]  # Настройка прав доступа. Доступ только для аутентифицированных пользователей.
+    pagination_class = CustomCursorPaginator  # Keyset-пагинация
 
 
-class UserRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):  # GET, PUT/PATCH, DELETE
+class UserRetrieveUpdateDestroyView(UserExpandMixin, generics.RetrieveUpdateDestroyAPIView):  # GET, PUT/PATCH, DELETE
     queryset = User.objects.all()  # выбрать всех пользователей из БД.
     serializer_class = UserSerializer  # преобразует данные при помощи UserSerializer
     permission_classes = [
@@ -63,12 +159,13 @@ class RegisterView(generics.CreateAPIView):  # Позволяет создава
     queryset = User.objects.all()
     serializer_class = RegisterSerializer  # хэширование пароля при помощи RegisterSerializer
     permission_classes = [permissions.AllowAny]  # Доступ без авторизации. Для регистрации.
+    throttle_scope = "register"  # Хеширование пароля дорогое, ограничиваем по IP
 
 
 class LessonListAPIView(generics.ListAPIView):  # Пагинация для уроков
     queryset = Lesson.objects.all()  # Выбрать все уроки из БД.
     serializer_class = LessonSerializer  # Преобразует данные при помощи LessonSerializer
-    pagination_class = CustomPaginator  # Пагинация
+    pagination_class = CustomCursorPaginator  # Keyset-пагинация
 
 
 class CourseListAPIView(generics.ListAPIView):  # Пагинация для курсов
@@ -78,48 +175,121 @@ class CourseListAPIView(generics.ListAPIView):  # Пагинация для ку
 
 
 class PaymentCreateAPIView(CreateAPIView):
+    """
+    Создание платежа. Сессия оплаты Stripe создается задачей в фоне, поэтому ответ 202 возвращается сразу,
+    а ссылку на оплату клиент получает из эндпоинта статуса.
+    С заголовком Idempotency-Key повтор запроса возвращает сохраненный первый ответ, не создавая новый платеж.
+    """
+
     permission_classes = [IsAuthenticated]
+    throttle_scope = "payments"
 
     def post(self, request, *args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if not key:
+            return self.create_payment(request)
+        if len(key) > 255:
+            return Response({"error": "Слишком длинный Idempotency-Key"}, status=status.HTTP_400_BAD_REQUEST)
+
+        cache_key = services.idempotency_cache_key(request.user.pk, key)
+        fingerprint = services.request_fingerprint(request.data)
+        stored = services.get_idempotent_response(cache_key)
+        if stored is None:
+            if not services.acquire_idempotency_lock(cache_key):
+                return Response({"error": "Запрос с этим Idempotency-Key уже выполняется"}, status=status.HTTP_409_CONFLICT)
+            try:
+                # Первый запрос мог завершиться между чтением ответа и захватом блокировки
+                stored = services.get_idempotent_response(cache_key)
+                if stored is None:
+                    response = self.create_payment(request)
+                    services.set_idempotent_response(cache_key, fingerprint, response)
+                    return response
+            finally:
+                services.release_idempotency_lock(cache_key)
+
+        if stored["fingerprint"] != fingerprint:
+            return Response(
+                {"error": "Idempotency-Key уже использован с другими параметрами"},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+        return Response(stored["data"], status=stored["status"], headers={"Idempotent-Replayed": "true"})
+
+    def create_payment(self, request):
         serializer = PaymentSerializer(data=request.data)
         if serializer.is_valid():
-            payment = serializer.save(user=request.user)
+            with transaction.atomic():
+                payment = serializer.save(user=request.user, payment_method="stripe", checkout_status="pending")
+                success_url = request.build_absolute_uri(reverse("users:payment_success", kwargs={"pk": payment.pk}))
+                cancel_url = request.build_absolute_uri(reverse("users:payment_cancel", kwargs={"pk": payment.pk}))
+                OutboxMessage.enqueue("lms.tasks.create_checkout_session", args=[payment.pk, success_url, cancel_url])
 
-            try:
-                payment_link, payment_id = payment.create_stripe_payment(request)
-                payment.session_id = payment_id
-                payment.link = payment_link
-                payment.save()
-                return Response(
-                    {"payment_id": payment_id, "payment_link": payment_link, "status": "created"},
-                    status=status.HTTP_201_CREATED,
-                )
-            except ValueError as e:
-                payment.delete()
-                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(
+                {
+                    "payment_id": payment.pk,
+                    "status": payment.checkout_status,
+                    "status_url": reverse("users:payment_status", kwargs={"pk": payment.pk}),
+                },
+                status=status.HTTP_202_ACCEPTED,
+            )
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class PaymentStatusView(APIView):
+    """Статус создания оплаты: одно чтение из БД, без обращения к Stripe"""
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk, *args, **kwargs):
+        payment = get_object_or_404(
+            Payment.objects.only("id", "checkout_status", "checkout_error", "link", "is_paid"), pk=pk, user=request.user.pk
+        )
+        return Response(
+            {
+                "payment_id": payment.pk,
+                "status": payment.checkout_status,
+                "payment_link": payment.link,
+                "error": payment.checkout_error or None,
+                "is_paid": payment.is_paid,
+            }
+        )
+
+
 class PaymentSuccessView(APIView):
-    """View для обработки успешной оплаты"""
+    """View для обработки успешной оплаты. Статус платежа обновляет вебхук Stripe, здесь только чтение из БД"""
 
     def get(self, request, pk, *args, **kwargs):
-        payment = get_object_or_404(Payment, pk=pk)
+        payment = get_object_or_404(Payment.objects.only("id", "is_paid"), pk=pk)
+        if payment.is_paid:
+            return Response({"status": "success", "message": "Платеж успешно завершен"})
+        return Response({"status": "pending", "message": "Ожидается оплата"})
 
-        # Проверяем статус платежа в Stripe
-        try:
-            session = stripe.checkout.Session.retrieve(payment.session_id)
 
-            if session.payment_status == "paid":
-                payment.is_paid = True
-                payment.save()
-                return Response({"status": "success", "message": "Платеж успешно завершен"})
-            else:
-                return Response({"status": "pending", "message": "Ожидается оплата"})
+class StripeWebhookView(APIView):
+    """
+    Вебхук Stripe. Проверяет подпись, запоминает id события и в той же транзакции ставит обработку
+    оплаченной сессии в outbox, поэтому отвечает сразу и не обрабатывает одно событие дважды.
+    """
+
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+    paid_session_events = ("checkout.session.completed", "checkout.session.async_payment_succeeded")
+
+    def post(self, request, *args, **kwargs):
+        try:
+            event = stripe.Webhook.construct_event(
+                request.body, request.META.get("HTTP_STRIPE_SIGNATURE", ""), settings.STRIPE_WEBHOOK_SECRET
+            )
+        except (ValueError, stripe.error.SignatureVerificationError):
+            return Response({"error": "Неверная подпись вебхука"}, status=status.HTTP_400_BAD_REQUEST)
 
-        except stripe.error.StripeError as e:
-            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if event["type"] in self.paid_session_events:
+            session = event["data"]["object"]
+            with transaction.atomic():
+                _, created = StripeEvent.objects.get_or_create(event_id=event["id"], defaults={"type": event["type"]})
+                if created and session["payment_status"] == "paid":
+                    OutboxMessage.enqueue("lms.tasks.process_checkout_session", args=[session["id"]])
+        return Response({"status": "received"})
 
 
 class PaymentCancelView(APIView):